@@ -0,0 +1,151 @@
+"""
+Reversible literal anonymization for NL/SQL pairs.
+
+Many questions differ only in the city, airline or flight number they mention, while
+their SQL is otherwise the same. Anonymizer replaces those literals with typed
+placeholders on both sides, numbered per type in order of appearance in the question:
+
+    "flights from denver to boston"  ->  "flights from CITY0 to CITY1"
+    ... city_1.city_name = 'DENVER' ...  ->  ... city_1.city_name = 'CITY0' ...
+
+The question alone determines the placeholders (the SQL is only rewritten with them), so
+the same mapping is available at inference time to put the literals back into generated
+SQL with deanonymize().
+
+Literal values are mined from train.sql: a quoted value is kept when its lowercase form,
+found as a phrase in a train question, almost always (min_precision) means the query
+uses that literal. Numbers of three or more digits (flight numbers, times written as
+1200) are kept as NUM; shorter ones ("8 am") rarely appear verbatim in the SQL.
+
+Run as a script to check the round trip on train/dev and count distinct inputs.
+"""
+
+import os
+import re
+from collections import Counter, defaultdict
+
+from entity_linker import EntityLinker
+
+SQL_LITERAL = re.compile(r"\b[a-z_]+_\d+\.(\w+) = '([^']+)'")
+NL_NUMBER = re.compile(r"\b\d{3,}\b")
+PLACEHOLDER = re.compile(r"\b([A-Z_]+?)(\d+)\b")
+
+# Placeholder type per column; other columns use their upper-cased name
+COLUMN_TYPES = {
+    'city_name': 'CITY',
+    'airport_code': 'AIRPORT',
+    'airline_code': 'AIRLINE',
+    'state_name': 'STATE',
+}
+
+class Anonymizer:
+
+    def __init__(self, values):
+        '''
+        values: {question phrase (lowercase): (placeholder type, SQL literal)}.
+        '''
+        self.values = values
+        self.linker = EntityLinker({phrase: phrase for phrase in values})
+
+    @classmethod
+    def from_data(cls, data_folder='data', nl_folder=None, min_count=2, min_precision=0.8):
+        '''
+        Literal values mined from data_folder/train.sql and the train.nl of nl_folder
+        (default data_folder), e.g. the preprocessed questions the model is trained on.
+        '''
+        with open(os.path.join(nl_folder or data_folder, 'train.nl'), 'r') as f:
+            nl_queries = [line.strip().lower() for line in f.readlines()]
+        with open(os.path.join(data_folder, 'train.sql'), 'r') as f:
+            sql_queries = [line.strip() for line in f.readlines()]
+
+        columns = defaultdict(Counter)
+        for sql_query in sql_queries:
+            for column, literal in SQL_LITERAL.findall(sql_query):
+                columns[literal][column] += 1
+
+        # How often a question containing the phrase uses the literal
+        candidates = EntityLinker({literal.lower(): literal for literal in columns})
+        mentions, uses = Counter(), Counter()
+        for nl_query, sql_query in zip(nl_queries, sql_queries):
+            for literal in {value for _, _, value in candidates.spans(nl_query)}:
+                mentions[literal] += 1
+                uses[literal] += f"'{literal.upper()}'" in sql_query
+
+        values = {}
+        for literal, column_counts in columns.items():
+            phrase = literal.lower()
+            if mentions[phrase] >= min_count and uses[phrase] / mentions[phrase] >= min_precision:
+                column = column_counts.most_common(1)[0][0]
+                values[phrase] = (COLUMN_TYPES.get(column, column.upper()), literal)
+        return cls(values)
+
+    def anonymize(self, nl_query, sql_query=None):
+        '''
+        Returns (anonymized question, anonymized SQL or None, {placeholder: literal}).
+        '''
+        lowered = nl_query.lower()
+        spans = [(start, end, self.values[phrase]) for start, end, phrase in self.linker.spans(lowered)]
+        taken = [(start, end) for start, end, _ in spans]
+        for match in NL_NUMBER.finditer(lowered):
+            if not any(start < match.end() and match.start() < end for start, end in taken):
+                spans.append((match.start(), match.end(), ('NUM', match.group())))
+        spans.sort()
+
+        placeholders = {}  # (type, literal) -> placeholder
+        type_counts = Counter()
+        pieces, position = [], 0
+        for start, end, (value_type, literal) in spans:
+            if (value_type, literal) not in placeholders:
+                placeholders[(value_type, literal)] = f"{value_type}{type_counts[value_type]}"
+                type_counts[value_type] += 1
+            pieces += [nl_query[position:start], placeholders[(value_type, literal)]]
+            position = end
+        pieces.append(nl_query[position:])
+        mapping = {placeholder: literal for (_, literal), placeholder in placeholders.items()}
+
+        if sql_query is not None:
+            for (value_type, literal), placeholder in placeholders.items():
+                if value_type == 'NUM':
+                    sql_query = re.sub(rf"(?<![\w'.]){literal}(?![\w'.])", placeholder, sql_query)
+                else:
+                    sql_query = sql_query.replace(f"'{literal.upper()}'", f"'{placeholder}'")
+        return "".join(pieces), sql_query, mapping
+
+    def deanonymize(self, sql_query, mapping):
+        '''
+        Put the literals of mapping back in place of their placeholders.
+        '''
+        def restore(match):
+            literal = mapping.get(match.group())
+            if literal is None:
+                return match.group()
+            return literal if match.group(1) == 'NUM' else literal.upper()
+        return PLACEHOLDER.sub(restore, sql_query)
+
+if __name__ == "__main__":
+    anonymizer = Anonymizer.from_data('data')
+    types = Counter(value_type for value_type, _ in anonymizer.values.values())
+
+    print("\n" + "="*80)
+    print(f"LITERAL ANONYMIZATION ({len(anonymizer.values)} literal values: "
+          + ", ".join(f"{t} {n}" for t, n in types.most_common(6)) + ", ...)")
+    print("="*80)
+    for split in ('train', 'dev'):
+        with open(os.path.join('data', f'{split}.nl'), 'r') as f:
+            nl_queries = [line.strip() for line in f.readlines()]
+        with open(os.path.join('data', f'{split}.sql'), 'r') as f:
+            sql_queries = [line.strip() for line in f.readlines()]
+
+        anonymized = [anonymizer.anonymize(nl, sql) for nl, sql in zip(nl_queries, sql_queries)]
+        mismatches = sum(anonymizer.deanonymize(sql, mapping) != gold
+                         for (_, sql, mapping), gold in zip(anonymized, sql_queries))
+        literals = sum(len(SQL_LITERAL.findall(sql)) for sql in sql_queries)
+        remaining = sum(len([l for _, l in SQL_LITERAL.findall(sql) if not PLACEHOLDER.fullmatch(l)])
+                        for _, sql, _ in anonymized)
+
+        status = "✓" if mismatches == 0 else "⚠"
+        print(f"{status} {split}: {mismatches} round-trip mismatches, "
+              f"{100 * (1 - remaining / literals):.1f}% of quoted SQL literals anonymized")
+        print(f"  Distinct questions: {len(set(nl_queries))} -> {len(set(nl for nl, _, _ in anonymized))}, "
+              f"distinct SQL: {len(set(sql_queries))} -> {len(set(sql for _, sql, _ in anonymized))}")
+    print("="*80 + "\n")
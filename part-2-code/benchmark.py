@@ -0,0 +1,592 @@
+#!/usr/bin/env python3
+"""
+CPU benchmarks for the training and inference performance options
+"""
+
+import argparse
+import copy
+import resource
+import time
+import numpy as np
+from itertools import islice
+import multiprocessing as mp
+
+import torch
+import torch.nn as nn
+
+from t5_utils import initialize_model, initialize_optimizer, compile_model, bucket_batch, enable_gradient_checkpointing
+from t5_utils import optimizer_state_bytes, load_model_weights, merge_lora
+from t5_utils import output_vocab_ids, restrict_output_vocab, get_encoder_outputs, speculative_generate
+from t5_utils_scratch import initialize_model_scratch
+from load_data import load_t5_data, load_lines, get_dataloader
+from load_data_scratch import get_dataloader_scratch
+from sql_tokenizer import SQLTokenizer, TrimmedTokenizer
+from sql_templates import TemplateMatcher
+from static_decoder import StaticCacheDecoder
+from transformers import T5TokenizerFast
+
+DEVICE = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+PAD_IDX = 0
+
+def get_args():
+    parser = argparse.ArgumentParser(description='T5 performance benchmarks')
+
+    parser.add_argument('--benchmark', type=str, required=True, choices=['compile', 'checkpointing', 'eval_encoder_reuse', 'optimizer', 'sql_tokenizer', 'sql_compression', 'restricted_vocab', 'schema_prompt', 'retrieval_draft', 'static_decoder'],
+                        help='Which benchmark to run')
+    parser.add_argument('--finetune', action='store_true', help="Benchmark pretrained T5 (vs scratch init)")
+    parser.add_argument('--use_schema', action='store_true', default=True, help="Use schema context in inputs")
+    parser.add_argument('--no_schema', dest='use_schema', action='store_false', help="Don't use schema context")
+    parser.add_argument('--use_preprocessed', action='store_true', help="Use preprocessed data")
+
+    parser.add_argument('--batch_size', type=int, default=16, help="Training batch size")
+    parser.add_argument('--test_batch_size', type=int, default=16, help="Generation batch size")
+    parser.add_argument('--num_batches', type=int, default=8, help="Number of distinct batches to time")
+    parser.add_argument('--num_repeats', type=int, default=3, help="Timed passes over the batches")
+    parser.add_argument('--max_gen_length', type=int, default=128, help="Max generation length")
+
+    parser.add_argument('--learning_rate', type=float, default=1e-4, help="Learning rate")
+    parser.add_argument('--weight_decay', type=float, default=0.01, help="Weight decay")
+    parser.add_argument('--optimizer', type=str, default="adamw", choices=["adamw", "adafactor"],
+                        help="AdamW, or Adafactor with factorized second moments (less optimizer memory)")
+    parser.add_argument('--adafactor_beta1', type=float, default=None, help="Adafactor first-moment decay (default: no first moment)")
+    parser.add_argument('--compile_bucket_size', type=int, default=64, help="Pad sequence lengths to multiples of this")
+    parser.add_argument('--num_prompt_tokens', type=int, default=20, help="Learned schema prompt length (schema_prompt)")
+    parser.add_argument('--checkpoint', type=str, default=None, help="Weights to benchmark (restricted_vocab, retrieval_draft; default: pretrained/init)")
+    parser.add_argument('--num_draft_tokens', type=int, default=8, help="Draft tokens verified per decoder forward (retrieval_draft)")
+    parser.add_argument('--dropout_rate', type=float, default=0.2, help="Dropout rate of the scratch model (sql_tokenizer)")
+    parser.add_argument('--sql_tokenizer_path', type=str, default="tokenizers/sql_tokenizer.json", help="SQL tokenizer (sql_tokenizer)")
+    parser.add_argument('--trim_vocab_path', type=str, default="tokenizers/trimmed_t5_vocab.json", help="Trimmed t5-small token ids (sql_tokenizer)")
+    parser.add_argument('--batch_sizes', type=str, default="8,16,32", help="Comma-separated batch sizes (checkpointing)")
+    parser.add_argument('--decode_batch_sizes', type=str, default="1,4,16,64", help="Comma-separated batch sizes (static_decoder)")
+    parser.add_argument('--num_beams', type=int, default=1, help="Beam width (static_decoder)")
+    parser.add_argument('--decode_slots', type=int, default=0, help="Greedy rows decoded at a time, 0 = whole batch (static_decoder)")
+    parser.add_argument('--checkpoint_stacks', type=str, default="both", choices=["encoder", "decoder", "both"])
+    parser.add_argument('--checkpoint_every_n_layers', type=int, default=1)
+
+    args = parser.parse_args()
+    return args
+
+def train_step(args, model, optimizer, batch, criterion):
+    encoder_input, encoder_mask, decoder_input, decoder_targets, _ = batch
+    encoder_input, encoder_mask, decoder_input, decoder_targets = bucket_batch(
+        args,
+        encoder_input.to(DEVICE), encoder_mask.to(DEVICE),
+        decoder_input.to(DEVICE), decoder_targets.to(DEVICE),
+    )
+
+    logits = model(
+        input_ids=encoder_input,
+        attention_mask=encoder_mask,
+        decoder_input_ids=decoder_input,
+    ).logits
+    loss = criterion(logits.reshape(-1, logits.size(-1)), decoder_targets.reshape(-1))
+    loss.backward()
+    optimizer.step()
+    optimizer.zero_grad()
+
+def generate_step(args, model, batch):
+    encoder_input, encoder_mask = bucket_batch(args, batch[0].to(DEVICE), batch[1].to(DEVICE))
+    with torch.no_grad():
+        model.generate(
+            input_ids=encoder_input,
+            attention_mask=encoder_mask,
+            max_length=args.max_gen_length,
+        )
+
+def time_steps(step_fn, batches):
+    """Run step_fn once per batch and return the per-step wall times in seconds."""
+    times = []
+    for batch in batches:
+        start = time.perf_counter()
+        step_fn(batch)
+        times.append(time.perf_counter() - start)
+    return times
+
+def time_steady_state(step_fn, batches, num_repeats):
+    """Mean per-step time over num_repeats passes (excluding a warm-up pass)."""
+    time_steps(step_fn, batches)
+    times = []
+    for _ in range(num_repeats):
+        times += time_steps(step_fn, batches)
+    return sum(times) / len(times)
+
+def benchmark_compile(args, train_batches, dev_batches):
+    """Compile time and steady-state speedup of --compile vs eager, for training and generation."""
+    # Both modes see the same bucketed shapes so only compilation differs
+    args.compile = True
+    criterion = nn.CrossEntropyLoss(ignore_index=PAD_IDX, label_smoothing=0.1)
+
+    model = initialize_model(args)
+    optimizer = initialize_optimizer(args, model)
+    train_fn = lambda batch: train_step(args, model, optimizer, batch, criterion)
+    gen_fn = lambda batch: generate_step(args, model, batch)
+
+    print("Timing eager mode...")
+    model.train()
+    eager_train = time_steady_state(train_fn, train_batches, args.num_repeats)
+    model.eval()
+    eager_gen = time_steady_state(gen_fn, dev_batches, args.num_repeats)
+
+    compile_model(model, args)
+
+    print("Timing compiled mode...")
+    model.train()
+    first_train = sum(time_steps(train_fn, train_batches))
+    compiled_train = time_steady_state(train_fn, train_batches, args.num_repeats)
+    model.eval()
+    first_gen = sum(time_steps(gen_fn, dev_batches))
+    compiled_gen = time_steady_state(gen_fn, dev_batches, args.num_repeats)
+
+    train_compile_time = first_train - compiled_train * len(train_batches)
+    gen_compile_time = first_gen - compiled_gen * len(dev_batches)
+
+    print("\n" + "="*80)
+    print(f"COMPILE BENCHMARK ({DEVICE}, bucket size {args.compile_bucket_size})")
+    print("="*80)
+    print(f"{'':<12} {'Compile (s)':>12} {'Eager (ms)':>12} {'Compiled (ms)':>14} {'Speedup':>9}")
+    print(f"{'Train step':<12} {train_compile_time:>12.1f} {eager_train*1000:>12.1f} "
+          f"{compiled_train*1000:>14.1f} {eager_train/compiled_train:>8.2f}x")
+    print(f"{'Generate':<12} {gen_compile_time:>12.1f} {eager_gen*1000:>12.1f} "
+          f"{compiled_gen*1000:>14.1f} {eager_gen/compiled_gen:>8.2f}x")
+    if compiled_train < eager_train:
+        breakeven = train_compile_time / (eager_train - compiled_train)
+        print(f"\nTraining compile time pays off after ~{breakeven:.0f} steps")
+    print("="*80 + "\n")
+
+def detailed_eval_step(args, model, batch, criterion, reuse_encoder):
+    """Loss + greedy generation on one dev batch, as in eval_epoch."""
+    encoder_input, encoder_mask, decoder_input, decoder_targets, _ = batch
+    encoder_input, encoder_mask = encoder_input.to(DEVICE), encoder_mask.to(DEVICE)
+    decoder_input, decoder_targets = decoder_input.to(DEVICE), decoder_targets.to(DEVICE)
+
+    with torch.no_grad():
+        if reuse_encoder:
+            encoder_outputs = model.get_encoder()(input_ids=encoder_input, attention_mask=encoder_mask, return_dict=True)
+            encoder_kwargs = {'encoder_outputs': encoder_outputs}
+        else:
+            encoder_kwargs = {'input_ids': encoder_input}
+        logits = model(attention_mask=encoder_mask, decoder_input_ids=decoder_input, **encoder_kwargs).logits
+        criterion(logits.reshape(-1, logits.size(-1)), decoder_targets.reshape(-1))
+        model.generate(attention_mask=encoder_mask, max_length=args.max_gen_length, **encoder_kwargs)
+
+def benchmark_eval_encoder_reuse(args, dev_batches):
+    """Detailed-eval time with a separate encoder pass for generation vs one shared encoder pass."""
+    args.compile = False
+    criterion = nn.CrossEntropyLoss(ignore_index=PAD_IDX, label_smoothing=0.1)
+    model = initialize_model(args)
+    model.eval()
+
+    separate = time_steady_state(lambda batch: detailed_eval_step(args, model, batch, criterion, False),
+                                 dev_batches, args.num_repeats)
+    shared = time_steady_state(lambda batch: detailed_eval_step(args, model, batch, criterion, True),
+                               dev_batches, args.num_repeats)
+
+    print("\n" + "="*80)
+    print(f"DETAILED EVAL ENCODER REUSE ({DEVICE}, schema={args.use_schema}, max_gen_length={args.max_gen_length})")
+    print("="*80)
+    print(f"Encoder run twice (loss + generate): {separate*1000:.1f} ms/batch")
+    print(f"Encoder run once (shared outputs):   {shared*1000:.1f} ms/batch")
+    print(f"Reduction: {100 * (separate - shared) / separate:.1f}%")
+    print("="*80 + "\n")
+
+def benchmark_optimizer(args, train_batches):
+    """Optimizer-state memory and training step time for AdamW vs Adafactor."""
+    args.compile = False
+    criterion = nn.CrossEntropyLoss(ignore_index=PAD_IDX, label_smoothing=0.1)
+
+    rows = []
+    for optimizer_name in ('adamw', 'adafactor'):
+        print(f"\nTiming {optimizer_name}...")
+        args.optimizer = optimizer_name
+        torch.manual_seed(0)
+        model = initialize_model(args)
+        optimizer = initialize_optimizer(args, model)
+        model.train()
+
+        step_time = time_steady_state(lambda batch: train_step(args, model, optimizer, batch, criterion),
+                                      train_batches, args.num_repeats)
+        param_bytes = sum(p.numel() * p.element_size() for p in model.parameters() if p.requires_grad)
+        rows.append((optimizer_name, optimizer_state_bytes(optimizer), param_bytes, step_time))
+
+    print("\n" + "="*80)
+    print(f"OPTIMIZER BENCHMARK ({DEVICE}, batch size {args.batch_size}, adafactor beta1={args.adafactor_beta1})")
+    print("="*80)
+    print(f"{'Optimizer':<10} {'State (MB)':>11} {'State/params':>13} {'Step (ms)':>10}")
+    for optimizer_name, state_bytes, param_bytes, step_time in rows:
+        print(f"{optimizer_name:<10} {state_bytes/1024**2:>11.1f} {state_bytes/param_bytes:>12.2f}x {step_time*1000:>10.1f}")
+    print("="*80 + "\n")
+
+def benchmark_sql_tokenizer(args):
+    """Sequence lengths, vocabulary size and scratch training throughput: t5-small (full or trimmed) vs SQL tokenizer."""
+    args.compile = False
+    criterion = nn.CrossEntropyLoss(ignore_index=PAD_IDX, label_smoothing=0.1)
+    nl_queries = load_lines('data/train.nl')
+    sql_queries = load_lines('data/train.sql')
+    t5_tokenizer = T5TokenizerFast.from_pretrained('google-t5/t5-small')
+    tokenizers = {
+        't5-small': t5_tokenizer,
+        't5-trimmed': TrimmedTokenizer.load_or_build(args.trim_vocab_path, t5_tokenizer),
+        'sql': SQLTokenizer.load_or_train(args.sql_tokenizer_path),
+    }
+
+    rows = []
+    for name, tokenizer in tokenizers.items():
+        print(f"\nTokenizer {name}...")
+        # Same formats as the scratch dataset (schema prefix excluded: it is a constant offset)
+        input_lengths = [len(tokenizer.encode(f"Question: {nl} Answer: ")) for nl in nl_queries]
+        target_lengths = [len(tokenizer.encode(f"{sql} END")) for sql in sql_queries]
+
+        args.vocab_size = len(tokenizer)
+        torch.manual_seed(0)
+        train_loader = get_dataloader_scratch(args.batch_size, "train", args.use_schema, args.use_preprocessed,
+                                              tokenizer=tokenizer)
+        batches = list(islice(train_loader, args.num_batches))
+        model = initialize_model_scratch(args)
+        optimizer = initialize_optimizer(args, model)
+        model.train()
+        step_time = time_steady_state(lambda batch: train_step(args, model, optimizer, batch, criterion),
+                                      batches, args.num_repeats)
+        embedding_params = model.shared.weight.numel() + model.lm_head.weight.numel()
+        total_params = sum(p.numel() for p in model.parameters())
+        rows.append((name, len(tokenizer), embedding_params, total_params, np.mean(input_lengths),
+                     np.mean(target_lengths), np.percentile(target_lengths, 95), step_time))
+
+    print("\n" + "="*80)
+    print(f"SQL TOKENIZER BENCHMARK ({DEVICE}, batch size {args.batch_size}, schema={args.use_schema})")
+    print("="*80)
+    print(f"{'Tokenizer':<11} {'Vocab':>7} {'Emb+head':>11} {'Params':>11} {'NL len':>7} {'SQL len':>8} {'SQL p95':>8} "
+          f"{'Step (ms)':>10} {'Examples/s':>11}")
+    for name, vocab_size, embedding_params, total_params, input_len, target_len, target_p95, step_time in rows:
+        print(f"{name:<11} {vocab_size:>7} {embedding_params:>11,} {total_params:>11,} {input_len:>7.1f} {target_len:>8.1f} "
+              f"{target_p95:>8.0f} {step_time*1000:>10.1f} {args.batch_size/step_time:>11.1f}")
+    base = rows[0]
+    for row in rows[1:]:
+        # AdamW keeps two moments per parameter, so optimizer state shrinks with the parameter count
+        print(f"\n{row[0]} vs {base[0]}: parameters (and optimizer state) -{100 * (1 - row[3] / base[3]):.1f}%, "
+              f"SQL length -{100 * (1 - row[5] / base[5]):.1f}%, NL length -{100 * (1 - row[4] / base[4]):.1f}%, "
+              f"training speedup {base[7] / row[7]:.2f}x")
+    print("="*80 + "\n")
+
+def generate_fixed_length_step(args, model, batch):
+    """Greedy decode exactly as many tokens as the batch's longest gold target."""
+    encoder_input, encoder_mask = bucket_batch(args, batch[0].to(DEVICE), batch[1].to(DEVICE))
+    num_tokens = int((batch[3] != PAD_IDX).sum(dim=1).max())
+    with torch.no_grad():
+        model.generate(
+            input_ids=encoder_input,
+            attention_mask=encoder_mask,
+            min_new_tokens=num_tokens,
+            max_new_tokens=num_tokens,
+        )
+
+def benchmark_sql_compression(args):
+    """Gold decode lengths and the greedy decoding time they imply: full vs compact SQL targets."""
+    args.compile = False
+    model = initialize_model(args)
+    model.eval()
+
+    rows = []
+    for compress_targets in (False, True):
+        dev_loader = get_dataloader(args.test_batch_size, "dev", args.use_schema, args.use_preprocessed,
+                                    compress_targets=compress_targets)
+        lengths = torch.cat([(batch[3] != PAD_IDX).sum(dim=1) for batch in dev_loader]).float()
+        # An untrained model emits EOS at random, so decode the gold length of each batch instead
+        dev_batches = list(islice(dev_loader, args.num_batches))
+        step_time = time_steady_state(lambda batch: generate_fixed_length_step(args, model, batch),
+                                      dev_batches, args.num_repeats)
+        rows.append(("compact" if compress_targets else "full", lengths.mean().item(),
+                     torch.quantile(lengths, 0.95).item(), lengths.max().item(), step_time))
+
+    print("\n" + "="*80)
+    print(f"SQL TARGET COMPRESSION ({DEVICE}, batch size {args.test_batch_size}, schema={args.use_schema})")
+    print("="*80)
+    print(f"{'Targets':<8} {'Mean len':>9} {'p95 len':>8} {'Max len':>8} {'Decode (ms/batch)':>18}")
+    for name, mean_length, p95_length, max_length, step_time in rows:
+        print(f"{name:<8} {mean_length:>9.1f} {p95_length:>8.0f} {max_length:>8.0f} {step_time*1000:>18.1f}")
+    full, compact = rows
+    print(f"\nDecode length reduction: {100 * (1 - compact[1] / full[1]):.1f}%, "
+          f"decoding speedup: {full[4] / compact[4]:.2f}x")
+    print(f"Compact max length {compact[3]:.0f}: --max_gen_length can shrink accordingly with --compress_sql")
+    print("="*80 + "\n")
+
+def benchmark_restricted_vocab(args, dev_batches):
+    """Per-token greedy decoding time with the full LM head vs one restricted to train SQL token ids."""
+    args.compile = False
+    tokenizer = T5TokenizerFast.from_pretrained('google-t5/t5-small')
+    model = initialize_model(args)
+    if args.checkpoint:
+        load_model_weights(model, args.checkpoint)
+        merge_lora(model)
+    model.eval()
+
+    token_ids = output_vocab_ids(tokenizer, load_lines('data/train.sql'))
+    restricted = restrict_output_vocab(copy.deepcopy(model), token_ids, tokenizer.unk_token_id)
+
+    # Dev gold queries the restricted head can still produce exactly
+    allowed = set(token_ids.tolist())
+    dev_ids = tokenizer(load_lines('data/dev.sql'))['input_ids']
+    covered_queries = sum(all(i in allowed for i in ids) for ids in dev_ids)
+    covered_tokens = sum(i in allowed for ids in dev_ids for i in ids)
+    num_tokens = sum(len(ids) for ids in dev_ids)
+
+    # generate_fixed_length_step decodes each batch's longest gold target
+    tokens_per_batch = sum(int((batch[3] != PAD_IDX).sum(dim=1).max()) for batch in dev_batches) / len(dev_batches)
+    rows = []
+    for name, head_model in (('full', model), ('restricted', restricted)):
+        step_time = time_steady_state(lambda batch: generate_fixed_length_step(args, head_model, batch),
+                                      dev_batches, args.num_repeats)
+        rows.append((name, head_model.lm_head.weight.size(0), head_model.lm_head.weight.numel(), step_time))
+
+    print("\n" + "="*80)
+    print(f"RESTRICTED OUTPUT VOCABULARY ({DEVICE}, batch size {args.test_batch_size}, {tokens_per_batch:.0f} tokens/batch)")
+    print("="*80)
+    print(f"{'LM head':<11} {'Vocab':>7} {'Head params':>12} {'ms/batch':>9} {'ms/token':>9}")
+    for name, vocab_size, head_params, step_time in rows:
+        print(f"{name:<11} {vocab_size:>7} {head_params:>12,} {step_time*1000:>9.1f} {step_time*1000/tokens_per_batch:>9.2f}")
+    full, restricted_row = rows
+    print(f"\nPer-token decoding speedup: {full[3] / restricted_row[3]:.2f}x")
+    status = "✓" if covered_queries == len(dev_ids) else "⚠"
+    print(f"{status} Dev gold SQL reachable: {covered_queries}/{len(dev_ids)} queries, "
+          f"{100 * covered_tokens / num_tokens:.2f}% of tokens")
+    print("Dev F1 change: train_t5.py --restrict_vocab evaluates both heads (see --restrict_vocab_tolerance)")
+    print("="*80 + "\n")
+
+def benchmark_schema_prompt(args):
+    """Encoder length, training and generation time: schema text vs learned schema prompt vs no schema."""
+    args.compile = False
+    criterion = nn.CrossEntropyLoss(ignore_index=PAD_IDX, label_smoothing=0.1)
+    prompt_tokens = args.num_prompt_tokens
+
+    rows = []
+    for name, use_schema, schema_prompt_tokens in (('schema', True, 0), ('prompt', True, prompt_tokens), ('no_schema', False, 0)):
+        print(f"\nTiming {name}...")
+        args.schema_prompt_tokens = schema_prompt_tokens  # read by initialize_model
+        train_loader = get_dataloader(args.batch_size, "train", use_schema, args.use_preprocessed,
+                                      schema_prompt_tokens=schema_prompt_tokens)
+        dev_loader = get_dataloader(args.test_batch_size, "dev", use_schema, args.use_preprocessed,
+                                    schema_prompt_tokens=schema_prompt_tokens)
+        train_batches = list(islice(train_loader, args.num_batches))
+        dev_batches = list(islice(dev_loader, args.num_batches))
+        encoder_length = torch.cat([batch[1].sum(dim=1) for batch in train_batches]).float().mean().item()
+
+        torch.manual_seed(0)
+        model = initialize_model(args)
+        optimizer = initialize_optimizer(args, model)
+        model.train()
+        train_time = time_steady_state(lambda batch: train_step(args, model, optimizer, batch, criterion),
+                                       train_batches, args.num_repeats)
+        model.eval()
+        generate_time = time_steady_state(lambda batch: generate_step(args, model, batch), dev_batches, args.num_repeats)
+        rows.append((name, encoder_length, train_time, generate_time))
+
+    print("\n" + "="*80)
+    print(f"SCHEMA PROMPT BENCHMARK ({DEVICE}, {prompt_tokens} prompt tokens, max_gen_length={args.max_gen_length})")
+    print("="*80)
+    print(f"{'Input':<10} {'Encoder len':>12} {'Train (ms/step)':>16} {'Examples/s':>11} {'Generate (ms/batch)':>20}")
+    for name, encoder_length, train_time, generate_time in rows:
+        print(f"{name:<10} {encoder_length:>12.1f} {train_time*1000:>16.1f} {args.batch_size/train_time:>11.1f} "
+              f"{generate_time*1000:>20.1f}")
+    schema, prompt, _ = rows
+    print(f"\nPrompt vs schema text: encoder length -{100 * (1 - prompt[1] / schema[1]):.1f}%, "
+          f"training {schema[2] / prompt[2]:.2f}x, generation {schema[3] / prompt[3]:.2f}x")
+    print("Dev F1: train with --use_schema, --schema_prompt_tokens N and --no_schema, then run evaluate_all_dev.py")
+    print("="*80 + "\n")
+
+def benchmark_retrieval_draft(args, dev_batches):
+    """Greedy generate vs speculative decoding with the nearest train template's SQL as draft."""
+    args.compile = False
+    tokenizer = T5TokenizerFast.from_pretrained('google-t5/t5-small')
+    model = initialize_model(args)
+    if args.checkpoint:
+        load_model_weights(model, args.checkpoint)
+        merge_lora(model)
+    model.eval()
+
+    # The dev loader is sequential, so batch k holds dev questions k * batch_size, ...
+    matcher = TemplateMatcher.from_data('data')
+    questions, gold_queries = load_lines('data/dev.nl'), load_lines('data/dev.sql')
+    batch_drafts, start = [], 0
+    for batch in dev_batches:
+        drafts = [matcher.draft(question) for question in questions[start:start + batch[0].size(0)]]
+        batch_drafts.append(drafts)
+        start += len(drafts)
+    num_questions = start
+    exact_drafts = sum(draft == gold for drafts in batch_drafts for draft, gold in zip(drafts, gold_queries))
+    draft_ids = [tokenizer(drafts)['input_ids'] for drafts in batch_drafts]
+
+    outputs, stats = {}, {}
+    def greedy_step(k):
+        with torch.no_grad():
+            outputs[('greedy', k)] = model.generate(input_ids=dev_batches[k][0].to(DEVICE), attention_mask=dev_batches[k][1].to(DEVICE),
+                                                    max_length=args.max_gen_length)
+    def speculative_step(k):
+        encoder_input, encoder_mask = dev_batches[k][0].to(DEVICE), dev_batches[k][1].to(DEVICE)
+        with torch.no_grad():
+            outputs[('speculative', k)] = speculative_generate(model, get_encoder_outputs(model, encoder_input, encoder_mask),
+                                                               encoder_mask, draft_ids[k], args.max_gen_length,
+                                                               args.num_draft_tokens, stats=stats)
+    batch_ids = list(range(len(dev_batches)))
+    greedy_time = time_steady_state(greedy_step, batch_ids, args.num_repeats)
+    speculative_time = time_steady_state(speculative_step, batch_ids, args.num_repeats)
+
+    def decoded(name, k):
+        return tokenizer.batch_decode(outputs[(name, k)], skip_special_tokens=True)
+    same = sum(a == b for k in batch_ids for a, b in zip(decoded('greedy', k), decoded('speculative', k)))
+    generated = sum(int((outputs[('greedy', k)][:, 1:] != PAD_IDX).sum()) for k in batch_ids)
+
+    print("\n" + "="*80)
+    print(f"RETRIEVAL-DRAFT SPECULATIVE DECODING ({DEVICE}, {num_questions} dev questions, "
+          f"{args.num_draft_tokens} draft tokens)")
+    print("="*80)
+    print(f"Drafts equal to the gold SQL: {exact_drafts}/{num_questions}")
+    print(f"{'Decoding':<12} {'ms/question':>12} {'Tokens/forward':>15}")
+    print(f"{'greedy':<12} {greedy_time*1000*len(dev_batches)/num_questions:>12.1f} {1.0:>15.2f}")
+    print(f"{'speculative':<12} {speculative_time*1000*len(dev_batches)/num_questions:>12.1f} "
+          f"{stats['tokens'] / stats['forwards']:>15.2f}")
+    print(f"\nSpeedup: {greedy_time / speculative_time:.2f}x ({generated / num_questions:.1f} tokens/question)")
+    status = "✓" if same == num_questions else "⚠"
+    print(f"{status} Identical outputs: {same}/{num_questions}")
+    if not args.checkpoint:
+        print("⚠ No --checkpoint: an untrained model does not follow the drafts, so expect ~1 token/forward")
+    print("="*80 + "\n")
+
+def benchmark_static_decoder(args):
+    """model.generate vs StaticCacheDecoder (preallocated KV cache) per batch size."""
+    args.compile = False
+    model = initialize_model(args)
+    if args.checkpoint:
+        load_model_weights(model, args.checkpoint)
+        merge_lora(model)
+    model.eval()
+    decoder = StaticCacheDecoder(model, args.max_gen_length)
+    generate_kwargs = {'max_length': args.max_gen_length}
+    static_kwargs = {'num_slots': args.decode_slots}
+    if args.num_beams > 1:
+        generate_kwargs.update(num_beams=args.num_beams, early_stopping=True)
+        static_kwargs = {}
+
+    rows = []
+    for batch_size in [int(size) for size in args.decode_batch_sizes.split(',')]:
+        print(f"\nTiming batch size {batch_size}...")
+        dev_loader = get_dataloader(batch_size, "dev", args.use_schema, args.use_preprocessed)
+        dev_batches = list(islice(dev_loader, args.num_batches))
+        outputs = {}
+        def decode_step(name, generator, k, **kwargs):
+            with torch.no_grad():
+                outputs[(name, k)] = generator.generate(input_ids=dev_batches[k][0].to(DEVICE),
+                                                        attention_mask=dev_batches[k][1].to(DEVICE),
+                                                        **generate_kwargs, **kwargs)
+        batch_ids = list(range(len(dev_batches)))
+        generate_time = time_steady_state(lambda k: decode_step('generate', model, k), batch_ids, args.num_repeats)
+        decoder.row_steps = decoder.padded_row_steps = 0
+        static_time = time_steady_state(lambda k: decode_step('static', decoder, k, **static_kwargs), batch_ids, args.num_repeats)
+        same = sum(torch.equal(outputs[('generate', k)], outputs[('static', k)]) for k in batch_ids)
+        tokens = sum(outputs[('generate', k)].numel() for k in batch_ids) / len(batch_ids)
+        saved = 1 - decoder.row_steps / decoder.padded_row_steps if decoder.padded_row_steps else 0.0
+        rows.append((batch_size, tokens, generate_time, static_time, saved, same, len(batch_ids)))
+
+    print("\n" + "="*80)
+    print(f"STATIC KV-CACHE DECODER ({DEVICE}, num_beams={args.num_beams}, max_gen_length={args.max_gen_length}, "
+          f"decode_slots={args.decode_slots or 'batch'})")
+    print("="*80)
+    print(f"{'Batch':>6} {'Tokens/batch':>13} {'generate (ms)':>14} {'static (ms)':>12} {'Speedup':>8} "
+          f"{'Row-steps saved':>16} {'Identical':>10}")
+    for batch_size, tokens, generate_time, static_time, saved, same, num_batches in rows:
+        print(f"{batch_size:>6} {tokens:>13.0f} {generate_time*1000:>14.1f} {static_time*1000:>12.1f} "
+              f"{generate_time / static_time:>7.2f}x {100 * saved:>15.1f}% {same:>5}/{num_batches}")
+    print("\nRow-steps saved: greedy decoder steps skipped by dropping finished rows (and refilling with --decode_slots)")
+    status = "✓" if all(row[5] == row[6] for row in rows) else "⚠"
+    print(f"{status} Outputs identical to model.generate in {sum(row[5] for row in rows)}/{sum(row[6] for row in rows)} batches")
+    print("="*80 + "\n")
+
+def peak_memory_mb():
+    """Peak memory of this process: allocator peak on CUDA, max RSS on CPU."""
+    if DEVICE.type == 'cuda':
+        return torch.cuda.max_memory_allocated() / (1024**2)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def checkpointing_trial(args, batch_size, checkpointing, results):
+    """Runs in a fresh process so peak memory is not polluted by other configurations."""
+    torch.manual_seed(0)
+    args.compile = False
+    criterion = nn.CrossEntropyLoss(ignore_index=PAD_IDX, label_smoothing=0.1)
+
+    train_loader, _, _ = load_t5_data(batch_size, batch_size, use_schema=args.use_schema,
+                                      use_preprocessed=args.use_preprocessed)
+    batches = list(islice(train_loader, args.num_batches))
+
+    model = initialize_model(args)
+    if checkpointing:
+        enable_gradient_checkpointing(model, args.checkpoint_stacks, args.checkpoint_every_n_layers)
+    optimizer = initialize_optimizer(args, model)
+    model.train()
+
+    step_time = time_steady_state(lambda batch: train_step(args, model, optimizer, batch, criterion),
+                                  batches, args.num_repeats)
+    results.put((step_time, peak_memory_mb()))
+
+def benchmark_checkpointing(args):
+    """Peak memory and training throughput with and without gradient checkpointing."""
+    ctx = mp.get_context('spawn')
+    rows = []
+    for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+        for checkpointing in (False, True):
+            print(f"\nBatch size {batch_size}, checkpointing={checkpointing}...")
+            results = ctx.Queue()
+            proc = ctx.Process(target=checkpointing_trial, args=(args, batch_size, checkpointing, results))
+            proc.start()
+            step_time, peak_mb = results.get()
+            proc.join()
+            rows.append((batch_size, checkpointing, step_time, peak_mb))
+
+    print("\n" + "="*80)
+    print(f"GRADIENT CHECKPOINTING BENCHMARK ({DEVICE}, stacks={args.checkpoint_stacks}, "
+          f"every {args.checkpoint_every_n_layers} layer(s))")
+    print("="*80)
+    print(f"{'Batch':>6} {'Checkpointing':>14} {'Step (ms)':>10} {'Examples/s':>11} {'Peak mem (MB)':>14}")
+    for batch_size, checkpointing, step_time, peak_mb in rows:
+        print(f"{batch_size:>6} {str(checkpointing):>14} {step_time*1000:>10.1f} "
+              f"{batch_size/step_time:>11.1f} {peak_mb:>14.1f}")
+    print("="*80 + "\n")
+
+def main():
+    args = get_args()
+    torch.manual_seed(0)
+
+    if args.benchmark == 'checkpointing':
+        benchmark_checkpointing(args)
+        return
+    if args.benchmark == 'sql_tokenizer':
+        benchmark_sql_tokenizer(args)
+        return
+    if args.benchmark == 'sql_compression':
+        benchmark_sql_compression(args)
+        return
+    if args.benchmark == 'schema_prompt':
+        benchmark_schema_prompt(args)
+        return
+    if args.benchmark == 'static_decoder':
+        benchmark_static_decoder(args)
+        return
+
+    train_loader, dev_loader, _ = load_t5_data(
+        args.batch_size, args.test_batch_size,
+        use_schema=args.use_schema,
+        use_preprocessed=args.use_preprocessed
+    )
+    train_batches = list(islice(train_loader, args.num_batches))
+    dev_batches = list(islice(dev_loader, args.num_batches))
+
+    if args.benchmark == 'compile':
+        benchmark_compile(args, train_batches, dev_batches)
+    elif args.benchmark == 'eval_encoder_reuse':
+        benchmark_eval_encoder_reuse(args, dev_batches)
+    elif args.benchmark == 'optimizer':
+        benchmark_optimizer(args, train_batches)
+    elif args.benchmark == 'restricted_vocab':
+        benchmark_restricted_vocab(args, dev_batches)
+    elif args.benchmark == 'retrieval_draft':
+        benchmark_retrieval_draft(args, dev_batches)
+
+if __name__ == "__main__":
+    main()
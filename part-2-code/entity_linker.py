@@ -0,0 +1,169 @@
+"""
+Entity linking for NL questions with an Aho-Corasick multi-pattern matcher.
+
+Questions name airports, airlines and cities in full ("general mitchell international
+airport") while the SQL uses codes or database spellings ('MKE'). EntityLinker compiles
+every known surface form into one automaton and rewrites the matched spans in a single
+pass over the question, so the cost is linear in its length whatever the number of
+patterns. Surface forms come from data/alignment.txt and, when the database is present,
+airport/airline/city names from data/flight_database.db.
+
+    replace:   "flights into general mitchell international airport" -> "flights into mke"
+    annotate:  "... general mitchell international airport (mke)"
+
+Matches must start and end at word boundaries; overlapping matches are resolved
+leftmost-longest. Run as a script to report how many spans are linked per split.
+"""
+
+import os
+import re
+import sqlite3
+from collections import deque
+
+WORD_CHAR = re.compile(r"[a-z0-9]")
+
+# Database surface forms: (query for (name, value) rows, suffix questions may add to a name)
+DATABASE_ENTITIES = [
+    ("SELECT DISTINCT airport_name, airport_code FROM airport", " airport"),
+    ("SELECT DISTINCT airline_name, airline_code FROM airline", " airlines"),
+    ("SELECT DISTINCT city_name, city_name FROM city", None),
+]
+
+class AhoCorasick:
+    '''
+    Automaton over the characters of a {pattern: value} dict. find(text) returns every
+    (start, end, value) occurrence in one pass over text.
+    '''
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]  # per state: (pattern length, value) of patterns ending here
+        for pattern, value in patterns.items():
+            state = 0
+            for char in pattern:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.output[state].append((len(pattern), value))
+
+        # Breadth-first failure links; outputs of the failure state are inherited
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def find(self, text):
+        matches = []
+        state = 0
+        for end, char in enumerate(text, start=1):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            for length, value in self.output[state]:
+                matches.append((end - length, end, value))
+        return matches
+
+class EntityLinker:
+
+    def __init__(self, entities, mode='replace'):
+        '''
+        entities: {surface form: linked value}, matched case-insensitively.
+        mode: 'replace' the span with its value, or 'annotate' it as "span (value)".
+        '''
+        if mode not in ('replace', 'annotate'):
+            raise ValueError(f"Unknown entity linking mode: {mode}")
+        self.mode = mode
+        self.entities = {form.lower(): value.lower() for form, value in entities.items() if form.strip()}
+        self.matcher = AhoCorasick(self.entities)
+
+    @classmethod
+    def from_data(cls, data_folder='data', mode='replace', db_path=None):
+        entities = {}
+        db_path = db_path or os.path.join(data_folder, 'flight_database.db')
+        if os.path.exists(db_path):
+            conn = sqlite3.connect(db_path)
+            for query, suffix in DATABASE_ENTITIES:
+                for name, value in conn.execute(query).fetchall():
+                    if name and value:
+                        entities[name.strip()] = value.strip()
+                        # "general mitchell international" is also asked about as "... airport"
+                        if suffix and not name.lower().endswith(suffix):
+                            entities[name.strip() + suffix] = value.strip()
+            conn.close()
+        else:
+            print(f"⚠ {db_path} not found: linking alignment.txt entities only")
+
+        # Curated alignments take precedence over database names
+        alignment_path = os.path.join(data_folder, 'alignment.txt')
+        with open(alignment_path, 'r') as f:
+            for line in f:
+                if '\t' in line:
+                    phrase, value = line.rstrip('\n').split('\t', 1)
+                    entities[phrase] = value
+        return cls(entities, mode)
+
+    def spans(self, text):
+        '''
+        Non-overlapping (start, end, value) entity spans of lowercase text,
+        leftmost-longest, at word boundaries.
+        '''
+        matches = [
+            (start, end, value) for start, end, value in self.matcher.find(text)
+            if (start == 0 or not WORD_CHAR.match(text[start - 1]))
+            and (end == len(text) or not WORD_CHAR.match(text[end]))
+        ]
+        matches.sort(key=lambda match: (match[0], -match[1]))
+        spans = []
+        for match in matches:
+            if not spans or match[0] >= spans[-1][1]:
+                spans.append(match)
+        return spans
+
+    def link(self, text):
+        lowered = text.lower()
+        pieces = []
+        position = 0
+        for start, end, value in self.spans(lowered):
+            pieces.append(text[position:start])
+            span = text[start:end]
+            if self.mode == 'annotate':
+                pieces.append(span if span.lower() == value else f"{span} ({value})")
+            else:
+                pieces.append(value)
+            position = end
+        pieces.append(text[position:])
+        return "".join(pieces)
+
+    __call__ = link
+
+if __name__ == "__main__":
+    import time
+
+    linker = EntityLinker.from_data('data')
+    print("\n" + "="*80)
+    print(f"ENTITY LINKING ({len(linker.entities)} surface forms, "
+          f"{len(linker.matcher.goto)} automaton states)")
+    print("="*80)
+    for split in ('train', 'dev', 'test'):
+        with open(os.path.join('data', f'{split}.nl'), 'r') as f:
+            nl_queries = [line.strip() for line in f.readlines()]
+        start = time.perf_counter()
+        linked = [linker.link(nl_query) for nl_query in nl_queries]
+        elapsed = time.perf_counter() - start
+        num_spans = sum(len(linker.spans(nl_query.lower())) for nl_query in nl_queries)
+        changed = sum(a != b for a, b in zip(nl_queries, linked))
+        chars = sum(len(q) for q in nl_queries)
+        linked_chars = sum(len(q) for q in linked)
+        print(f"{split:<6} {num_spans:>5} spans in {changed}/{len(nl_queries)} questions, "
+              f"characters {chars / len(nl_queries):.1f} -> {linked_chars / len(nl_queries):.1f}, "
+              f"{1e6 * elapsed / len(nl_queries):.0f} us/question")
+    print("="*80 + "\n")
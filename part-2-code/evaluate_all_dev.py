@@ -145,7 +145,7 @@ def main():
     print(f"Errors: {best_overall['num_errors']} ({best_overall['error_rate']:.1f}%)")
     
     # Determine checkpoint path
-    checkpoint_path = f"checkpoints/t5_ft/{best_overall['exp_name']}/best_model.pt"
+    checkpoint_path = f"checkpoints/t5_ft/{best_overall['exp_name']}/best_model.safetensors"
     
     print("\n" + "="*100)
     print("📋 NEXT STEPS")
@@ -168,7 +168,7 @@ def main():
     for i, result in enumerate(results_sorted[:3], 1):
         print(f"\n{i}. {result['exp_name']} (epoch {result['epoch']})")
         print(f"   F1: {result['record_f1']:.4f}, EM: {result['record_em']:.4f}, Errors: {result['num_errors']}")
-        print(f"   Checkpoint: checkpoints/t5_ft/{result['exp_name']}/best_model.pt")
+        print(f"   Checkpoint: checkpoints/t5_ft/{result['exp_name']}/best_model.safetensors")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
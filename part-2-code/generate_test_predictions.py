@@ -10,6 +10,8 @@ from tqdm import tqdm
 import argparse
 import os
 
+from t5_utils import load_model_weights, merge_lora
+
 class SQLDataset(Dataset):
     """Dataset for text-to-SQL generation"""
     def __init__(self, nl_file, tokenizer, max_length=512):
@@ -77,7 +79,7 @@ def generate_predictions(model, dataloader, tokenizer, device, output_file):
 def main():
     parser = argparse.ArgumentParser(description='Generate test predictions')
     parser.add_argument('--checkpoint', type=str, required=True,
-                       help='Path to model checkpoint (e.g., checkpoints/t5_ft_higherlr_cosine_batch32_40ep_epoch35.pkl)')
+                       help='Path to model checkpoint (e.g., checkpoints/t5_ft/t5_ft_higherlr_cosine_batch32_40ep/best_model.safetensors)')
     parser.add_argument('--test_file', type=str, default='data/test.nl',
                        help='Path to test natural language queries')
     parser.add_argument('--output', type=str, required=True,
@@ -120,8 +122,8 @@ def main():
     
     # Load checkpoint
     print(f"Loading checkpoint from {args.checkpoint}...")
-    checkpoint = torch.load(args.checkpoint, map_location=args.device)
-    model.load_state_dict(checkpoint)
+    load_model_weights(model, args.checkpoint, args.device)
+    merge_lora(model)  # adapter-only checkpoints run as a plain T5
     
     model = model.to(args.device)
     print(f"Model loaded on {args.device}\n")
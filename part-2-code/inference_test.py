@@ -4,13 +4,22 @@ Generate test predictions (both .sql and .pkl) using trained model
 """
 
 import os
+import time
 import argparse
 import torch
 from tqdm import tqdm
-from transformers import T5ForConditionalGeneration, T5TokenizerFast
+from transformers import T5ForConditionalGeneration, T5TokenizerFast, LogitsProcessorList
 
-from load_data import get_dataloader
+from load_data import get_dataloader, load_lines
+from t5_utils import compile_model, bucket_batch, load_model_weights, merge_lora
+from t5_utils import output_vocab_ids, restrict_output_vocab, from_output_vocab, GenerationCache
+from t5_utils import get_encoder_outputs, speculative_generate
 from utils import save_queries_and_records
+from sql_compression import compress_sql, expand_sql
+from sql_templates import TemplateMatcher
+from static_decoder import StaticCacheDecoder
+from length_predictor import LengthPredictor, length_grouped_batches
+from sql_grammar import SQLGrammar
 
 DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
@@ -18,27 +27,72 @@ def get_args():
     parser = argparse.ArgumentParser(description='Generate test predictions')
     
     parser.add_argument('--checkpoint', type=str, required=True,
-                       help='Path to model checkpoint (e.g., checkpoints/t5_ft/exp_name/best_model.pt)')
+                       help='Path to model checkpoint (e.g., checkpoints/t5_ft/exp_name/best_model.safetensors)')
     parser.add_argument('--experiment_name', type=str, required=True,
                        help='Experiment name for output files')
     parser.add_argument('--use_schema', action='store_true', default=True,
                        help='Use schema context (should match training)')
     parser.add_argument('--use_preprocessed', action='store_true', default=True,
                        help='Use preprocessed data (should match training)')
+    parser.add_argument('--entity_linking', type=str, default=None, choices=["replace", "annotate"],
+                       help='Entity linking mode (should match training)')
+    parser.add_argument('--anonymize_literals', action='store_true',
+                       help='Literal anonymization (should match training)')
+    parser.add_argument('--schema_token_budget', type=int, default=0,
+                       help='Question-conditioned schema token budget (should match training)')
+    parser.add_argument('--schema_prompt_tokens', type=int, default=0,
+                       help='Learned schema prompt length (should match training)')
     parser.add_argument('--batch_size', type=int, default=16,
                        help='Batch size for inference')
     parser.add_argument('--max_gen_length', type=int, default=512,
                        help='Max generation length')
     parser.add_argument('--num_beams', type=int, default=1,
                        help='Number of beams for beam search')
+    parser.add_argument('--template_threshold', type=float, default=0.0,
+                       help='Answer questions whose SQL template is matched with this confidence without decoding (0 = off, e.g. 0.9)')
+    parser.add_argument('--static_decoder', action='store_true',
+                       help='Decode with the preallocated-KV-cache decoder (static_decoder) instead of model.generate')
+    parser.add_argument('--constrained_decoding', action='store_true',
+                       help='Mask tokens that cannot continue a valid SQL query over the schema tables / columns (sql_grammar)')
+    parser.add_argument('--length_margin', type=float, default=0.0,
+                       help="Cap each question's generation at this margin times its predicted length (length_predictor; 0 = off, e.g. 1.5)")
+    parser.add_argument('--decode_slots', type=int, default=0,
+                       help='Greedy --static_decoder: decode at most this many rows at a time, refilling the slots of finished rows from the rest of the batch (0 = whole batch)')
+    parser.add_argument('--retrieval_draft', action='store_true',
+                       help="Greedy decoding that verifies the nearest train template's SQL as draft tokens (same output, fewer decoder forwards)")
+    parser.add_argument('--num_draft_tokens', type=int, default=8,
+                       help='Draft tokens verified per decoder forward (--retrieval_draft)')
+    parser.add_argument('--compress_sql', action='store_true',
+                       help='Model was trained on compact SQL targets (should match training)')
+    parser.add_argument('--restrict_vocab', action='store_true',
+                       help='Restrict the LM head to token ids seen in train SQL (check dev F1 with train_t5.py first)')
+    parser.add_argument('--compile', action='store_true',
+                       help='Compile the model forward with torch.compile')
+    parser.add_argument('--compile_bucket_size', type=int, default=64,
+                       help='Pad sequence lengths to multiples of this when compiling')
     
     args = parser.parse_args()
+    if args.retrieval_draft and args.num_beams > 1:
+        parser.error("--retrieval_draft verifies drafts against greedy decoding (--num_beams 1)")
+    if args.retrieval_draft and args.constrained_decoding:
+        parser.error("--retrieval_draft verifies drafts against unconstrained greedy decoding")
+    if args.decode_slots and not args.static_decoder:
+        parser.error("--decode_slots requires --static_decoder")
     return args
 
-def test_inference(args, model, test_loader, tokenizer, model_sql_path, model_record_path):
+def test_inference(args, model, test_loader, tokenizer, model_sql_path, model_record_path, length_predictor=None):
     """Generate SQL predictions and compute records"""
     model.eval()
-    sql_queries = []
+    predictions = {}
+    generation_cache = GenerationCache()
+    generator = StaticCacheDecoder(model, args.max_gen_length) if args.static_decoder else model
+    greedy_kwargs = {'num_slots': args.decode_slots} if args.static_decoder else {}
+    
+    # Grammar- and schema-constrained decoding (see sql_grammar)
+    grammar, decode_kwargs = None, {}
+    if args.constrained_decoding:
+        grammar = SQLGrammar.for_model(model, tokenizer, getattr(test_loader.dataset, 'anonymizer', None))
+        decode_kwargs = {'logits_processor': LogitsProcessorList([grammar.logits_processor()])}
     
     print(f"\nGenerating SQL predictions for test set...")
     print(f"Device: {DEVICE}")
@@ -46,35 +100,86 @@ def test_inference(args, model, test_loader, tokenizer, model_sql_path, model_re
     print(f"Num beams: {args.num_beams}")
     print("="*80)
     
-    progress_bar = tqdm(test_loader, desc="Generating")
+    # Questions close to a train question take the SQL of its template (see sql_templates)
+    # and, with --retrieval_draft, the others decode speculatively from that template
+    use_templates = args.template_threshold > 0 or args.retrieval_draft
+    template_matcher = TemplateMatcher.from_data('data', args.template_threshold) if use_templates else None
+    questions = load_lines(os.path.join('data', 'test.nl'))
+    num_matched = 0
+    draft_stats = {}
+    start_time = time.perf_counter()
+    
+    # With length caps, batches group questions of similar predicted length and decode
+    # up to the largest cap in the batch (see length_predictor)
+    caps = None
+    batches = zip(test_loader.batch_sampler, test_loader)
+    if length_predictor is not None:
+        caps = {idx: length_predictor.predict(questions[idx]) for idx in test_loader.sampler}
+        batches = length_grouped_batches(test_loader, caps)
+    progress_bar = tqdm(batches, total=len(test_loader), desc="Generating")
     
     with torch.no_grad():
-        for encoder_input, encoder_mask, _ in progress_bar:
-            encoder_input = encoder_input.to(DEVICE)
-            encoder_mask = encoder_mask.to(DEVICE)
+        for batch_ids, (encoder_input, encoder_mask, _) in progress_bar:
+            batch_sql = [template_matcher.match(questions[idx]) if args.template_threshold > 0 else None for idx in batch_ids]
+            rows = [row for row, sql in enumerate(batch_sql) if sql is None]
+            num_matched += len(batch_sql) - len(rows)
+            if not rows:
+                predictions.update(zip(batch_ids, batch_sql))
+                continue
+            
+            rows_index = torch.tensor(rows)
+            encoder_input = encoder_input[rows_index].to(DEVICE)
+            encoder_mask = encoder_mask[rows_index].to(DEVICE)
+            encoder_input, encoder_mask = bucket_batch(args, encoder_input, encoder_mask)
             
             # Generate
-            if args.num_beams > 1:
-                generated_ids = model.generate(
-                    input_ids=encoder_input,
-                    attention_mask=encoder_mask,
-                    max_length=args.max_gen_length,
+            max_length = max(caps[batch_ids[row]] for row in rows) if caps else args.max_gen_length
+            if args.retrieval_draft:
+                drafts = [tokenizer(compress_sql(sql) if args.compress_sql else sql)['input_ids']
+                          for sql in (template_matcher.draft(questions[batch_ids[row]], args.anonymize_literals) for row in rows)]
+                generated_ids = speculative_generate(
+                    model, get_encoder_outputs(model, encoder_input, encoder_mask), encoder_mask, drafts,
+                    max_length, args.num_draft_tokens, stats=draft_stats,
+                )
+            elif args.num_beams > 1:
+                generated_ids = generation_cache.generate(
+                    generator, encoder_input, encoder_mask,
+                    max_length=max_length,
                     num_beams=args.num_beams,
                     early_stopping=True,
+                    **decode_kwargs,
                 )
             else:
-                generated_ids = model.generate(
-                    input_ids=encoder_input,
-                    attention_mask=encoder_mask,
-                    max_length=args.max_gen_length,
+                generated_ids = generation_cache.generate(
+                    generator, encoder_input, encoder_mask,
+                    max_length=max_length,
+                    **greedy_kwargs,
+                    **decode_kwargs,
                 )
             
             # Decode
-            for gen_ids in generated_ids:
+            for row, gen_ids in zip(rows, from_output_vocab(model, generated_ids)):
+                if caps:
+                    gen_ids = length_predictor.capped(gen_ids, caps[batch_ids[row]], tokenizer.eos_token_id)
                 sql = tokenizer.decode(gen_ids, skip_special_tokens=True)
-                sql_queries.append(sql)
+                sql = expand_sql(sql) if args.compress_sql else sql
+                batch_sql[row] = test_loader.dataset.restore_literals(batch_ids[row], sql)
+            predictions.update(zip(batch_ids, batch_sql))
+    sql_queries = [predictions[idx] for idx in test_loader.sampler]
     
     print(f"\n✓ Generated {len(sql_queries)} SQL queries")
+    generation_cache.report()
+    if args.static_decoder:
+        generator.report()
+    if grammar is not None:
+        grammar.report()
+    if length_predictor is not None:
+        length_predictor.report()
+    if args.template_threshold > 0:
+        print(f"✓ Template fast path: {num_matched}/{len(sql_queries)} questions answered without decoding")
+    if args.retrieval_draft and draft_stats:
+        print(f"✓ Retrieval drafts: {draft_stats['tokens'] / draft_stats['forwards']:.2f} tokens per decoder forward, "
+              f"{1000 * (time.perf_counter() - start_time) / len(sql_queries):.1f} ms/question")
     
     # Save queries and compute records
     print(f"\nSaving queries to: {model_sql_path}")
@@ -142,7 +247,11 @@ def main():
         args.batch_size, 
         "test", 
         use_schema=args.use_schema,
-        use_preprocessed=args.use_preprocessed
+        use_preprocessed=args.use_preprocessed,
+        schema_prompt_tokens=args.schema_prompt_tokens,
+        schema_token_budget=args.schema_token_budget,
+        entity_linking=args.entity_linking,
+        anonymize_literals=args.anonymize_literals
     )
     print(f"✓ Loaded {len(test_loader)} batches\n")
     
@@ -151,19 +260,41 @@ def main():
     model = T5ForConditionalGeneration.from_pretrained('google-t5/t5-small')
     
     print(f"Loading checkpoint weights from {args.checkpoint}...")
-    checkpoint = torch.load(args.checkpoint, map_location=DEVICE)
-    model.load_state_dict(checkpoint['model_state_dict'])
+    load_model_weights(model, args.checkpoint)
+    merge_lora(model)  # adapter-only checkpoints run as a plain T5
     
     model = model.to(DEVICE)
     model.eval()
+    if args.restrict_vocab or args.length_margin > 0:
+        # Train SQL in the form the model generates
+        train_sql_queries = load_lines('data/train.sql')
+        if args.anonymize_literals:
+            # The decoder writes placeholders for anonymized literals, so keep their tokens
+            anonymizer = test_loader.dataset.anonymizer
+            train_sql_queries = [anonymizer.anonymize(nl_query, sql_query)[1]
+                                 for nl_query, sql_query in zip(load_lines('data/train.nl'), train_sql_queries)]
+        if args.compress_sql:
+            train_sql_queries = [compress_sql(sql_query) for sql_query in train_sql_queries]
+    if args.restrict_vocab:
+        restrict_output_vocab(model, output_vocab_ids(tokenizer, train_sql_queries), tokenizer.unk_token_id)
+    if args.compile:
+        model = compile_model(model, args)
     print(f"✓ Model loaded on {DEVICE}\n")
     
     # Set output paths
     model_sql_path = f'results/t5_ft_{args.experiment_name}_test.sql'
     model_record_path = f'results/t5_ft_{args.experiment_name}_test.pkl'
     
+    # Per-question generation caps from the nearest train questions
+    length_predictor = None
+    if args.length_margin > 0:
+        # With --anonymize_literals the targets hold placeholders, so questions are compared anonymized too
+        anonymizer = test_loader.dataset.anonymizer if args.anonymize_literals else None
+        length_predictor = LengthPredictor(tokenizer, load_lines('data/train.nl'), train_sql_queries, anonymizer,
+                                           max_length=args.max_gen_length, margin=args.length_margin)
+    
     # Generate predictions
-    test_inference(args, model, test_loader, tokenizer, model_sql_path, model_record_path)
+    test_inference(args, model, test_loader, tokenizer, model_sql_path, model_record_path, length_predictor)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
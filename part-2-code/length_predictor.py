@@ -0,0 +1,133 @@
+"""
+Per-question generation length caps.
+
+--max_gen_length (512) bounds every batch, while most SQL queries are far shorter: a batch
+with a row that never emits EOS (an undertrained or scratch model) runs all 512 steps, and
+the static decoder sizes its KV cache for it. LengthPredictor caps each question from the
+target lengths of its nearest train questions (Jaccard similarity of word unigrams +
+bigrams, as in sql_templates), with a safety margin:
+
+    cap = min(max_length, ceil(margin * max(neighbour lengths)) + slack)
+
+Questions that share no feature with a train question fall back to a least-squares fit
+of length on the question's word count. Lengths count generated positions (decoder start
+token, SQL tokens, EOS), the unit of generate's max_length.
+
+length_grouped_batches() regroups a loader's examples by predicted cap so each batch
+decodes with the largest cap of similar questions. Run as a script to report dev
+coverage (gold lengths within their cap) and the mean cap per margin.
+"""
+
+import math
+from collections import Counter, defaultdict
+
+from sql_templates import question_features
+
+class LengthPredictor:
+
+    def __init__(self, tokenizer, nl_queries, sql_queries, anonymizer=None, max_length=512,
+                 margin=1.5, slack=4, num_neighbours=10):
+        '''
+        nl_queries / sql_queries: train pairs, the SQL in the form the model is trained
+        to generate (compressed / anonymized). With an anonymizer, questions are compared
+        with their literals replaced by placeholders.
+        '''
+        self.anonymizer = anonymizer
+        self.max_length = max_length
+        self.margin = margin
+        self.slack = slack
+        self.num_neighbours = num_neighbours
+        self.num_generated = self.num_capped = self.total_cap = 0
+
+        self.lengths = [len(ids) + 1 for ids in tokenizer(sql_queries)['input_ids']]  # + decoder start
+        self.features = [question_features(self.normalize(nl_query)) for nl_query in nl_queries]
+        self.postings = defaultdict(list)
+        for i, features in enumerate(self.features):
+            for feature in features:
+                self.postings[feature].append(i)
+
+        # Fallback: length ~ slope * words + intercept
+        words = [len(nl_query.split()) for nl_query in nl_queries]
+        mean_words, mean_length = sum(words) / len(words), sum(self.lengths) / len(self.lengths)
+        variance = sum((w - mean_words) ** 2 for w in words)
+        covariance = sum((w - mean_words) * (l - mean_length) for w, l in zip(words, self.lengths))
+        self.slope = covariance / variance if variance else 0.0
+        self.intercept = mean_length - self.slope * mean_words
+
+    def normalize(self, nl_query):
+        return self.anonymizer.anonymize(nl_query)[0] if self.anonymizer is not None else nl_query
+
+    def estimate(self, nl_query):
+        '''
+        Expected generated length of nl_query, before the safety margin.
+        '''
+        features = question_features(self.normalize(nl_query))
+        overlaps = Counter()
+        for feature in features:
+            overlaps.update(self.postings.get(feature, ()))
+        if not overlaps:
+            return self.slope * len(nl_query.split()) + self.intercept
+
+        similarity = lambda i: overlaps[i] / (len(features) + len(self.features[i]) - overlaps[i])
+        neighbours = sorted(overlaps, key=similarity, reverse=True)[:self.num_neighbours]
+        return max(self.lengths[i] for i in neighbours)
+
+    def cap(self, estimate):
+        return min(self.max_length, math.ceil(self.margin * estimate) + self.slack)
+
+    def predict(self, nl_query):
+        return self.cap(self.estimate(nl_query))
+
+    def capped(self, gen_ids, cap, eos_id):
+        '''
+        gen_ids (one generated row) cut to cap positions, counting rows that hit the cap
+        before EOS.
+        '''
+        gen_ids = gen_ids[:cap]
+        self.num_generated += 1
+        self.num_capped += not (gen_ids == eos_id).any().item()
+        self.total_cap += cap
+        return gen_ids
+
+    def report(self):
+        if self.num_generated:
+            status = "✓" if self.num_capped == 0 else "⚠"
+            print(f"{status} Length caps: {self.num_capped}/{self.num_generated} generations hit their cap "
+                  f"(mean cap {self.total_cap / self.num_generated:.0f}, max_gen_length {self.max_length})")
+        self.num_generated = self.num_capped = self.total_cap = 0
+
+def length_grouped_batches(dataloader, caps):
+    '''
+    (batch indices, collated batch) over the examples of dataloader (in sampler order,
+    so one shard under DDP), regrouped into batches of similar predicted cap.
+    '''
+    order = sorted(dataloader.sampler, key=lambda idx: caps[idx])
+    for start in range(0, len(order), dataloader.batch_size):
+        batch_ids = order[start:start + dataloader.batch_size]
+        yield batch_ids, dataloader.collate_fn([dataloader.dataset[idx] for idx in batch_ids])
+
+if __name__ == "__main__":
+    import os
+    from transformers import T5TokenizerFast
+
+    tokenizer = T5TokenizerFast.from_pretrained('google-t5/t5-small')
+    def load(path):
+        with open(path, 'r') as f:
+            return [line.strip() for line in f.readlines()]
+    predictor = LengthPredictor(tokenizer, load(os.path.join('data', 'train.nl')), load(os.path.join('data', 'train.sql')))
+    nl_queries = load(os.path.join('data', 'dev.nl'))
+    gold = [len(ids) + 1 for ids in tokenizer(load(os.path.join('data', 'dev.sql')))['input_ids']]
+    estimates = [predictor.estimate(nl_query) for nl_query in nl_queries]
+
+    print("\n" + "="*80)
+    print(f"GENERATION LENGTH CAPS (dev, gold length mean {sum(gold) / len(gold):.0f}, max {max(gold)}; "
+          f"max_gen_length {predictor.max_length})")
+    print("="*80)
+    print(f"{'Margin':>7} {'Mean cap':>9} {'Max cap':>8} {'Within cap':>11}")
+    for margin in (1.0, 1.1, 1.25, 1.5, 2.0):
+        predictor.margin = margin
+        caps = [predictor.cap(estimate) for estimate in estimates]
+        within = sum(length <= cap for length, cap in zip(gold, caps))
+        status = "✓" if within == len(gold) else "⚠"
+        print(f"{margin:>7.2f} {sum(caps) / len(caps):>9.1f} {max(caps):>8} {status} {100 * within / len(gold):>8.1f}%")
+    print("="*80 + "\n")
@@ -4,7 +4,8 @@ from tqdm import tqdm
 import pickle
 import json
 
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler, RandomSampler, SequentialSampler
+from torch.utils.data.distributed import DistributedSampler
 from torch.nn.utils.rnn import pad_sequence
 
 import nltk
@@ -12,11 +13,24 @@ nltk.download('punkt')
 from transformers import T5TokenizerFast
 import torch
 
+from sql_compression import compress_sql, verify_round_trip
+from schema_linker import SchemaLinker
+from entity_linker import EntityLinker
+from anonymizer import Anonymizer
+
 PAD_IDX = 0
 
+def schema_prompt(num_tokens):
+    '''
+    Placeholder text for a learned schema prompt: the first num_tokens T5 sentinel tokens,
+    whose embeddings are initialized from the schema (see t5_utils.init_schema_prompt).
+    '''
+    return "".join(f"<extra_id_{i}>" for i in range(num_tokens))
+
 class T5Dataset(Dataset):
 
-    def __init__(self, data_folder, split, use_schema=True, use_preprocessed=False):
+    def __init__(self, data_folder, split, use_schema=True, use_preprocessed=False, compress_targets=False,
+                 schema_prompt_tokens=0, schema_token_budget=0, entity_linking=None, anonymize_literals=False):
         '''
         Skeleton for the class for performing data processing for the T5 model.
 
@@ -29,10 +43,14 @@ class T5Dataset(Dataset):
         '''
         self.split = split
         self.use_schema = use_schema
+        self.schema_prompt_tokens = schema_prompt_tokens
         self.tokenizer = T5TokenizerFast.from_pretrained('google-t5/t5-small')
         
         # Load schema if needed
-        if self.use_schema:
+        if self.schema_prompt_tokens > 0:
+            self.schema = ""
+            print(f"Schema replaced by a {schema_prompt_tokens}-token learned prompt")
+        elif self.use_schema:
             self.schema = self.load_schema(os.path.join(data_folder, 'flight_database.schema'))
             print(f"Schema loaded ({len(self.schema)} chars)")
         else:
@@ -47,9 +65,50 @@ class T5Dataset(Dataset):
             data_path = data_folder
             print(f"Using original data from {data_path}")
         
+        # Per-question pruned schema instead of the fixed one (see schema_linker)
+        self.schema_linker = None
+        if self.use_schema and self.schema_prompt_tokens == 0 and schema_token_budget > 0:
+            self.schema_linker = SchemaLinker(data_folder, self.tokenizer, schema_token_budget, nl_folder=data_path)
+            print(f"Schema linking: question-conditioned schema within {schema_token_budget} tokens")
+        
         # Load data
         self.nl_queries, self.sql_queries = self.load_data(data_path, split)
         print(f"Loaded {len(self.nl_queries)} examples for {split} split")
+        # The schema linker's statistics come from these questions, before anonymization /
+        # entity linking rewrite the city and airport names it relies on
+        self.linker_nl_queries = self.nl_queries
+        
+        # Typed placeholders for literals (see anonymizer); restore_literals puts them back
+        self.anonymize_literals = anonymize_literals
+        if anonymize_literals:
+            self.anonymizer = Anonymizer.from_data(data_folder, nl_folder=data_path)
+            anonymized = [self.anonymizer.anonymize(nl_query, sql_query)
+                          for nl_query, sql_query in zip(self.nl_queries, self.sql_queries)]
+            self.nl_queries = [nl_query for nl_query, _, _ in anonymized]
+            self.sql_queries = [sql_query for _, sql_query, _ in anonymized]
+            self.literal_values = [values for _, _, values in anonymized]
+            print(f"✓ Anonymized literals: {len(set(self.nl_queries))} distinct questions "
+                  f"({sum(len(values) for values in self.literal_values)} literals)")
+        
+        # Rewrite entity names to codes / database spellings (see entity_linker)
+        if entity_linking:
+            entity_linker = EntityLinker.from_data(data_folder, mode=entity_linking)
+            linked = [entity_linker.link(nl_query) for nl_query in self.nl_queries]
+            num_changed = sum(a != b for a, b in zip(self.nl_queries, linked))
+            self.nl_queries = linked
+            print(f"✓ Entity linking ({entity_linking}) changed {num_changed}/{len(linked)} questions")
+        
+        # Decode to the compact SQL form (see sql_compression); outputs go through expand_sql
+        if compress_targets and split != 'test':
+            compressed, unchanged = verify_round_trip(self.sql_queries)
+            self.sql_queries = [compress_sql(sql_query) for sql_query in self.sql_queries]
+            print(f"✓ Compressed {compressed}/{len(self.sql_queries)} targets (round trip exact, {len(unchanged)} kept as is)")
+
+    def restore_literals(self, idx, sql_query):
+        # Generated SQL for example idx with its anonymized literals put back
+        if not self.anonymize_literals:
+            return sql_query
+        return self.anonymizer.deanonymize(sql_query, self.literal_values[idx])
 
     def load_schema(self, schema_path):
         """Load and format database schema from JSON file."""
@@ -105,16 +164,22 @@ class T5Dataset(Dataset):
     def __len__(self):
         return len(self.nl_queries)
 
-    def __getitem__(self, idx):
+    def get_encoder_input(self, idx):
         nl_query = self.nl_queries[idx]
-        sql_query = self.sql_queries[idx]
         
         # Format input with optional schema context
+        if self.schema_prompt_tokens > 0:
+            # The learned prompt tokens take the place of the schema text
+            return f"translate to SQL: {schema_prompt(self.schema_prompt_tokens)} | query: {nl_query}"
         if self.use_schema:
             # Include schema for better SQL generation
-            encoder_input = f"translate to SQL: {self.schema} | query: {nl_query}"
-        else:
-            encoder_input = f"translate to SQL: {nl_query}"
+            schema = self.schema_linker.link(self.linker_nl_queries[idx]) if self.schema_linker is not None else self.schema
+            return f"translate to SQL: {schema} | query: {nl_query}"
+        return f"translate to SQL: {nl_query}"
+
+    def __getitem__(self, idx):
+        sql_query = self.sql_queries[idx]
+        encoder_input = self.get_encoder_input(idx)
         
         # Tokenize encoder input
         encoder_tokens = self.tokenizer(
@@ -227,32 +292,114 @@ def test_collate_fn(batch):
     
     return encoder_ids, encoder_mask, initial_decoder_inputs
 
-def get_dataloader(batch_size, split, use_schema=True, use_preprocessed=False):
+class EncoderStateDataset(Dataset):
+    '''
+    Wraps a T5Dataset so items carry cached encoder hidden states, shape (T, d_model) in
+    fp16, in place of the encoder input ids (see t5_utils.EncoderStateCache). The other
+    item fields are unchanged, so normal_collate_fn pads the states like input ids.
+    '''
+    def __init__(self, dataset, encoder_cache):
+        self.dataset = dataset
+        self.encoder_cache = encoder_cache
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        _, _, decoder_input_ids, decoder_target_ids, initial_decoder_input = self.dataset[idx]
+        encoder_states = self.encoder_cache.get(self.dataset.get_encoder_input(idx))
+        encoder_mask = torch.ones(encoder_states.size(0), dtype=torch.long)
+        return encoder_states, encoder_mask, decoder_input_ids, decoder_target_ids, initial_decoder_input
+
+def with_encoder_cache(dataloader, encoder_cache):
+    '''
+    Same loader (batch size, shuffling, distributed sampling) over an EncoderStateDataset.
+    '''
+    dataset = EncoderStateDataset(dataloader.dataset, encoder_cache)
+    sampler = dataloader.sampler
+    if isinstance(sampler, DistributedSampler):
+        sampler = DistributedSampler(dataset, num_replicas=sampler.num_replicas, rank=sampler.rank, shuffle=sampler.shuffle)
+    elif isinstance(sampler, ShardSampler):
+        sampler = ShardSampler(dataset, sampler.num_replicas, sampler.rank)
+    elif isinstance(sampler, RandomSampler):
+        sampler = RandomSampler(dataset)
+    else:
+        sampler = SequentialSampler(dataset)
+    
+    return DataLoader(
+        dataset,
+        batch_size=dataloader.batch_size,
+        sampler=sampler,
+        collate_fn=dataloader.collate_fn,
+        num_workers=0
+    )
+
+class ShardSampler(Sampler):
+    '''
+    Strided, non-padded shard of a dataset for distributed evaluation: rank r sees
+    examples r, r + world_size, ... so results can be merged back in order
+    (see utils.gather_shards). Unlike DistributedSampler no examples are duplicated.
+    '''
+    def __init__(self, dataset, num_replicas, rank):
+        self.dataset = dataset
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def __iter__(self):
+        return iter(range(self.rank, len(self.dataset), self.num_replicas))
+
+    def __len__(self):
+        return len(range(self.rank, len(self.dataset), self.num_replicas))
+
+def get_dataloader(batch_size, split, use_schema=True, use_preprocessed=False, distributed=False, compress_targets=False,
+                   schema_prompt_tokens=0, schema_token_budget=0, entity_linking=None, anonymize_literals=False):
     data_folder = 'data'
-    dataset = T5Dataset(data_folder, split, use_schema=use_schema, use_preprocessed=use_preprocessed)
+    dataset = T5Dataset(data_folder, split, use_schema=use_schema, use_preprocessed=use_preprocessed,
+                        compress_targets=compress_targets, schema_prompt_tokens=schema_prompt_tokens,
+                        schema_token_budget=schema_token_budget, entity_linking=entity_linking,
+                        anonymize_literals=anonymize_literals)
     shuffle = (split == "train")
     collate = normal_collate_fn if split != "test" else test_collate_fn
     
+    sampler = None
+    if distributed:
+        import torch.distributed as dist
+        if split == "train":
+            sampler = DistributedSampler(dataset, shuffle=True)
+        else:
+            sampler = ShardSampler(dataset, dist.get_world_size(), dist.get_rank())
+        shuffle = False
+    
     dataloader = DataLoader(
         dataset, 
         batch_size=batch_size, 
         shuffle=shuffle, 
+        sampler=sampler,
         collate_fn=collate,
         num_workers=0
     )
     
     return dataloader
 
-def load_t5_data(batch_size, test_batch_size, use_schema=True, use_preprocessed=False):
+def load_t5_data(batch_size, test_batch_size, use_schema=True, use_preprocessed=False, distributed=False, compress_targets=False,
+                 schema_prompt_tokens=0, schema_token_budget=0, entity_linking=None, anonymize_literals=False):
     print("\n" + "="*80)
     print("Loading T5 data...")
     print(f"Schema context: {use_schema}")
     print(f"Preprocessed data: {use_preprocessed}")
+    print(f"Compressed SQL targets: {compress_targets}")
+    print(f"Schema prompt tokens: {schema_prompt_tokens}")
+    print(f"Schema token budget: {schema_token_budget or 'off (full schema)'}")
+    print(f"Entity linking: {entity_linking or 'off'}")
+    print(f"Anonymized literals: {anonymize_literals}")
     print("="*80)
     
-    train_loader = get_dataloader(batch_size, "train", use_schema, use_preprocessed)
-    dev_loader = get_dataloader(test_batch_size, "dev", use_schema, use_preprocessed)
-    test_loader = get_dataloader(test_batch_size, "test", use_schema, use_preprocessed)
+    train_loader = get_dataloader(batch_size, "train", use_schema, use_preprocessed, distributed, compress_targets,
+                                  schema_prompt_tokens, schema_token_budget, entity_linking, anonymize_literals)
+    dev_loader = get_dataloader(test_batch_size, "dev", use_schema, use_preprocessed, distributed, compress_targets,
+                                schema_prompt_tokens, schema_token_budget, entity_linking, anonymize_literals)
+    test_loader = get_dataloader(test_batch_size, "test", use_schema, use_preprocessed, distributed, compress_targets,
+                                 schema_prompt_tokens, schema_token_budget, entity_linking, anonymize_literals)
     
     print(f"Train batches: {len(train_loader)}")
     print(f"Dev batches: {len(dev_loader)}")
@@ -262,6 +409,16 @@ def load_t5_data(batch_size, test_batch_size, use_schema=True, use_preprocessed=
     return train_loader, dev_loader, test_loader
 
 
+def restore_literals(dataloader, sql_queries):
+    '''
+    sql_queries generated in dataloader order (one shard under DDP), with the literals of
+    an anonymize_literals dataset put back.
+    '''
+    dataset = getattr(dataloader.dataset, 'dataset', dataloader.dataset)  # EncoderStateDataset wraps a T5Dataset
+    if not dataset.anonymize_literals:
+        return sql_queries
+    return [dataset.restore_literals(idx, sql_query) for idx, sql_query in zip(dataloader.sampler, sql_queries)]
+
 def load_lines(path):
     with open(path, 'r') as f:
         lines = f.readlines()
@@ -5,10 +5,11 @@ and Question/Answer format with END tokens
 """
 
 import os
+import torch
 from load_data import T5Dataset, normal_collate_fn, test_collate_fn
 from torch.utils.data import DataLoader
 
-def get_dataloader_scratch(batch_size, split, use_schema=True, use_preprocessed=False, use_heavy_aug=False):
+def get_dataloader_scratch(batch_size, split, use_schema=True, use_preprocessed=False, use_heavy_aug=False, tokenizer=None):
     """
     Get dataloader with support for heavy augmentation
     
@@ -18,6 +19,7 @@ def get_dataloader_scratch(batch_size, split, use_schema=True, use_preprocessed=
         use_schema: Whether to use schema in input
         use_preprocessed: Whether to use preprocessed data
         use_heavy_aug: Whether to use heavily augmented data (for scratch training)
+        tokenizer: Tokenizer for inputs and targets (default: google-t5/t5-small)
     """
     data_folder = 'data'
     
@@ -37,14 +39,14 @@ def get_dataloader_scratch(batch_size, split, use_schema=True, use_preprocessed=
     
     # Create dataset with appropriate folder
     class ModifiedT5Dataset(T5Dataset):
-        def __init__(self, data_folder, split, use_schema=True, preprocessed_folder=None):
+        def __init__(self, data_folder, split, use_schema=True, preprocessed_folder=None, tokenizer=None):
             self.split = split
             self.use_schema = use_schema
             self.tokenizer = T5Dataset.__dict__['__init__'].__code__.co_consts[1]  # Get tokenizer
             
             # Import here to avoid circular dependency
             from transformers import T5TokenizerFast
-            self.tokenizer = T5TokenizerFast.from_pretrained('google-t5/t5-small')
+            self.tokenizer = tokenizer if tokenizer is not None else T5TokenizerFast.from_pretrained('google-t5/t5-small')
             
             # Load schema if needed
             if self.use_schema:
@@ -78,14 +80,24 @@ def get_dataloader_scratch(batch_size, split, use_schema=True, use_preprocessed=
             else:
                 input_text = f"Question: {nl_query} Answer: "
             
+            encoder_tokens = self.tokenizer(input_text, max_length=512, truncation=True, return_tensors='pt')
+            encoder_ids = encoder_tokens['input_ids'].squeeze(0)
+            encoder_mask = encoder_tokens['attention_mask'].squeeze(0)
+            
+            # For test split there are no targets
+            if self.split == "test":
+                return encoder_ids, encoder_mask, None, None, None
+            
             # Format target as "<sql> END" for training
-            # For test split, don't add END since we won't have targets
-            if self.split != "test":
-                target_text = f"{sql_query} END"
-            else:
-                target_text = sql_query
+            target_text = f"{sql_query} END"
+            decoder_target_ids = self.tokenizer(target_text, max_length=512, truncation=True, return_tensors='pt')['input_ids'].squeeze(0)
+            
+            # Decoder inputs are the targets shifted right behind the start token (pad),
+            # which is also what generation starts from
+            initial_decoder_input = torch.tensor([self.tokenizer.pad_token_id])
+            decoder_input_ids = torch.cat([initial_decoder_input, decoder_target_ids[:-1]])
             
-            return input_text, target_text
+            return encoder_ids, encoder_mask, decoder_input_ids, decoder_target_ids, initial_decoder_input
         
         def __len__(self):
             return len(self.nl_queries)
@@ -94,7 +106,8 @@ def get_dataloader_scratch(batch_size, split, use_schema=True, use_preprocessed=
         data_folder, 
         split, 
         use_schema=use_schema,
-        preprocessed_folder=preprocessed_folder
+        preprocessed_folder=preprocessed_folder,
+        tokenizer=tokenizer
     )
     
     shuffle = (split == "train")
@@ -110,7 +123,7 @@ def get_dataloader_scratch(batch_size, split, use_schema=True, use_preprocessed=
     
     return dataloader
 
-def load_t5_data_scratch(batch_size, test_batch_size, use_schema=True, use_preprocessed=False, use_heavy_aug=False):
+def load_t5_data_scratch(batch_size, test_batch_size, use_schema=True, use_preprocessed=False, use_heavy_aug=False, tokenizer=None):
     """
     Load data for scratch training with optional heavy augmentation
     
@@ -120,6 +133,7 @@ def load_t5_data_scratch(batch_size, test_batch_size, use_schema=True, use_prepr
         use_schema: Whether to use schema
         use_preprocessed: Whether to use preprocessed data
         use_heavy_aug: Whether to use heavily augmented data
+        tokenizer: Tokenizer for inputs and targets (default: google-t5/t5-small)
     """
     print("\n" + "="*80)
     print("Loading T5 data for SCRATCH training...")
@@ -129,9 +143,9 @@ def load_t5_data_scratch(batch_size, test_batch_size, use_schema=True, use_prepr
     print(f"Format: Question/Answer with END tokens")
     print("="*80)
     
-    train_loader = get_dataloader_scratch(batch_size, "train", use_schema, use_preprocessed, use_heavy_aug)
-    dev_loader = get_dataloader_scratch(test_batch_size, "dev", use_schema, use_preprocessed, False)  # No aug for dev
-    test_loader = get_dataloader_scratch(test_batch_size, "test", use_schema, use_preprocessed, False)  # No aug for test
+    train_loader = get_dataloader_scratch(batch_size, "train", use_schema, use_preprocessed, use_heavy_aug, tokenizer)
+    dev_loader = get_dataloader_scratch(test_batch_size, "dev", use_schema, use_preprocessed, False, tokenizer)  # No aug for dev
+    test_loader = get_dataloader_scratch(test_batch_size, "test", use_schema, use_preprocessed, False, tokenizer)  # No aug for test
     
     print(f"Train batches: {len(train_loader)}")
     print(f"Dev batches: {len(dev_loader)}")
@@ -6,6 +6,8 @@ from nltk.corpus import wordnet
 from nltk.tokenize import word_tokenize
 from nltk.tag import pos_tag
 
+from entity_linker import EntityLinker
+
 # Download required NLTK data
 try:
     nltk.data.find('corpora/wordnet')
@@ -171,19 +173,24 @@ def augment_with_synonyms(text, aug_prob=0.5):
 # PART 2: PREPROCESSING
 # ============================================================================
 
-def preprocess_nl_query(query):
+def preprocess_nl_query(query, entity_linker=None):
     """
     Preprocess natural language query
     
     Preprocessing steps:
     1. Lowercase
-    2. Normalize query phrases (give me, show me, what flights, etc.) -> list
-    3. Remove extra whitespace
-    4. Remove punctuation at the end
+    2. Link entity names (optional, see entity_linker.EntityLinker)
+    3. Normalize query phrases (give me, show me, what flights, etc.) -> list
+    4. Remove extra whitespace
+    5. Remove punctuation at the end
     """
     # Step 1: Lowercase
     query = query.lower()
     
+    # Step 1b: Airport/airline/city names -> codes
+    if entity_linker is not None:
+        query = entity_linker.link(query)
+    
     # Step 2: Normalize query phrases to "list"
     # Handle various question patterns
     query = re.sub(r'^give me (the )?', 'list ', query)
@@ -229,7 +236,7 @@ def preprocess_sql_query(query):
 def create_augmented_and_preprocessed_dataset(
     input_nl_path, input_sql_path, 
     output_nl_path, output_sql_path, 
-    augmentation_ratio=0.05, aug_prob=0.5):
+    augmentation_ratio=0.05, aug_prob=0.5, entity_linker=None):
     """
     Complete pipeline: Augment + Preprocess data
     
@@ -240,6 +247,7 @@ def create_augmented_and_preprocessed_dataset(
         output_sql_path: Output preprocessed + augmented SQL file
         augmentation_ratio: Ratio of augmented examples to add (e.g., 0.05 = 5%)
         aug_prob: Probability of replacing each significant word
+        entity_linker: Optional EntityLinker applied to every NL query
     """
     # Read original data
     with open(input_nl_path, 'r', encoding='utf-8') as f:
@@ -297,7 +305,7 @@ def create_augmented_and_preprocessed_dataset(
     preprocessed_sql = []
     
     for nl, sql in zip(combined_nl_raw, combined_sql_raw):
-        preprocessed_nl.append(preprocess_nl_query(nl))
+        preprocessed_nl.append(preprocess_nl_query(nl, entity_linker))
         preprocessed_sql.append(preprocess_sql_query(sql))
     
     # Write final output
@@ -326,7 +334,7 @@ def create_augmented_and_preprocessed_dataset(
     
     return indices_to_augment
 
-def preprocess_file_only(input_path, output_path, is_sql=False):
+def preprocess_file_only(input_path, output_path, is_sql=False, entity_linker=None):
     """
     Preprocess a file line by line (NO augmentation, just preprocessing)
     Used for dev and test sets
@@ -341,7 +349,7 @@ def preprocess_file_only(input_path, output_path, is_sql=False):
             if is_sql:
                 preprocessed_line = preprocess_sql_query(line)
             else:
-                preprocessed_line = preprocess_nl_query(line)
+                preprocessed_line = preprocess_nl_query(line, entity_linker)
             preprocessed_lines.append(preprocessed_line)
     
     os.makedirs(os.path.dirname(output_path) if os.path.dirname(output_path) else '.', exist_ok=True)
@@ -367,10 +375,13 @@ def main():
     # Configuration
     AUGMENTATION_RATIO = 0.05  # Add 5% augmented examples (2-5% recommended)
     AUG_PROBABILITY = 0.5      # Probability of replacing each significant word (50%)
+    ENTITY_LINKING = None      # None, 'replace' or 'annotate' (entity names -> codes)
     
     print(f"\nConfiguration:")
     print(f"  Augmentation ratio: {AUGMENTATION_RATIO*100:.1f}% of training data")
     print(f"  Significant word replacement probability: {AUG_PROBABILITY}")
+    print(f"  Entity linking: {ENTITY_LINKING or 'off'}")
+    entity_linker = EntityLinker.from_data('data', mode=ENTITY_LINKING) if ENTITY_LINKING else None
     print(f"\nSignificant words include:")
     print(f"  - Action verbs: arrive, leave, depart, return, show, list, etc.")
     print(f"  - Important adjectives: earliest, latest, expensive, cheap, nonstop, etc.")
@@ -393,7 +404,8 @@ def main():
         f'{output_dir}/train.nl',
         f'{output_dir}/train.sql',
         augmentation_ratio=AUGMENTATION_RATIO,
-        aug_prob=AUG_PROBABILITY
+        aug_prob=AUG_PROBABILITY,
+        entity_linker=entity_linker
     )
     
     # ========================================================================
@@ -403,7 +415,7 @@ def main():
     print("PROCESSING DEV SET (no augmentation)")
     print("="*80)
     
-    preprocess_file_only('data/dev.nl', f'{output_dir}/dev.nl', is_sql=False)
+    preprocess_file_only('data/dev.nl', f'{output_dir}/dev.nl', is_sql=False, entity_linker=entity_linker)
     preprocess_file_only('data/dev.sql', f'{output_dir}/dev.sql', is_sql=True)
     
     # ========================================================================
@@ -413,7 +425,7 @@ def main():
     print("PROCESSING TEST SET (no augmentation)")
     print("="*80)
     
-    preprocess_file_only('data/test.nl', f'{output_dir}/test.nl', is_sql=False)
+    preprocess_file_only('data/test.nl', f'{output_dir}/test.nl', is_sql=False, entity_linker=entity_linker)
     
     # ========================================================================
     # SUMMARY
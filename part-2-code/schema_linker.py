@@ -0,0 +1,191 @@
+"""
+Question-conditioned schema pruning for the T5 encoder input.
+
+T5Dataset.load_schema lists every table (alphabetically, 8 columns each, cut at 800
+characters), so every question pays for tables it never uses while columns it needs can
+be cut. SchemaLinker instead scores each table and table.column for the question and
+writes the most likely ones, best first, in the same "Schema: table(col, ...); ..."
+format until a token budget is spent. The score of a schema item is the larger of:
+
+    * a lexical match: all words of the item's name (or its description in the schema
+      file) appear in the question, after the phrase rewrites in alignment.txt
+    * co-occurrence: max over the question's words w of P(item used in the SQL | w in
+      the question), mined from train.nl / train.sql
+
+Run as a script to report gold table/column recall and schema length on dev.
+"""
+
+import os
+import re
+import json
+from collections import Counter, defaultdict
+
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+ALIAS_PATTERN = re.compile(r"\b([a-z_]+)_\d+\b")
+COLUMN_PATTERN = re.compile(r"\b([a-z_]+)_\d+\.([a-z_]+)\b")
+
+def sql_schema_items(sql_query):
+    '''
+    Tables and (table, column) pairs a gold query uses (all ATIS tables are aliased table_n).
+    '''
+    tables = set(ALIAS_PATTERN.findall(sql_query))
+    columns = {(table, column) for table, column in COLUMN_PATTERN.findall(sql_query)}
+    return tables, columns
+
+class SchemaLinker:
+
+    def __init__(self, data_folder, tokenizer, token_budget, nl_folder=None,
+                 min_word_count=3, table_threshold=0.1, column_threshold=0.1):
+        '''
+        data_folder holds the schema, alignment.txt and train.sql; nl_folder (default
+        data_folder) the train.nl the questions will look like (e.g. preprocessed).
+        token_budget is in tokenizer tokens for the whole schema string.
+        '''
+        self.tokenizer = tokenizer
+        self.token_budget = token_budget
+        self.min_word_count = min_word_count
+        self.table_threshold = table_threshold
+        self.column_threshold = column_threshold
+
+        with open(os.path.join(data_folder, 'flight_database.schema'), 'r') as f:
+            schema = json.load(f)
+        self.tables = {table: list(columns) for table, columns in schema['ents'].items()}
+
+        # Words that name each item: identifier parts plus the schema's descriptions
+        self.item_words = {}
+        for table, columns in schema['ents'].items():
+            table_utt = schema.get('defaults', {}).get(table, {}).get('utt', '')
+            self.item_words[table] = [set(table.split('_')), set(WORD_PATTERN.findall(table_utt))]
+            for column, info in columns.items():
+                self.item_words[(table, column)] = [set(column.split('_')), set(WORD_PATTERN.findall(info.get('utt', '')))]
+
+        self.alignments = []
+        alignment_path = os.path.join(data_folder, 'alignment.txt')
+        if os.path.exists(alignment_path):
+            with open(alignment_path, 'r') as f:
+                for line in f:
+                    if '\t' in line:
+                        phrase, replacement = line.rstrip('\n').split('\t', 1)
+                        self.alignments.append((re.compile(rf"\b{re.escape(phrase)}\b"), replacement))
+
+        with open(os.path.join(nl_folder or data_folder, 'train.nl'), 'r') as f:
+            nl_queries = [line.strip() for line in f.readlines()]
+        with open(os.path.join(data_folder, 'train.sql'), 'r') as f:
+            sql_queries = [line.strip() for line in f.readlines()]
+        self.mine_cooccurrence(nl_queries, sql_queries)
+
+        # Token cost of each fragment of the schema string, so budgets are cheap to check
+        self.header_cost = self.count_tokens("Schema:")
+        self.table_cost = {table: self.count_tokens(f"; {table}()") for table in self.tables}
+        self.column_cost = {(table, column): self.count_tokens(f", {column}")
+                            for table, columns in self.tables.items() for column in columns}
+
+    def count_tokens(self, text):
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+    def question_words(self, nl_query):
+        nl_query = nl_query.lower()
+        for pattern, replacement in self.alignments:
+            nl_query = pattern.sub(replacement, nl_query)
+        return set(WORD_PATTERN.findall(nl_query))
+
+    def mine_cooccurrence(self, nl_queries, sql_queries):
+        '''
+        P(item | word) for every question word seen at least min_word_count times.
+        '''
+        word_counts = Counter()
+        item_counts = defaultdict(Counter)
+        for nl_query, sql_query in zip(nl_queries, sql_queries):
+            tables, columns = sql_schema_items(sql_query)
+            items = tables | columns
+            for word in self.question_words(nl_query):
+                word_counts[word] += 1
+                item_counts[word].update(items)
+        self.item_given_word = {
+            word: {item: count / word_counts[word] for item, count in item_counts[word].items()}
+            for word in word_counts if word_counts[word] >= self.min_word_count
+        }
+
+    def score_items(self, nl_query):
+        words = self.question_words(nl_query)
+        scores = defaultdict(float)
+        for word in words:
+            for item, probability in self.item_given_word.get(word, {}).items():
+                scores[item] = max(scores[item], probability)
+        for item, names in self.item_words.items():
+            if any(name and name <= words for name in names):
+                scores[item] = max(scores[item], 1.0)
+        return scores
+
+    def link(self, nl_query):
+        '''
+        Schema string for nl_query: likely tables (best first) with their likely columns,
+        within the token budget.
+        '''
+        scores = self.score_items(nl_query)
+        tables = sorted((table for table in self.tables if scores[table] >= self.table_threshold),
+                        key=lambda table: -scores[table])
+
+        parts = []
+        cost = self.header_cost
+        for table in tables:
+            columns = sorted((column for column in self.tables[table] if scores[(table, column)] >= self.column_threshold),
+                             key=lambda column: -scores[(table, column)])
+            if cost + self.table_cost[table] > self.token_budget:
+                continue
+            cost += self.table_cost[table]
+            kept = []
+            for column in columns:
+                if cost + self.column_cost[(table, column)] > self.token_budget:
+                    break
+                cost += self.column_cost[(table, column)]
+                kept.append(column)
+            parts.append(f"{table}({', '.join(kept)})")
+        return "Schema: " + "; ".join(parts)
+
+if __name__ == "__main__":
+    import argparse
+    from transformers import T5TokenizerFast
+    from load_data import T5Dataset
+
+    parser = argparse.ArgumentParser(description='Schema linker recall and length on dev')
+    parser.add_argument('--token_budget', type=int, default=160, help="Schema token budget")
+    args = parser.parse_args()
+
+    tokenizer = T5TokenizerFast.from_pretrained('google-t5/t5-small')
+    linker = SchemaLinker('data', tokenizer, args.token_budget)
+    static_schema = T5Dataset.load_schema(None, os.path.join('data', 'flight_database.schema'))
+    static_tokens = linker.count_tokens(static_schema)
+
+    with open(os.path.join('data', 'dev.nl'), 'r') as f:
+        nl_queries = [line.strip() for line in f.readlines()]
+    with open(os.path.join('data', 'dev.sql'), 'r') as f:
+        sql_queries = [line.strip() for line in f.readlines()]
+
+    def recall(schema):
+        # Fraction of queries whose gold tables / columns all appear in schema
+        listed = {table: set(columns.split(', ')) for table, columns in re.findall(r"(\w+)\(([^)]*)\)", schema)}
+        def covered(sql_query):
+            tables, columns = sql_schema_items(sql_query)
+            return (all(table in listed for table in tables),
+                    all(column in listed.get(table, ()) for table, column in columns))
+        return covered
+
+    linked_tokens, static_covered, linked_covered = [], [], []
+    static_recall = recall(static_schema)
+    for nl_query, sql_query in zip(nl_queries, sql_queries):
+        schema = linker.link(nl_query)
+        linked_tokens.append(linker.count_tokens(schema))
+        static_covered.append(static_recall(sql_query))
+        linked_covered.append(recall(schema)(sql_query))
+
+    print("\n" + "="*80)
+    print(f"SCHEMA LINKING (dev, budget {args.token_budget} tokens)")
+    print("="*80)
+    print(f"{'Schema':<8} {'Tokens':>8} {'Tables recall':>14} {'Columns recall':>15}")
+    for name, tokens, covered in (('static', [static_tokens] * len(nl_queries), static_covered),
+                                  ('linked', linked_tokens, linked_covered)):
+        print(f"{name:<8} {sum(tokens) / len(tokens):>8.1f} {100 * sum(c[0] for c in covered) / len(covered):>13.1f}% "
+              f"{100 * sum(c[1] for c in covered) / len(covered):>14.1f}%")
+    print(f"\nSchema tokens: -{100 * (1 - sum(linked_tokens) / len(linked_tokens) / static_tokens):.1f}%")
+    print("="*80 + "\n")
@@ -0,0 +1,153 @@
+"""
+Reversible compact form of the ATIS gold SQL, used as the T5 decoder target.
+
+The gold queries spell out a lot that the schema already determines:
+
+    FROM flight flight_1 , city city_1         ->  FROM flight_1 , city_1
+    flight_1.flight_days = days_1.days_code    ->  flight_1.flight_days = days_1
+    flight_1.from_airport = airport_service_1.airport_code
+        AND airport_service_1.city_code = city_1.city_code
+                                               ->  flight_1.from_airport = city_1
+    AND 1 = 1                                  ->  AND TRUE
+
+Every rule is undone by expand_sql(), which leaves uncompressed SQL unchanged. So
+compress_sql() keeps the original query whenever its compact form does not expand
+back exactly, and any model output (compressed or not) can be passed to expand_sql().
+
+Run as a script to check the round trip on all train/dev gold queries.
+"""
+
+import os
+import re
+
+# Foreign-key joins: (left table, left column, right table) -> right column. The right
+# column is dropped from `left_n.column = right_m.column` and restored on expansion.
+JOIN_COLUMNS = {
+    ('airport_service', 'city_code', 'city'): 'city_code',
+    ('flight', 'from_airport', 'airport_service'): 'airport_code',
+    ('flight', 'to_airport', 'airport_service'): 'airport_code',
+    ('flight', 'flight_days', 'days'): 'days_code',
+    ('days', 'day_name', 'date_day'): 'day_name',
+    ('fare', 'fare_id', 'flight_fare'): 'fare_id',
+    ('flight_fare', 'flight_id', 'flight'): 'flight_id',
+    ('flight', 'flight_id', 'flight_fare'): 'flight_id',
+    ('flight_fare', 'fare_id', 'fare'): 'fare_id',
+    ('fare', 'fare_basis_code', 'fare_basis'): 'fare_basis_code',
+    ('flight', 'flight_id', 'flight_stop'): 'flight_id',
+    ('flight_stop', 'stop_airport', 'airport_service'): 'airport_code',
+    ('ground_service', 'city_code', 'city'): 'city_code',
+    ('airline', 'airline_code', 'flight'): 'airline_code',
+    ('ground_service', 'airport_code', 'airport'): 'airport_code',
+    ('flight', 'meal_code', 'food_service'): 'meal_code',
+    ('fare_basis', 'basis_days', 'days'): 'days_code',
+    ('airport', 'airport_code', 'airport_service'): 'airport_code',
+    ('flight', 'to_airport', 'airport'): 'airport_code',
+    ('flight', 'from_airport', 'airport'): 'airport_code',
+    ('city', 'state_code', 'state'): 'state_code',
+    ('aircraft', 'aircraft_code', 'equipment_sequence'): 'aircraft_code',
+    ('equipment_sequence', 'aircraft_code_sequence', 'flight'): 'aircraft_code_sequence',
+    ('flight', 'aircraft_code_sequence', 'equipment_sequence'): 'aircraft_code_sequence',
+    ('equipment_sequence', 'aircraft_code', 'aircraft'): 'aircraft_code',
+    ('airport_service', 'airport_code', 'airport'): 'airport_code',
+    ('flight_leg', 'flight_id', 'flight'): 'flight_id',
+    ('fare', 'from_airport', 'airport_service'): 'airport_code',
+    ('fare', 'to_airport', 'airport_service'): 'airport_code',
+    ('city', 'city_code', 'airport_service'): 'city_code',
+}
+
+# `x.col = airport_service_n.airport_code AND airport_service_n.city_code = city_n.city_code`
+CITY_CHAIN = re.compile(
+    r"\b([a-z_]+)_(\d+)\.(\w+) = airport_service_(\d+)\.airport_code "
+    r"AND airport_service_\4\.city_code = city_\4\.city_code\b"
+)
+JOIN = re.compile(r"\b([a-z_]+)_(\d+)\.(\w+) = ([a-z_]+)_(\d+)\.(\w+)\b")
+FROM_ITEM = re.compile(r"(FROM |, )([a-z_]+) \2_(\d+)\b")
+TAUTOLOGY = re.compile(r"\b1 = 1\b")
+
+COMPACT_JOIN = re.compile(r"\b([a-z_]+)_(\d+)\.(\w+) = ([a-z_]+)_(\d+)(?![\w.])")
+COMPACT_FROM_ITEM = re.compile(r"(FROM |, )([a-z_]+)_(\d+)(?![\w.])")
+COMPACT_TAUTOLOGY = re.compile(r"\bTRUE\b")
+
+def _compress_city_chain(match):
+    table, index, column, service_index = match.groups()
+    if (table, column, 'city') in JOIN_COLUMNS:
+        # `x.col = city_n` already means a direct join for this column
+        return match.group()
+    return f"{table}_{index}.{column} = city_{service_index}"
+
+def _compress_join(match):
+    left_table, left_index, left_column, right_table, right_index, right_column = match.groups()
+    if JOIN_COLUMNS.get((left_table, left_column, right_table)) != right_column:
+        return match.group()
+    return f"{left_table}_{left_index}.{left_column} = {right_table}_{right_index}"
+
+def _expand_join(match):
+    left_table, left_index, left_column, right_table, right_index = match.groups()
+    left = f"{left_table}_{left_index}.{left_column}"
+    right_column = JOIN_COLUMNS.get((left_table, left_column, right_table))
+    if right_column is not None:
+        return f"{left} = {right_table}_{right_index}.{right_column}"
+    if right_table == 'city':
+        return (f"{left} = airport_service_{right_index}.airport_code "
+                f"AND airport_service_{right_index}.city_code = city_{right_index}.city_code")
+    return match.group()
+
+def _compress(sql_query):
+    sql_query = CITY_CHAIN.sub(_compress_city_chain, sql_query)
+    sql_query = JOIN.sub(_compress_join, sql_query)
+    sql_query = FROM_ITEM.sub(r"\1\2_\3", sql_query)
+    return TAUTOLOGY.sub("TRUE", sql_query)
+
+def compress_sql(sql_query):
+    '''
+    Compact form of sql_query, or sql_query itself if the compact form would not
+    expand back to it exactly.
+    '''
+    compressed = _compress(sql_query)
+    return compressed if expand_sql(compressed) == sql_query else sql_query
+
+def expand_sql(sql_query):
+    '''
+    Executable SQL for a compact (or already executable) query.
+    '''
+    sql_query = COMPACT_TAUTOLOGY.sub("1 = 1", sql_query)
+    sql_query = COMPACT_FROM_ITEM.sub(r"\1\2 \2_\3", sql_query)
+    return COMPACT_JOIN.sub(_expand_join, sql_query)
+
+def verify_round_trip(sql_queries):
+    '''
+    Returns (number of queries compressed, list of queries that are not).
+    '''
+    compressed, unchanged = 0, []
+    for sql_query in sql_queries:
+        if compress_sql(sql_query) != sql_query:
+            compressed += 1
+        else:
+            unchanged.append(sql_query)
+    return compressed, unchanged
+
+if __name__ == "__main__":
+    from sql_tokenizer import split_units
+
+    print("\n" + "="*80)
+    print("SQL TARGET COMPRESSION")
+    print("="*80)
+    for split in ('train', 'dev'):
+        with open(os.path.join('data', f'{split}.sql'), 'r') as f:
+            sql_queries = [line.strip() for line in f.readlines()]
+        compressed, unchanged = verify_round_trip(sql_queries)
+        # compress_sql only ever returns round-trip-exact forms; this re-checks the claim
+        mismatches = sum(expand_sql(compress_sql(q)) != q for q in sql_queries)
+        chars = sum(len(q) for q in sql_queries)
+        compressed_chars = sum(len(compress_sql(q)) for q in sql_queries)
+        units = sum(len(split_units(q)) for q in sql_queries)
+        compressed_units = sum(len(split_units(compress_sql(q))) for q in sql_queries)
+
+        status = "✓" if mismatches == 0 else "⚠"
+        print(f"{status} {split}: {compressed}/{len(sql_queries)} compressed, {len(unchanged)} kept as is, "
+              f"{mismatches} round-trip mismatches")
+        print(f"  Characters: {chars / len(sql_queries):.1f} -> {compressed_chars / len(sql_queries):.1f} "
+              f"({100 * (1 - compressed_chars / chars):.1f}% shorter)")
+        print(f"  SQL units:  {units / len(sql_queries):.1f} -> {compressed_units / len(sql_queries):.1f} "
+              f"({100 * (1 - compressed_units / units):.1f}% shorter)")
+    print("="*80 + "\n")
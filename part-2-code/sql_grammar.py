@@ -0,0 +1,612 @@
+"""
+Grammar- and schema-constrained decoding for the SQL decoder.
+
+An incremental, character-level recognizer for the SQL the ATIS queries use. It checks
+the output as it is generated, so the decoder can only emit prefixes of queries that
+parse and name real tables and columns:
+
+    SELECT [DISTINCT] item , ... FROM from_item , ... [WHERE condition]
+        [GROUP BY column , ...] [ORDER BY column [ASC | DESC] , ...]
+
+    * select items are alias.column, * or an aggregate (COUNT, MIN, MAX, AVG, SUM) of
+      [DISTINCT] alias.column, a bare column or *
+    * FROM items are "table table_n", a bare table or a bare alias table_n (compressed
+      SQL), where table is a table of flight_database.schema
+    * conditions are predicates joined by AND / OR, negated with NOT or parenthesized:
+      comparisons, [NOT] BETWEEN .. AND .., IS [NOT] NULL, [NOT] LIKE, TRUE / FALSE;
+      a subquery in parentheses follows a comparison, IN, ALL or ANY
+    * operands are alias.column with column a column of that alias's table, a bare
+      alias (compressed joins), numbers, quoted strings and anonymized-literal placeholders
+    * aliases have to be declared by a FROM clause, once per clause (subqueries may
+      redeclare outer aliases): a select list may name the aliases its FROM clause
+      declares next, conditions only aliases declared before them
+    * parentheses balance and the query is complete before EOS
+
+The recognizer state has two parts. The syntactic state (mode, open parentheses, FROM
+table, partial word) moves one character at a time; a partial word is checked with a
+set lookup in the precomputed prefixes of the keywords, tables and columns. The alias
+scope (declared aliases, aliases a select list used before their declaration, aliases
+of the FROM clause being read) changes
+at a few words only, so a step returns its effects on the scope (use, declare, ...)
+rather than carrying it. For each syntactic state, SQLGrammar caches the allowed tokens
+grouped by their effects, found by walking a character trie of the vocabulary alongside
+the recognizer and pruning a subtree at its first rejected character. The mask of a
+state is the union of the groups its scope allows. A token that ends inside a word is
+only allowed if the vocabulary can complete that word (a restricted vocabulary may not),
+so rows cannot steer into dead ends. Decoding is repetitive, so the token groups are
+shared by most steps and most batch rows.
+
+SQLGrammar.logits_processor() plugs into model.generate (greedy and beam search) and
+static_decoder.StaticCacheDecoder. A state without any allowed token, or a row that left
+the grammar, is not masked.
+
+Run as a script to check that the gold train/dev queries (plain and compressed) are
+accepted and queries with unknown columns or malformed syntax rejected.
+"""
+
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+
+import torch
+from transformers import LogitsProcessor
+
+AGGREGATES = ['COUNT', 'MIN', 'MAX', 'AVG', 'SUM']
+COMPARISONS = ['=', '<', '>', '<=', '>=', '!=', '<>']
+MAX_ALIAS = 9  # table_1 .. table_9
+MAX_DEPTH = 16  # open parentheses (the gold queries nest up to 8)
+MASK_CACHE_SIZE = 1024  # masks of the most recent states
+NUMBER = re.compile(r"\d+(\.\d*)?")
+
+# Keywords each mode accepts (upper or lower case) and the mode they lead to
+FROM_END = {'WHERE': 'pred', 'GROUP': 'group_by', 'ORDER': 'order_by'}
+KEYWORD_MODES = {
+    'query_start': {'SELECT': 'select_start'},
+    'select_start': {'DISTINCT': 'select_item', **{name: 'call_open' for name in AGGREGATES}},
+    'select_item': {name: 'call_open' for name in AGGREGATES},
+    'after_select_item': {'FROM': 'from_item'},
+    'call_arg_start': {'DISTINCT': 'call_arg'},
+    'after_table': FROM_END,
+    'after_from_item': FROM_END,
+    'pred': {'NOT': 'pred', 'TRUE': 'after_pred', 'FALSE': 'after_pred'},
+    'after_left': {'BETWEEN': 'between_low', 'NOT': 'after_left_not', 'IS': 'is', 'LIKE': 'like', 'IN': 'in'},
+    'after_left_not': {'BETWEEN': 'between_low', 'LIKE': 'like', 'IN': 'in'},
+    'right': {'ALL': 'in', 'ANY': 'in'},
+    'between_and': {'AND': 'between_high'},
+    'is': {'NOT': 'is_not', 'NULL': 'after_pred'},
+    'is_not': {'NULL': 'after_pred'},
+    'after_pred': {'AND': 'pred', 'OR': 'pred', 'GROUP': 'group_by', 'ORDER': 'order_by'},
+    'group_by': {'BY': 'group_item'},
+    'order_by': {'BY': 'order_item'},
+    'after_group_item': {'ORDER': 'order_by'},
+    'after_order_item': {'ASC': 'after_order_dir', 'DESC': 'after_order_dir'},
+}
+# Operands each mode accepts and the mode they lead to. 'column': alias.column;
+# 'argument': also a bare column; 'value': alias.column, a bare alias, a number, a
+# string or a placeholder
+OPERAND_MODES = {
+    'select_start': ('column', 'after_select_item'),
+    'select_item': ('column', 'after_select_item'),
+    'call_arg_start': ('argument', 'call_end'),
+    'call_arg': ('argument', 'call_end'),
+    'pred': ('value', 'after_left'),
+    'right': ('value', 'after_pred'),
+    'between_low': ('value', 'between_and'),
+    'between_high': ('value', 'after_pred'),
+    'like': ('value', 'after_pred'),
+    'group_item': ('column', 'after_group_item'),
+    'order_item': ('column', 'after_order_item'),
+}
+# Select lists name aliases their FROM clause declares next
+SELECT_MODES = {'select_start', 'select_item', 'call_arg_start', 'call_arg'}
+QUERY_END_MODES = {'after_table', 'after_from_item', 'after_pred', 'after_group_item', 'after_order_item', 'after_order_dir'}
+LIST_MODES = {'after_select_item': 'select_item', 'after_table': 'from_item', 'after_from_item': 'from_item',
+              'after_group_item': 'group_item', 'after_order_item': 'order_item', 'after_order_dir': 'order_item'}
+CLOSE = ('close', None)  # effect: the FROM clause ends, every alias the select list named is declared
+
+def char_class(char):
+    if char.isspace():
+        return 'space'
+    if char.isascii() and (char.isalnum() or char == '_' or char == '.'):
+        return 'word'
+    if char in '<>=!':
+        return 'operator'
+    if char in '(),*;':
+        return 'punctuation'
+    if char == "'":
+        return 'quote'
+    return None
+
+def with_prefixes(words):
+    return {word[:i] for word in words for i in range(1, len(word) + 1)}
+
+class SQLGrammar:
+
+    def __init__(self, tables, token_strings, eos_token_id=1, placeholder_types=()):
+        '''
+        tables: {table: [columns]}. token_strings[i]: the text decoder id i adds to the
+        output (None for ids the decoder should never emit). placeholder_types: literal
+        types of an anonymizer (CITY, NUM, ...), whose placeholders may appear unquoted.
+        '''
+        self.tables = tables
+        self.eos_token_id = eos_token_id
+        self.vocab_size = len(token_strings)
+
+        self.aliases = {f"{table}_{n}": table for table in tables for n in range(1, MAX_ALIAS + 1)}
+        self.placeholders = {f"{value_type}{n}" for value_type in placeholder_types for n in range(10)}
+        self.bare_columns = {column for columns in tables.values() for column in columns}
+        # Prefixes of the valid words, so a partial word is checked with a set lookup
+        self.keyword_prefixes = {mode: with_prefixes(set(keywords) | {keyword.lower() for keyword in keywords})
+                                 for mode, keywords in KEYWORD_MODES.items()}
+        self.comparison_prefixes = with_prefixes(COMPARISONS)
+        self.from_prefixes = with_prefixes(set(tables) | set(self.aliases))
+        self.table_prefixes = with_prefixes(tables)
+        self.alias_prefixes = with_prefixes(self.aliases)
+        self.column_prefixes = {table: with_prefixes(columns) | {''} for table, columns in tables.items()}
+        self.bare_column_prefixes = with_prefixes(self.bare_columns)
+        self.placeholder_prefixes = with_prefixes(self.placeholders)
+
+        # Character trie of the vocabulary: node = (ids ending here, {char: child})
+        self.vocab_trie = ([], {})
+        for token_id, text in enumerate(token_strings):
+            if text:
+                node = self.vocab_trie
+                for char in text:
+                    node = node[1].setdefault(char, ([], {}))
+                node[0].append(token_id)
+        self.token_strings = token_strings
+
+        # Syntactic state: (mode, open parentheses, FROM table, partial word). State:
+        # (syntactic state, declared aliases, aliases used before their declaration, aliases
+        # of the open FROM clause)
+        self.start_state = (('query_start', (), None, ''), frozenset(), frozenset(), frozenset())
+        self.transitions = {}  # (syntactic state, char) -> (syntactic state, effects) or None
+        self.token_transitions = {}  # (syntactic state, token id) -> (syntactic state, effects) or None
+        self.token_groups = {}  # syntactic state -> {effects: allowed decoder ids}
+        self.viable_states = {}  # syntactic state -> whether a token continues its partial word
+        self.masks = OrderedDict()  # state -> bool mask over the vocabulary, or None (unconstrained)
+        self.mask_time = 0.0
+        self.mask_calls = 0
+
+    @classmethod
+    def from_schema(cls, tokenizer, schema_path=os.path.join('data', 'flight_database.schema'), token_ids=None,
+                    placeholder_types=(), vocab_size=None):
+        '''
+        token_ids: full-vocabulary id of each decoder id (t5_utils.restrict_output_vocab),
+        default the identity over vocab_size ids (the model's, which may exceed the tokenizer's).
+        '''
+        with open(schema_path, 'r') as f:
+            tables = {table: list(columns) for table, columns in json.load(f)['ents'].items()}
+        if token_ids is None:
+            token_ids = range(vocab_size or len(tokenizer))
+        special = set(tokenizer.all_special_ids)
+        pieces = tokenizer.convert_ids_to_tokens([i for i in token_ids if i < len(tokenizer)])
+        pieces += [None] * (len(token_ids) - len(pieces))
+        token_strings = [piece.replace('▁', ' ') if piece is not None and int(i) not in special else None
+                         for i, piece in zip(token_ids, pieces)]
+        eos_token_id = list(map(int, token_ids)).index(tokenizer.eos_token_id)
+        return cls(tables, token_strings, eos_token_id, placeholder_types)
+
+    @classmethod
+    def for_model(cls, model, tokenizer, anonymizer=None, schema_path=os.path.join('data', 'flight_database.schema')):
+        '''
+        Grammar over the decoder ids of model (restricted vocabulary or not), allowing the
+        placeholders of anonymizer (models trained with --anonymize_literals).
+        '''
+        from t5_utils import unwrap_model, has_restricted_vocab
+        model = unwrap_model(model)
+        token_ids = model.output_vocab.tolist() if has_restricted_vocab(model) else None
+        placeholder_types = ()
+        if anonymizer is not None:
+            placeholder_types = {value_type for value_type, _ in anonymizer.values.values()} | {'NUM'}
+        return cls.from_schema(tokenizer, schema_path, token_ids, placeholder_types, model.config.vocab_size)
+
+    def keyword(self, mode, word):
+        if word != word.upper() and word != word.lower():
+            return None
+        return KEYWORD_MODES.get(mode, {}).get(word.upper())
+
+    def valid_operand_prefix(self, kind, word):
+        if word[0].isdigit():
+            return kind == 'value' and NUMBER.fullmatch(word) is not None
+        if kind == 'argument' and word in self.bare_column_prefixes:
+            return True
+        if kind == 'value' and word in self.placeholder_prefixes:
+            return True
+        alias, dot, column = word.partition('.')
+        if not dot:
+            return alias in self.alias_prefixes
+        return alias in self.aliases and column in self.column_prefixes[self.aliases[alias]]
+
+    def valid_prefix(self, syntax, word):
+        mode, _, table, _ = syntax
+        if char_class(word[0]) == 'operator':
+            return mode == 'after_left' and word in self.comparison_prefixes
+        if word in self.keyword_prefixes.get(mode, ()):
+            return True
+        if mode == 'from_item':
+            return word in self.from_prefixes
+        if mode == 'after_table':
+            return any(f"{table}_{n}".startswith(word) for n in range(1, MAX_ALIAS + 1))
+        if mode in OPERAND_MODES:
+            return self.valid_operand_prefix(OPERAND_MODES[mode][0], word)
+        return False
+
+    def alias_effect(self, mode, alias):
+        # Select lists may name an alias before their FROM clause declares it
+        return ('pend' if mode in SELECT_MODES else 'use', alias)
+
+    def complete(self, syntax):
+        '''
+        (Syntactic state, effects) after the partial word of syntax ends, or None if it is
+        not a valid word.
+        '''
+        mode, stack, table, word = syntax
+        if not word:
+            return syntax, ()
+        if char_class(word[0]) == 'operator':
+            return (('right', stack, None, ''), ()) if mode == 'after_left' and word in COMPARISONS else None
+        if word == "''":  # a closed string (quotes only open in value modes)
+            return (OPERAND_MODES[mode][1], stack, None, ''), ()
+
+        next_mode = self.keyword(mode, word)
+        if next_mode is not None:
+            if next_mode in ('group_by', 'order_by') and stack and stack[-1] == 'group':
+                return None
+            return (next_mode, stack, None, ''), (CLOSE,) if mode in ('after_table', 'after_from_item') else ()
+
+        if mode == 'from_item':
+            if word in self.tables:
+                return ('after_table', stack, word, ''), ()
+            return (('after_from_item', stack, None, ''), (('declare', word),)) if word in self.aliases else None
+        if mode == 'after_table':
+            return (('after_from_item', stack, None, ''), (('declare', word),)) if self.aliases.get(word) == table else None
+
+        if mode not in OPERAND_MODES:
+            return None
+        kind, next_mode = OPERAND_MODES[mode]
+        next_syntax = (next_mode, stack, None, '')
+        if word[0].isdigit():
+            return (next_syntax, ()) if kind == 'value' and NUMBER.fullmatch(word) else None
+        if (kind == 'value' and word in self.placeholders) or (kind == 'argument' and word in self.bare_columns):
+            return next_syntax, ()
+        alias, dot, column = word.partition('.')
+        if dot:  # the alias took effect when '.' was typed
+            return (next_syntax, ()) if column in self.tables[self.aliases[alias]] else None
+        return (next_syntax, (self.alias_effect(mode, alias),)) if kind == 'value' and alias in self.aliases else None
+
+    def step(self, syntax, char):
+        '''
+        (Syntactic state, effects) after appending char to the output, or None if no valid
+        query continues it.
+        '''
+        key = (syntax, char)
+        if key not in self.transitions:
+            self.transitions[key] = self._step(syntax, char)
+        return self.transitions[key]
+
+    def _step(self, syntax, char):
+        mode, stack, table, word = syntax
+        if word == "'":  # inside a string literal
+            return ((mode, stack, table, "''"), ()) if char == "'" else (syntax, ())
+        kind = char_class(char)
+        if kind is None:
+            return None
+        if word and word != "''" and kind == char_class(word[0]):
+            word += char
+            if not self.valid_prefix(syntax, word):
+                return None
+            if word[0].isdigit():
+                return (mode, stack, table, '0.' if '.' in word else '0'), ()  # one state for all numbers
+            effects = (self.alias_effect(mode, word[:-1]),) if char == '.' else ()
+            return (mode, stack, table, word), effects
+
+        effects = ()
+        if word:
+            completed = self.complete(syntax)
+            if completed is None:
+                return None
+            syntax, effects = completed
+            mode, stack, table, word = syntax
+        if kind == 'space':
+            return syntax, effects
+        if kind in ('word', 'operator'):
+            if not self.valid_prefix(syntax, char):
+                return None
+            return (mode, stack, table, '0' if char.isdigit() else char), effects
+        if kind == 'quote':
+            return ((mode, stack, table, "'"), effects) if OPERAND_MODES.get(mode, ('',))[0] == 'value' else None
+        punctuation = self.punctuation(syntax, char)
+        return (punctuation[0], effects + punctuation[1]) if punctuation is not None else None
+
+    def punctuation(self, syntax, char):
+        mode, stack, _, _ = syntax
+        if char == '(':
+            if len(stack) >= MAX_DEPTH:
+                return None
+            if mode == 'pred':
+                return ('pred', stack + ('group',), None, ''), ()
+            if mode in ('right', 'in'):
+                return ('query_start', stack + ('subquery',), None, ''), ()
+            if mode == 'call_open':
+                return ('call_arg_start', stack + ('call',), None, ''), ()
+            return None
+        if char == ')':
+            if not stack:
+                return None
+            if stack[-1] == 'group':
+                return (('after_pred', stack[:-1], None, ''), ()) if mode == 'after_pred' else None
+            if stack[-1] == 'subquery':
+                return (('after_pred', stack[:-1], None, ''), (CLOSE,)) if mode in QUERY_END_MODES else None
+            return (('after_select_item', stack[:-1], None, ''), ()) if mode == 'call_end' else None
+        if char == ',':
+            return ((LIST_MODES[mode], stack, None, ''), ()) if mode in LIST_MODES else None
+        if char == ';':
+            return (('end', stack, None, ''), (CLOSE,)) if mode in QUERY_END_MODES and not stack else None
+        # '*': the select list or count( * )
+        if mode in ('select_start', 'select_item'):
+            return ('after_select_item', stack, None, ''), ()
+        if mode in ('call_arg_start', 'call_arg'):
+            return ('call_end', stack, None, ''), ()
+        return None
+
+    def end_effects(self, syntax):
+        '''
+        Effects of ending the query after syntax, or None if it cannot end there.
+        '''
+        completed = self.complete(syntax)
+        if completed is None:
+            return None
+        (mode, stack, _, _), effects = completed
+        if mode == 'end':
+            return effects
+        return effects + (CLOSE,) if mode in QUERY_END_MODES and not stack else None
+
+    def token_end_effects(self, syntax):
+        # Effects a token ending in a partial word commits to: a word that can only become
+        # a keyword ending the FROM clause closes it, one that can only become a FROM alias
+        # needs an alias with that prefix the clause has not declared, one that can only
+        # become an alias of a condition a declared one
+        mode, _, table, word = syntax
+        if mode == 'from_item' and word and word not in self.table_prefixes:
+            return (('fresh', tuple(alias for alias in self.aliases if alias.startswith(word))),)
+        if mode in ('after_table', 'after_from_item') and word:
+            candidates = tuple(alias for alias in (f"{table}_{n}" for n in range(1, MAX_ALIAS + 1)) if alias.startswith(word))
+            return (('fresh', candidates),) if mode == 'after_table' and candidates else (CLOSE,)
+        if (not word or mode not in OPERAND_MODES or mode in SELECT_MODES or char_class(word[0]) != 'word'
+                or word[0].isdigit() or '.' in word or word in self.keyword_prefixes.get(mode, ())):
+            return ()
+        kind = OPERAND_MODES[mode][0]
+        if (kind == 'value' and word in self.placeholder_prefixes) or (kind == 'argument' and word in self.bare_column_prefixes):
+            return ()
+        return (('prefix', word),)
+
+    def apply(self, scope, effects):
+        '''
+        Scope (declared aliases, aliases used before their declaration, aliases of the open
+        FROM clause) after effects, or None if one of them is not allowed in scope.
+        '''
+        declared, pending, clause = scope
+        for effect, alias in effects:
+            if effect == 'use' and alias not in declared:
+                return None
+            if effect == 'pend' and alias not in declared:
+                pending = pending | {alias}
+            if effect == 'declare':
+                if alias in clause:
+                    return None
+                declared, pending, clause = declared | {alias}, pending - {alias}, clause | {alias}
+            if effect == 'close':
+                if pending:
+                    return None
+                clause = frozenset()
+            if effect == 'prefix' and not any(name.startswith(alias) for name in declared):
+                return None
+            if effect == 'fresh' and clause.issuperset(alias):  # alias: the candidate aliases
+                return None
+        return declared, pending, clause
+
+    def token_transition(self, syntax, token_id):
+        key = (syntax, token_id)
+        if key not in self.token_transitions:
+            text = self.token_strings[token_id] if token_id < self.vocab_size else None
+            transition = None
+            if text:
+                transition, effects = (syntax, ()), ()
+                for char in text:
+                    transition = self.step(transition[0], char)
+                    if transition is None:
+                        break
+                    effects += transition[1]
+                else:
+                    transition = (transition[0], effects + self.token_end_effects(transition[0]))
+            self.token_transitions[key] = transition
+        return self.token_transitions[key]
+
+    def advance(self, state, token_id):
+        '''
+        State after decoder id token_id, or None once the output leaves the grammar.
+        '''
+        transition = self.token_transition(state[0], token_id)
+        if transition is None:
+            return None
+        scope = self.apply(state[1:], transition[1])
+        return (transition[0],) + scope if scope is not None else None
+
+    def viable(self, syntax):
+        '''
+        Whether the partial word of syntax can be completed with decoder ids of the
+        (restricted) vocabulary: some token reaches a word boundary, EOS, or a viable
+        partial word. Tokens that end inside a dead-end word are not allowed, since a later
+        step would have nothing to allow. States being explored count as viable (cycles).
+        '''
+        if syntax not in self.viable_states:
+            self.viable_states[syntax] = True
+            viable = self.end_effects(syntax) is not None
+            stack = [(self.vocab_trie, syntax)]
+            while stack and not viable:
+                (ids, children), node = stack.pop()
+                if ids and node != syntax:
+                    viable = not node[3] or self.viable(node)
+                for char, child in children.items():
+                    transition = self.step(node, char)
+                    if transition is not None:
+                        stack.append((child, transition[0]))
+            self.viable_states[syntax] = viable
+        return self.viable_states[syntax]
+
+    def groups(self, syntax):
+        '''
+        {effects: decoder ids} of the tokens allowed after syntax (EOS under the effects
+        of ending the query).
+        '''
+        if syntax not in self.token_groups:
+            groups = {}
+            stack = [(self.vocab_trie, syntax, ())]
+            while stack:
+                (ids, children), node, effects = stack.pop()
+                if ids and (node == syntax or not node[3] or self.viable(node)):
+                    groups.setdefault(effects + self.token_end_effects(node), []).extend(ids)
+                for char, child in children.items():
+                    transition = self.step(node, char)
+                    if transition is not None:
+                        stack.append((child, transition[0], effects + transition[1]))
+            end_effects = self.end_effects(syntax)
+            if end_effects is not None:
+                groups.setdefault(end_effects, []).append(self.eos_token_id)
+            self.token_groups[syntax] = {effects: torch.tensor(ids) for effects, ids in groups.items()}
+        return self.token_groups[syntax]
+
+    def mask(self, state):
+        '''
+        Bool mask of the decoder ids allowed after state (None: no constraint).
+        '''
+        if state in self.masks:
+            self.masks.move_to_end(state)
+            return self.masks[state]
+        allowed = [ids for effects, ids in self.groups(state[0]).items() if self.apply(state[1:], effects) is not None]
+        mask = None
+        if allowed:
+            mask = torch.zeros(self.vocab_size, dtype=torch.bool)
+            mask[torch.cat(allowed)] = True
+        self.masks[state] = mask
+        if len(self.masks) > MASK_CACHE_SIZE:
+            self.masks.popitem(last=False)
+        return mask
+
+    def accepts(self, sql_query):
+        syntax, scope = self.start_state[0], self.start_state[1:]
+        for char in sql_query:
+            transition = self.step(syntax, char)
+            if transition is None:
+                return False
+            syntax, effects = transition
+            scope = self.apply(scope, effects)
+            if scope is None:
+                return False
+        end_effects = self.end_effects(syntax)
+        return end_effects is not None and self.apply(scope, end_effects) is not None
+
+    def logits_processor(self):
+        return SQLGrammarLogitsProcessor(self)
+
+    def report(self):
+        if self.mask_calls:
+            print(f"✓ Constrained decoding: {len(self.token_groups)} grammar states cached, "
+                  f"{1000 * self.mask_time / self.mask_calls:.2f} ms masking per step")
+
+class SQLGrammarLogitsProcessor(LogitsProcessor):
+    '''
+    Masks the scores of decoder ids the grammar does not allow after each row's prefix.
+    Row prefixes (decoder start token first, right-padded with pad / start id 0) are
+    mapped to grammar states through a per-generation cache, extended by one token a step.
+    '''
+    def __init__(self, grammar):
+        self.grammar = grammar
+        self.states = {}
+
+    def state(self, prefix):
+        if prefix not in self.states:
+            if not prefix:
+                self.states[prefix] = self.grammar.start_state
+            else:
+                previous = self.state(prefix[:-1])
+                done = previous is None or prefix[-1] == self.grammar.eos_token_id
+                self.states[prefix] = None if done else self.grammar.advance(previous, prefix[-1])
+        return self.states[prefix]
+
+    def __call__(self, input_ids, scores):
+        start = time.perf_counter()
+        if input_ids.size(1) == 1:
+            self.states = {}  # a new generation
+        rows = input_ids[:, 1:].tolist()
+        masks = []
+        for row in rows:
+            while row and row[-1] == 0:  # right padding of rows at earlier positions
+                row.pop()
+            state = self.state(tuple(row))
+            mask = self.grammar.mask(state) if state is not None else None
+            masks.append(mask)
+        if any(mask is not None for mask in masks):
+            full = torch.ones(scores.size(-1), dtype=torch.bool)
+            masks = torch.stack([mask if mask is not None else full for mask in masks]).to(scores.device)
+            scores = scores.masked_fill(~masks, -float('inf'))
+        self.grammar.mask_time += time.perf_counter() - start
+        self.grammar.mask_calls += 1
+        return scores
+
+if __name__ == "__main__":
+    from transformers import T5TokenizerFast
+    from sql_compression import compress_sql
+
+    # Each must turn a gold query into one the grammar rejects
+    corruptions = {
+        'unknown column': lambda sql_query: re.sub(r"\b([a-z_]+_\d+)\.(\w+)", r"\1.\2x", sql_query, count=1),
+        'undeclared alias': lambda sql_query: re.sub(r"WHERE (\w+)_\d\.", r"WHERE \1_9.", sql_query, count=1),
+        'repeated alias': lambda sql_query: re.sub(r"FROM (\w+ \w+_\d) ", r"FROM \1 , \1 ", sql_query, count=1),
+        'empty select list': lambda sql_query: re.sub(r"^SELECT( DISTINCT)? .*? FROM", r"SELECT\1 FROM", sql_query, count=1),
+        'missing FROM': lambda sql_query: sql_query.split(' FROM ')[0],
+        'repeated keyword': lambda sql_query: sql_query.replace(' WHERE ', ' WHERE WHERE ', 1),
+        'repeated operator': lambda sql_query: sql_query.replace(' = ', ' = = ', 1),
+        'dangling AND': lambda sql_query: sql_query.rstrip(';') + ' AND',
+        'unclosed parenthesis': lambda sql_query: sql_query.replace('WHERE ', 'WHERE( ', 1),
+    }
+
+    tokenizer = T5TokenizerFast.from_pretrained('google-t5/t5-small')
+    grammar = SQLGrammar.from_schema(tokenizer)
+
+    print("\n" + "="*80)
+    print(f"SQL GRAMMAR ({len(grammar.tables)} tables, "
+          f"{sum(len(columns) for columns in grammar.tables.values())} columns)")
+    print("="*80)
+    for split in ('train', 'dev'):
+        with open(os.path.join('data', f'{split}.sql'), 'r') as f:
+            sql_queries = [line.strip() for line in f.readlines()]
+        plain = sum(grammar.accepts(sql_query) for sql_query in sql_queries)
+        compressed = sum(grammar.accepts(compress_sql(sql_query)) for sql_query in sql_queries)
+        status = "✓" if plain == compressed == len(sql_queries) else "⚠"
+        print(f"{status} {split}: gold accepted {plain}/{len(sql_queries)}, compressed {compressed}/{len(sql_queries)}")
+        for name, corrupt in corruptions.items():
+            corrupted = [corrupt(sql_query) for sql_query in sql_queries]
+            corrupted = [sql_query for sql_query, gold in zip(corrupted, sql_queries) if sql_query != gold]
+            rejected = sum(not grammar.accepts(sql_query) for sql_query in corrupted)
+            status = "✓" if rejected == len(corrupted) else "⚠"
+            print(f"  {status} {name} rejected {rejected}/{len(corrupted)}")
+
+    # Token-level masks along the gold dev outputs
+    start = time.perf_counter()
+    steps = 0
+    gold_allowed = 0
+    for input_ids in tokenizer(sql_queries[:200])['input_ids']:
+        state = grammar.start_state
+        for token_id in input_ids:
+            mask = grammar.mask(state)
+            gold_allowed += mask is None or bool(mask[token_id])
+            steps += 1
+            state = grammar.advance(state, token_id) if token_id != tokenizer.eos_token_id else state
+    elapsed = time.perf_counter() - start
+    print(f"  Gold dev tokens allowed by the mask: {gold_allowed}/{steps}; {len(grammar.token_groups)} grammar states, "
+          f"{1000 * elapsed / steps:.2f} ms/token including mask construction")
+    print("="*80 + "\n")
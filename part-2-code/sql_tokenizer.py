@@ -0,0 +1,235 @@
+"""
+Domain tokenizer for the scratch T5 model.
+
+The t5-small SentencePiece vocabulary is built for general text and splits SQL identifiers
+such as airport_service_1.city_code into many pieces. This tokenizer is trained on the
+train split instead: every identifier (keyword, table, alias, column), number and
+punctuation mark is one unit, and units seen often enough in training get their own id.
+Rarer words fall back to single characters, so any input can be encoded without <unk>.
+
+As in SentencePiece, a unit preceded by whitespace is marked with '▁', the start of the
+text counts as whitespace, and decode() turns the markers back into single spaces.
+
+TrimmedTokenizer keeps t5-small's tokenization instead and only renumbers the ids that
+occur in the data, so the scratch model's embedding and LM head shrink to that size.
+"""
+
+import os
+import re
+import json
+from collections import Counter
+
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+SPACE = '▁'
+SPECIAL_TOKENS = ['<pad>', '</s>', '<unk>']  # same ids as T5: pad 0, eos 1, unk 2
+UNIT_PATTERN = re.compile(r"\s+|[A-Za-z_][A-Za-z0-9_]*|\d+|[^\sA-Za-z0-9_]")
+
+def split_units(text):
+    '''
+    Split text into vocabulary units, each prefixed with SPACE if whitespace precedes it.
+    '''
+    units = []
+    space = True
+    for match in UNIT_PATTERN.finditer(text):
+        unit = match.group()
+        if unit.isspace():
+            # Collapse whitespace runs to a single space, as the SQL data is written
+            space = True
+            continue
+        units.append(SPACE + unit if space else unit)
+        space = False
+    return units
+
+class SQLTokenizer:
+
+    def __init__(self, vocab):
+        self.vocab = list(vocab)
+        self.token_to_id = {token: i for i, token in enumerate(self.vocab)}
+        self.pad_token_id = self.token_to_id['<pad>']
+        self.eos_token_id = self.token_to_id['</s>']
+        self.unk_token_id = self.token_to_id['<unk>']
+
+    @classmethod
+    def train(cls, texts, min_freq=2, max_vocab_size=8000, reserved_units=()):
+        '''
+        Vocabulary: special tokens, every character seen (with and without SPACE, for the
+        fallback), reserved_units, then units occurring at least min_freq times, most
+        frequent first.
+        '''
+        unit_counts = Counter()
+        chars = set()
+        for text in texts:
+            units = split_units(text)
+            unit_counts.update(units)
+            for unit in units:
+                chars.update(unit.lstrip(SPACE))
+
+        vocab = list(SPECIAL_TOKENS)
+        for char in sorted(chars):
+            vocab += [char, SPACE + char]
+        vocab += [unit for unit in reserved_units if unit not in vocab]
+        seen = set(vocab)
+        for unit, count in unit_counts.most_common():
+            if len(vocab) >= max_vocab_size or count < min_freq:
+                break
+            if unit not in seen:
+                vocab.append(unit)
+                seen.add(unit)
+        return cls(vocab)
+
+    @classmethod
+    def load_or_train(cls, path, data_folder='data', min_freq=2):
+        '''
+        Load the tokenizer saved at path, training it on the train split first if needed.
+        '''
+        if os.path.exists(path):
+            return cls.load(path)
+
+        print(f"Training SQL tokenizer on {data_folder}/train.nl and {data_folder}/train.sql...")
+        texts = []
+        for file_name in ('train.nl', 'train.sql'):
+            with open(os.path.join(data_folder, file_name), 'r') as f:
+                texts += [line.strip() for line in f.readlines()]
+
+        # Always single units: every table and column name (they appear in the schema
+        # prefix even when rare in train.sql), the prompt words and the END marker
+        with open(os.path.join(data_folder, 'flight_database.schema'), 'r') as f:
+            entities = json.load(f).get('ents', {})
+        names = set(entities)
+        for columns in entities.values():
+            names.update(columns)
+        names.update(['Schema', 'Question', 'Answer', 'END'])
+        reserved_units = [unit for name in sorted(names) for unit in (name, SPACE + name)]
+
+        tokenizer = cls.train(texts, min_freq=min_freq, reserved_units=reserved_units)
+        tokenizer.save(path)
+        print(f"✓ Saved SQL tokenizer ({len(tokenizer)} tokens) to {path}")
+        return tokenizer
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            return cls(json.load(f)['vocab'])
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'vocab': self.vocab}, f, indent=0)
+
+    def __len__(self):
+        return len(self.vocab)
+
+    def tokenize(self, text):
+        tokens = []
+        for unit in split_units(text):
+            if unit in self.token_to_id:
+                tokens.append(unit)
+            else:
+                # Out-of-vocabulary unit: spell it out character by character
+                space = unit.startswith(SPACE)
+                chars = list(unit.lstrip(SPACE))
+                if space:
+                    chars[0] = SPACE + chars[0]
+                tokens += chars
+        return tokens
+
+    def encode(self, text, add_special_tokens=True, max_length=None):
+        ids = [self.token_to_id.get(token, self.unk_token_id) for token in self.tokenize(text)]
+        if max_length is not None:
+            ids = ids[:max_length - 1 if add_special_tokens else max_length]
+        if add_special_tokens:
+            ids.append(self.eos_token_id)
+        return ids
+
+    def __call__(self, text, max_length=512, truncation=True, padding=False, return_tensors='pt'):
+        '''
+        Tokenizer-style call for one text or a list of texts; returns input_ids and
+        attention_mask tensors of shape (num_texts, length).
+        '''
+        texts = [text] if isinstance(text, str) else text
+        ids = [torch.tensor(self.encode(t, max_length=max_length if truncation else None)) for t in texts]
+        if len(ids) > 1 and not padding:
+            raise ValueError("padding=True is required to batch texts of different lengths")
+        input_ids = pad_sequence(ids, batch_first=True, padding_value=self.pad_token_id)
+        attention_mask = pad_sequence([torch.ones_like(i) for i in ids], batch_first=True, padding_value=0)
+        return {'input_ids': input_ids, 'attention_mask': attention_mask}
+
+    def decode(self, ids, skip_special_tokens=False):
+        if isinstance(ids, torch.Tensor):
+            ids = ids.tolist()
+        special_ids = {self.pad_token_id, self.eos_token_id, self.unk_token_id}
+        tokens = [self.vocab[i] for i in ids if not (skip_special_tokens and i in special_ids)]
+        text = ''.join(tokens).replace(SPACE, ' ')
+        return text[1:] if text.startswith(' ') else text
+
+class TrimmedTokenizer:
+    '''
+    A tokenizer (t5-small's) whose ids are renumbered to the token_ids that occur in the
+    data. Inputs are tokenized as before and mapped to 0..len(token_ids)-1, and decode()
+    maps back, so the model only needs embeddings for those tokens. Ids outside token_ids
+    become <unk>. Sorted token_ids keep pad (0), eos (1) and unk (2) unchanged.
+    '''
+    def __init__(self, base, token_ids):
+        self.base = base
+        self.token_ids = torch.tensor(sorted(token_ids), dtype=torch.long)
+        self.unk_token_id = int((self.token_ids == base.unk_token_id).nonzero())
+        self.index = torch.full((max(len(base), int(self.token_ids.max()) + 1),), self.unk_token_id, dtype=torch.long)
+        self.index[self.token_ids] = torch.arange(len(self.token_ids))
+        self.pad_token_id = int(self.index[base.pad_token_id])
+        self.eos_token_id = int(self.index[base.eos_token_id])
+
+    @classmethod
+    def load_or_build(cls, path, base, data_folders=('data', 'data_preprocessed', 'data_preprocessed_heavy')):
+        '''
+        Load the token ids saved at path, or collect them from every .nl/.sql file in
+        data_folders (all splits), the schema prompt and the Question/Answer/END format.
+        '''
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                return cls(base, json.load(f)['token_ids'])
+
+        from load_data import T5Dataset
+        texts = [T5Dataset.load_schema(None, os.path.join('data', 'flight_database.schema')), "Question: Answer: END"]
+        for folder in data_folders:
+            if not os.path.isdir(folder):
+                continue
+            for file_name in sorted(os.listdir(folder)):
+                if file_name.endswith(('.nl', '.sql')):
+                    with open(os.path.join(folder, file_name), 'r') as f:
+                        texts += [line.strip() for line in f.readlines()]
+
+        token_ids = {base.pad_token_id, base.eos_token_id, base.unk_token_id}
+        for input_ids in base(texts)['input_ids']:
+            token_ids.update(input_ids)
+        tokenizer = cls(base, token_ids)
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'token_ids': tokenizer.token_ids.tolist()}, f)
+        print(f"✓ Saved trimmed vocabulary ({len(tokenizer)} of {len(base)} tokens) to {path}")
+        return tokenizer
+
+    def __len__(self):
+        return len(self.token_ids)
+
+    def trim(self, ids):
+        # Base tokenizer ids (tensor, list or list of lists) -> trimmed ids
+        if isinstance(ids, torch.Tensor):
+            return self.index[ids]
+        if len(ids) > 0 and isinstance(ids[0], list):
+            return [self.trim(i) for i in ids]
+        return self.index[torch.tensor(ids, dtype=torch.long)].tolist()
+
+    def encode(self, text, **kwargs):
+        return self.trim(self.base.encode(text, **kwargs))
+
+    def __call__(self, text, **kwargs):
+        encoding = self.base(text, **kwargs)
+        encoding['input_ids'] = self.trim(encoding['input_ids'])
+        return encoding
+
+    def decode(self, ids, **kwargs):
+        ids = torch.as_tensor(ids, dtype=torch.long)
+        return self.base.decode(self.token_ids[ids.cpu()], **kwargs)
@@ -0,0 +1,315 @@
+"""
+Greedy / beam decoding for T5ForConditionalGeneration with a static KV cache.
+
+model.generate grows the decoder's past_key_values with a torch.cat per layer and step,
+re-gathers every cache tensor (cross-attention included) per beam step, recomputes the
+relative position bias each step and runs the generic logits-processor / stopping-criteria
+machinery. StaticCacheDecoder runs the decoder blocks itself:
+
+    * self-attention keys/values go into buffers preallocated for max_length positions
+      (reused across batches) and are written in place, one position per step; beam
+      search gathers reordered beams into a second preallocated buffer
+    * cross-attention keys/values are projected once per batch
+    * the relative position bias for every (query, key) position pair is computed once
+    * greedy decoding drops rows that have emitted EOS from the active batch, refilling
+      their slots from the rest of the batch when num_slots is smaller than it
+
+Outputs match model.generate (greedy, and beam search with early_stopping=True); its
+generate() takes the same arguments, so it can stand in for the model wherever
+model.generate is called. Use benchmark.py --benchmark static_decoder to compare.
+"""
+
+import torch
+import torch.nn as nn
+
+from t5_utils import unwrap_model
+
+class StaticCacheDecoder:
+
+    def __init__(self, model, max_length):
+        self.model = unwrap_model(model)
+        self.config = self.model.config
+        self.max_length = max_length
+        self.blocks = self.model.decoder.block
+        self.num_heads = self.config.num_heads
+        self.head_dim = self.config.d_kv
+
+        # (1, heads, max_length, max_length); step t uses row t, keys 0..t
+        self_attention = self.blocks[0].layer[0].SelfAttention
+        with torch.no_grad():
+            self.position_bias = self_attention.compute_bias(max_length, max_length)
+        self.cache = None
+        # Greedy row-steps decoded, and those a loop without compaction or refill would run
+        self.row_steps = 0
+        self.padded_row_steps = 0
+
+    def allocate(self, num_rows, dtype, device, num_buffers=1):
+        '''
+        num_buffers (keys, values) pairs of self-attention buffers, each of shape
+        (layers, num_rows, heads, max_length, head_dim). Beam search uses a second pair to
+        gather reordered beams into. Buffers are only grown, never freed between batches;
+        they start zeroed since rows at different positions read (masked) entries past
+        their own prefix, which must at least be finite.
+        '''
+        if (self.cache is None or self.cache.dtype != dtype or self.cache.size(0) < num_buffers
+                or self.cache.size(3) < num_rows):
+            allocated = (self.cache.size(0), self.cache.size(3)) if self.cache is not None else (0, 0)
+            shape = (max(num_buffers, allocated[0]), 2, len(self.blocks), max(num_rows, allocated[1]),
+                     self.num_heads, self.max_length, self.head_dim)
+            self.cache = torch.zeros(shape, dtype=dtype, device=device)
+        return [(self.cache[i, 0, :, :num_rows], self.cache[i, 1, :, :num_rows]) for i in range(num_buffers)]
+
+    def split_heads(self, states):
+        return states.view(states.size(0), -1, self.num_heads, self.head_dim).transpose(1, 2)
+
+    def attend(self, attention, query, keys, values, bias):
+        scores = torch.matmul(query, keys.transpose(-1, -2)) + bias
+        weights = nn.functional.softmax(scores.float(), dim=-1).type_as(scores)
+        output = torch.matmul(weights, values).transpose(1, 2).reshape(query.size(0), 1, -1)
+        return attention.o(output)
+
+    def cross_attention_states(self, encoder_hidden, encoder_mask):
+        keys, values = [], []
+        for block in self.blocks:
+            attention = block.layer[1].EncDecAttention
+            keys.append(self.split_heads(attention.k(encoder_hidden)))
+            values.append(self.split_heads(attention.v(encoder_hidden)))
+        mask_bias = (1.0 - encoder_mask[:, None, None, :].to(encoder_hidden.dtype)) * torch.finfo(encoder_hidden.dtype).min
+        return keys, values, mask_bias
+
+    def step(self, tokens, position, key_cache, value_cache, cross_keys, cross_values, mask_bias):
+        '''
+        Logits for the next token given the current tokens (rows,) at position: an int
+        shared by all rows, or a (rows,) tensor when rows are at different positions.
+        '''
+        hidden = self.model.decoder.embed_tokens(tokens[:, None])
+        if isinstance(position, int):
+            length = position + 1
+            bias = self.position_bias[:, :, position:position + 1, :length]
+            rows = slice(None)
+        else:
+            # Each row attends to its own prefix; cache entries past it belong to an earlier occupant
+            length = int(position.max()) + 1
+            bias = self.position_bias[0, :, position, :length].transpose(0, 1)[:, :, None]
+            ahead = torch.arange(length, device=position.device)[None, :] > position[:, None]
+            bias = bias.masked_fill(ahead[:, None, None, :], torch.finfo(bias.dtype).min)
+            rows = torch.arange(position.size(0), device=position.device)
+        for i, block in enumerate(self.blocks):
+            layer = block.layer[0]
+            attention = layer.SelfAttention
+            normed = layer.layer_norm(hidden)
+            key_cache[i][rows, :, position] = self.split_heads(attention.k(normed))[:, :, 0]
+            value_cache[i][rows, :, position] = self.split_heads(attention.v(normed))[:, :, 0]
+            hidden = hidden + self.attend(attention, self.split_heads(attention.q(normed)),
+                                          key_cache[i, :, :, :length], value_cache[i, :, :, :length], bias)
+
+            layer = block.layer[1]
+            attention = layer.EncDecAttention
+            normed = layer.layer_norm(hidden)
+            hidden = hidden + self.attend(attention, self.split_heads(attention.q(normed)),
+                                          cross_keys[i], cross_values[i], mask_bias)
+            hidden = block.layer[2](hidden)
+
+        hidden = self.model.decoder.final_layer_norm(hidden)
+        if self.config.tie_word_embeddings:
+            hidden = hidden * (self.config.d_model ** -0.5)
+        return self.model.lm_head(hidden)[:, 0]
+
+    @torch.no_grad()
+    def generate(self, input_ids=None, attention_mask=None, encoder_outputs=None, max_length=None,
+                 num_beams=1, length_penalty=1.0, early_stopping=True, num_slots=None, logits_processor=None):
+        '''
+        Same arguments and output as model.generate for greedy / beam search decoding.
+        num_slots: greedy only, decode at most this many rows of the batch at a time.
+        logits_processor: called as in generate, with the decoded prefixes (rows at earlier
+        positions right-padded) and the scores of the next token.
+        '''
+        max_length = min(max_length or self.max_length, self.max_length)
+        if encoder_outputs is None:
+            encoder_outputs = self.model.get_encoder()(input_ids=input_ids, attention_mask=attention_mask, return_dict=True)
+        encoder_hidden = encoder_outputs.last_hidden_state
+        if attention_mask is None:
+            attention_mask = torch.ones(encoder_hidden.shape[:2], dtype=torch.long, device=encoder_hidden.device)
+        if num_beams > 1:
+            return self.beam_search(encoder_hidden, attention_mask, max_length, num_beams, length_penalty, logits_processor)
+        return self.greedy(encoder_hidden, attention_mask, max_length, num_slots, logits_processor)
+
+    def greedy(self, encoder_hidden, encoder_mask, max_length, num_slots=None, logits_processor=None):
+        '''
+        Greedy decoding over num_slots active rows (default: the whole batch). When a row
+        emits EOS its slot goes to the next pending batch row, which starts at position 0;
+        once none are pending, finished rows are compacted away (the last active rows move
+        into their slots), so each step only runs the rows still decoding.
+        '''
+        batch_size = encoder_hidden.size(0)
+        num_slots = min(num_slots or batch_size, batch_size)
+        device = encoder_hidden.device
+        pad_id, eos_id = self.config.pad_token_id, self.config.eos_token_id
+        (key_cache, value_cache), = self.allocate(num_slots, encoder_hidden.dtype, device)
+        cross_keys, cross_values, mask_bias = self.cross_attention_states(encoder_hidden[:num_slots], encoder_mask[:num_slots])
+
+        output = torch.full((batch_size, max_length), pad_id, dtype=torch.long, device=device)
+        output[:, 0] = self.config.decoder_start_token_id
+        examples = torch.arange(num_slots, device=device)  # batch row decoded in each slot
+        positions = torch.zeros(num_slots, dtype=torch.long, device=device)
+        position = 0  # shared by all slots until one is refilled
+        num_pending = batch_size - num_slots
+        steps = torch.zeros(batch_size, dtype=torch.long, device=device)  # decoded per batch row
+        while examples.numel():
+            tokens = output[examples, positions]
+            logits = self.step(tokens, position if position is not None else positions,
+                               key_cache, value_cache, cross_keys, cross_values, mask_bias)
+            if logits_processor is not None:
+                logits = logits_processor(output[examples, :int(positions.max()) + 1], logits)
+            positions += 1
+            position = position + 1 if position is not None else None
+            tokens = logits.argmax(dim=-1)
+            output[examples, positions] = tokens
+
+            finished = (tokens == eos_id) | (positions == max_length - 1)
+            if not finished.any():
+                continue
+            freed = finished.nonzero().squeeze(1)
+            steps[examples[freed]] = positions[freed]
+
+            # Refill freed slots with pending rows
+            refill = freed[:num_pending]
+            if refill.numel():
+                start = batch_size - num_pending
+                new_examples = torch.arange(start, start + refill.numel(), device=device)
+                new_keys, new_values, new_mask_bias = self.cross_attention_states(
+                    encoder_hidden[new_examples], encoder_mask[new_examples])
+                for i in range(len(self.blocks)):
+                    cross_keys[i][refill], cross_values[i][refill] = new_keys[i], new_values[i]
+                mask_bias[refill] = new_mask_bias
+                examples[refill] = new_examples
+                positions[refill] = 0
+                position = None
+                num_pending -= refill.numel()
+
+            # Compact: move the last live slots into the holes left by finished ones
+            holes = freed[refill.numel():]
+            if holes.numel():
+                num_active = examples.numel() - holes.numel()
+                live = torch.ones_like(finished)
+                live[holes] = False
+                holes = holes[holes < num_active]
+                movers = live[num_active:].nonzero().squeeze(1) + num_active
+                if holes.numel():
+                    length = int(positions[movers].max())  # positions written so far
+                    key_cache[:, holes, :, :length] = key_cache[:, movers, :, :length]
+                    value_cache[:, holes, :, :length] = value_cache[:, movers, :, :length]
+                    for i in range(len(self.blocks)):
+                        cross_keys[i][holes], cross_values[i][holes] = cross_keys[i][movers], cross_values[i][movers]
+                    mask_bias[holes] = mask_bias[movers]
+                    examples[holes], positions[holes] = examples[movers], positions[movers]
+                key_cache, value_cache = key_cache[:, :num_active], value_cache[:, :num_active]
+                cross_keys = [keys[:num_active] for keys in cross_keys]
+                cross_values = [values[:num_active] for values in cross_values]
+                mask_bias = mask_bias[:num_active]
+                examples, positions = examples[:num_active], positions[:num_active]
+
+        # Without compaction each group of num_slots rows runs as long as its longest row
+        self.row_steps += int(steps.sum())
+        self.padded_row_steps += sum(group.numel() * int(group.max()) for group in steps.split(num_slots))
+        return output[:, :int(steps.max()) + 1]
+
+    def beam_search(self, encoder_hidden, encoder_mask, max_length, num_beams, length_penalty, logits_processor=None):
+        '''
+        Beam search as in model.generate with early_stopping=True: a batch item is done
+        once num_beams hypotheses have ended with EOS; hypotheses are scored by their
+        summed log-probabilities / (generated length ** length_penalty).
+        '''
+        batch_size = encoder_hidden.size(0)
+        num_rows = batch_size * num_beams
+        device = encoder_hidden.device
+        pad_id, eos_id = self.config.pad_token_id, self.config.eos_token_id
+        encoder_hidden = encoder_hidden.repeat_interleave(num_beams, dim=0)
+        encoder_mask = encoder_mask.repeat_interleave(num_beams, dim=0)
+        (key_cache, value_cache), (spare_keys, spare_values) = self.allocate(num_rows, encoder_hidden.dtype, device, num_buffers=2)
+        cross_keys, cross_values, mask_bias = self.cross_attention_states(encoder_hidden, encoder_mask)
+
+        sequences = torch.full((num_rows, max_length), pad_id, dtype=torch.long, device=device)
+        sequences[:, 0] = self.config.decoder_start_token_id
+        beam_scores = torch.zeros(batch_size, num_beams, device=device)
+        beam_scores[:, 1:] = -1e9  # all beams start identical; expand from the first only
+        beam_scores = beam_scores.view(-1)
+        hypotheses = [[] for _ in range(batch_size)]  # (score, tokens) per batch item
+        done = [False] * batch_size
+        row_offsets = torch.arange(batch_size, device=device)[:, None] * num_beams
+
+        length = 1
+        while length < max_length:
+            logits = self.step(sequences[:, length - 1], length - 1, key_cache, value_cache, cross_keys, cross_values, mask_bias)
+            scores = nn.functional.log_softmax(logits.float(), dim=-1)
+            if logits_processor is not None:
+                scores = logits_processor(sequences[:, :length], scores)
+            scores = scores + beam_scores[:, None]
+            vocab_size = scores.size(-1)
+            top_scores, top_ids = scores.view(batch_size, -1).topk(2 * num_beams, dim=1)
+            top_rows = top_ids // vocab_size + row_offsets
+            top_tokens = top_ids % vocab_size
+
+            next_scores = torch.zeros(batch_size, num_beams, device=device)
+            next_tokens = torch.full((batch_size, num_beams), pad_id, dtype=torch.long, device=device)
+            next_rows = row_offsets.repeat(1, num_beams)
+            for item in range(batch_size):
+                if done[item]:
+                    continue
+                slot = 0
+                for rank, (score, row, token) in enumerate(zip(top_scores[item].tolist(), top_rows[item].tolist(),
+                                                                top_tokens[item].tolist())):
+                    if token == eos_id:
+                        if rank < num_beams:
+                            self.add_hypothesis(hypotheses[item], num_beams, score, sequences[row, :length], length, length_penalty)
+                    else:
+                        next_scores[item, slot], next_tokens[item, slot], next_rows[item, slot] = score, token, row
+                        slot += 1
+                    if slot == num_beams:
+                        break
+                done[item] = len(hypotheses[item]) >= num_beams
+
+            # Reorder the beams: gather the caches into the spare buffers, which become current
+            next_rows = next_rows.view(-1)
+            sequences.copy_(sequences.index_select(0, next_rows))
+            torch.index_select(key_cache[:, :, :, :length], 1, next_rows, out=spare_keys[:, :, :, :length])
+            torch.index_select(value_cache[:, :, :, :length], 1, next_rows, out=spare_values[:, :, :, :length])
+            key_cache, spare_keys = spare_keys, key_cache
+            value_cache, spare_values = spare_values, value_cache
+            sequences[:, length] = next_tokens.view(-1)
+            beam_scores = next_scores.view(-1)
+            length += 1
+            if all(done):
+                break
+
+        # Beams still open at max_length compete with the finished hypotheses
+        for item in range(batch_size):
+            if not done[item]:
+                for beam in range(num_beams):
+                    row = item * num_beams + beam
+                    self.add_hypothesis(hypotheses[item], num_beams, beam_scores[row].item(),
+                                        sequences[row, :length], length - 1, length_penalty)
+
+        # Highest score; ties go to the latest hypothesis, as in generate
+        best = [sorted(hypotheses[item], key=lambda hypothesis: hypothesis[0])[-1][1] for item in range(batch_size)]
+        output_length = min(max(len(tokens) for tokens in best) + 1, max_length)
+        output = torch.full((batch_size, output_length), pad_id, dtype=torch.long, device=device)
+        for item, tokens in enumerate(best):
+            output[item, :len(tokens)] = tokens
+            if len(tokens) < output_length:
+                output[item, len(tokens)] = eos_id
+        return output
+
+    def report(self):
+        if self.padded_row_steps > self.row_steps:
+            print(f"✓ Static decoder: {self.row_steps}/{self.padded_row_steps} greedy row-steps decoded "
+                  f"({100 * (1 - self.row_steps / self.padded_row_steps):.1f}% saved by dropping finished rows)")
+
+    @staticmethod
+    def add_hypothesis(hypotheses, num_beams, sum_logprobs, tokens, generated_length, length_penalty):
+        # Keep the num_beams best finished hypotheses of a batch item
+        score = sum_logprobs / (generated_length ** length_penalty)
+        if len(hypotheses) < num_beams or score > min(hypothesis[0] for hypothesis in hypotheses):
+            hypotheses.append((score, tokens.clone()))
+            if len(hypotheses) > num_beams:
+                hypotheses.remove(min(hypotheses, key=lambda hypothesis: hypothesis[0]))
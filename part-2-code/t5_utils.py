@@ -1,11 +1,29 @@
 import os
+import glob
+import json
+import math
+import pickle
+import hashlib
+import queue
+import atexit
+import functools
+import threading
+import multiprocessing as mp
 
+import numpy as np
 import torch
+import torch.nn as nn
 
 import transformers
-from transformers import T5ForConditionalGeneration, T5Config
+from transformers import T5ForConditionalGeneration, T5Config, T5TokenizerFast
 from transformers.pytorch_utils import ALL_LAYERNORM_LAYERS
+from transformers.modeling_outputs import BaseModelOutput
+from safetensors import safe_open
+from safetensors.torch import save_file, load_file, load_model
 import wandb
+from tqdm import tqdm
+
+from utils import is_main_process, get_rank, gather_shards, get_rng_state, set_rng_state
 
 DEVICE = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
 
@@ -19,10 +37,12 @@ def setup_wandb(args):
             config={
                 "learning_rate": args.learning_rate,
                 "weight_decay": args.weight_decay,
+                "optimizer": getattr(args, 'optimizer', 'adamw'),
                 "scheduler": args.scheduler_type,
                 "batch_size": args.batch_size,
                 "finetune": getattr(args, 'finetune', False),
                 "use_schema": args.use_schema,
+                "schema_prompt_tokens": getattr(args, 'schema_prompt_tokens', 0),
                 "max_epochs": args.max_n_epochs,
                 "warmup_epochs": args.num_warmup_epochs,
             }
@@ -50,10 +70,19 @@ def initialize_model(args):
         print("Loading pretrained google-t5/t5-small...")
         model = T5ForConditionalGeneration.from_pretrained('google-t5/t5-small')
         
-        # Optional: Freeze encoder layers for faster training (uncomment if needed)
-        # print("Freezing encoder layers...")
-        # for param in model.encoder.parameters():
-        #     param.requires_grad = False
+        # Freeze the encoder (including the shared embedding, which is tied to it) so its
+        # hidden states can be computed once and cached (see EncoderStateCache)
+        if getattr(args, 'freeze_encoder', False):
+            print("Freezing encoder layers...")
+            for param in model.encoder.parameters():
+                param.requires_grad = False
+        
+        # Parameter-efficient fine-tuning: only low-rank adapters are trained
+        if getattr(args, 'lora', False):
+            stacks = ('decoder',) if getattr(args, 'freeze_encoder', False) else ('encoder', 'decoder')
+            print(f"Adding LoRA adapters (rank={args.lora_rank}, alpha={args.lora_alpha}, "
+                  f"targets={args.lora_targets}, stacks={','.join(stacks)})...")
+            apply_lora(model, args.lora_rank, args.lora_alpha, args.lora_dropout, args.lora_targets.split(','), stacks)
         
     else:
         # Train from scratch
@@ -61,6 +90,13 @@ def initialize_model(args):
         config = T5Config.from_pretrained('google-t5/t5-small')
         model = T5ForConditionalGeneration(config)
     
+    # Learned prompt in place of the schema text (see load_data.schema_prompt)
+    if getattr(args, 'schema_prompt_tokens', 0) > 0:
+        from load_data import T5Dataset
+        print(f"Initializing a {args.schema_prompt_tokens}-token schema prompt from the schema embeddings...")
+        schema = T5Dataset.load_schema(None, os.path.join('data', 'flight_database.schema'))
+        init_schema_prompt(model, T5TokenizerFast.from_pretrained('google-t5/t5-small'), schema, args.schema_prompt_tokens)
+    
     model = model.to(DEVICE)
     
     # Print parameter stats
@@ -72,6 +108,439 @@ def initialize_model(args):
     
     return model
 
+class LoRALinear(nn.Module):
+    '''
+    nn.Linear with a trainable low-rank update: base(x) + dropout(x) A^T B^T * alpha / rank.
+    The base layer stays frozen. B starts at zero, so training starts from the pretrained model.
+    '''
+    def __init__(self, base, rank, alpha, dropout):
+        super().__init__()
+        self.base = base
+        self.scaling = alpha / rank
+        factory = {'device': base.weight.device, 'dtype': base.weight.dtype}
+        self.lora_A = nn.Parameter(torch.empty(rank, base.in_features, **factory))
+        self.lora_B = nn.Parameter(torch.zeros(base.out_features, rank, **factory))
+        nn.init.kaiming_uniform_(self.lora_A, a=math.sqrt(5))
+        self.lora_dropout = nn.Dropout(dropout)
+
+    @property
+    def weight(self):
+        # T5 layers inspect .weight (e.g. its dtype) on their projections
+        return self.base.weight
+
+    def forward(self, x):
+        return self.base(x) + (self.lora_dropout(x) @ self.lora_A.t() @ self.lora_B.t()) * self.scaling
+
+    def merged(self):
+        # Plain nn.Linear with the update folded into the weight
+        merged = nn.Linear(self.base.in_features, self.base.out_features, bias=self.base.bias is not None,
+                           device=self.base.weight.device, dtype=self.base.weight.dtype)
+        with torch.no_grad():
+            merged.weight.copy_(self.base.weight + (self.lora_B @ self.lora_A) * self.scaling)
+            if self.base.bias is not None:
+                merged.bias.copy_(self.base.bias)
+        return merged
+
+def apply_lora(model, rank, alpha, dropout, targets=('q', 'k', 'v', 'o', 'wi', 'wo'), stacks=('encoder', 'decoder')):
+    '''
+    Freeze every parameter of model and wrap the target projections (T5Attention q/k/v/o,
+    feed-forward wi/wo) of the given stacks in LoRALinear adapters.
+    '''
+    for param in model.parameters():
+        param.requires_grad = False
+    for stack in stacks:
+        for module in list(getattr(model, stack).modules()):
+            for target in targets:
+                child = getattr(module, target, None)
+                if isinstance(child, nn.Linear):
+                    setattr(module, target, LoRALinear(child, rank, alpha, dropout))
+    model.lora_config = {'rank': rank, 'alpha': alpha, 'dropout': dropout, 'targets': list(targets), 'stacks': list(stacks)}
+    return model
+
+def init_schema_prompt(model, tokenizer, schema, num_tokens):
+    '''
+    Set the embeddings of the schema prompt tokens from the schema text: its token
+    embeddings are split into num_tokens contiguous segments, and each prompt token starts
+    as the mean of one segment. Training then tunes them with the rest of the model.
+    '''
+    from load_data import schema_prompt
+    prompt_ids = tokenizer(schema_prompt(num_tokens), add_special_tokens=False)['input_ids']
+    schema_ids = tokenizer(schema, add_special_tokens=False)['input_ids']
+    if len(prompt_ids) != num_tokens or len(schema_ids) < num_tokens:
+        raise ValueError(f"Cannot build a {num_tokens}-token schema prompt from {len(schema_ids)} schema tokens")
+    
+    embedding = model.get_input_embeddings()
+    with torch.no_grad():
+        schema_embeddings = embedding.weight[torch.tensor(schema_ids, device=embedding.weight.device)]
+        for prompt_id, segment in zip(prompt_ids, torch.tensor_split(schema_embeddings, num_tokens)):
+            embedding.weight[prompt_id] = segment.mean(dim=0)
+    return model
+
+def merge_lora(model):
+    '''
+    Fold LoRA adapters into the base weights so inference runs the plain T5 architecture.
+    No-op for models without adapters.
+    '''
+    if not has_lora(model):
+        return model
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, LoRALinear):
+                setattr(module, name, child.merged())
+    del model.lora_config
+    print("✓ Merged LoRA adapters into the base weights")
+    return model
+
+def has_lora(model):
+    return getattr(unwrap_model(model), 'lora_config', None) is not None
+
+def checkpoint_state_dict(model):
+    # LoRA models only store their adapters; the frozen base weights come from the pretrained checkpoint
+    model = unwrap_model(model)
+    if has_lora(model):
+        return {name: tensor for name, tensor in model.state_dict().items() if 'lora_' in name}
+    return model.state_dict()
+
+def checkpoint_metadata(model):
+    # safetensors metadata marking adapter-only checkpoints, so loaders can rebuild the adapters
+    if has_lora(model):
+        return {'lora_config': json.dumps(unwrap_model(model).lora_config)}
+    return None
+
+def load_checkpoint_state_dict(model, state_dict):
+    model = unwrap_model(model)
+    if not has_lora(model):
+        model.load_state_dict(state_dict)
+        return
+    missing, unexpected = model.load_state_dict(state_dict, strict=False)
+    missing = [name for name in missing if 'lora_' in name]
+    if missing or unexpected:
+        raise RuntimeError(f"Adapter checkpoint does not match the model (missing: {missing}, unexpected: {unexpected})")
+
+def compile_model(model, args):
+    '''
+    Compile the model forward with torch.compile (opt-in via --compile).
+
+    Teacher-forced calls (training and loss computation) are compiled with static
+    shapes; callers pad their batches with bucket_batch so the number of distinct
+    shapes, and therefore recompilations, is bounded by the number of length buckets.
+    Calls coming from model.generate (which pass encoder_outputs) go through a
+    separate dynamic-shape graph, so the growing decoder cache reuses one compiled
+    decoding step instead of recompiling at every position.
+    '''
+    import torch._dynamo
+
+    # Inputs are truncated to 512 tokens, so at most n_buckets lengths per side
+    n_buckets = -(-512 // args.compile_bucket_size)
+    torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, n_buckets * n_buckets)
+
+    print(f"Compiling model with torch.compile (bucket size {args.compile_bucket_size})...")
+    static_forward = torch.compile(model.forward, dynamic=False)
+    decode_step = torch.compile(model.forward, dynamic=True)
+
+    @functools.wraps(model.forward)
+    def forward(*inputs, **kwargs):
+        if kwargs.get('encoder_outputs') is not None:
+            return decode_step(*inputs, **kwargs)
+        return static_forward(*inputs, **kwargs)
+
+    model.forward = forward
+    return model
+
+def bucket_batch(args, *tensors, pad_value=0):
+    '''
+    Right-pad each (B, T, ...) tensor along T to the next multiple of args.compile_bucket_size.
+    Padding uses PAD/mask value 0, which the loss and attention masks already ignore.
+    No-op unless --compile is set.
+    '''
+    if not getattr(args, 'compile', False):
+        return tensors
+    
+    padded = []
+    for tensor in tensors:
+        length = tensor.size(1)
+        target = -(-length // args.compile_bucket_size) * args.compile_bucket_size
+        if target > length:
+            padding = (0, 0) * (tensor.dim() - 2) + (0, target - length)
+            tensor = torch.nn.functional.pad(tensor, padding, value=pad_value)
+        padded.append(tensor)
+    return tuple(padded)
+
+def enable_gradient_checkpointing(model, stacks='both', every_n_layers=1):
+    '''
+    Activation checkpointing for selected T5 blocks: their intermediate activations are
+    dropped after the forward pass and recomputed during backward, trading compute for
+    memory. stacks picks 'encoder', 'decoder' or 'both'; every_n_layers=k checkpoints
+    blocks 0, k, 2k, ... of each selected stack (1 = every block).
+    '''
+    from torch.utils.checkpoint import checkpoint
+
+    def checkpointed(block):
+        forward = block.forward
+
+        @functools.wraps(forward)
+        def wrapper(*inputs, **kwargs):
+            if not (block.training and torch.is_grad_enabled()):
+                return forward(*inputs, **kwargs)
+            return checkpoint(forward, *inputs, use_reentrant=False, **kwargs)
+        return wrapper
+
+    selected = []
+    for stack_name in ('encoder', 'decoder'):
+        if stacks not in (stack_name, 'both'):
+            continue
+        for i, block in enumerate(getattr(model, stack_name).block):
+            if i % every_n_layers == 0:
+                block.forward = checkpointed(block)
+                selected.append(f"{stack_name}.{i}")
+
+    # Cached decoder keys/values would be kept alive as outputs, defeating the savings
+    # (generation still uses the cache through its own generation_config)
+    model.config.use_cache = False
+
+    print(f"Gradient checkpointing enabled for {len(selected)} blocks: {', '.join(selected)}")
+    return selected
+
+class EncoderStateCache:
+    '''
+    On-disk cache of frozen-encoder hidden states (--freeze_encoder).
+
+    States are stored in fp16 in one memory-mapped file of shape (total_tokens, d_model),
+    with an index from sha1(input text) to the row range of that input. The cache
+    directory is named after a fingerprint of the encoder weights, so states computed
+    with a different checkpoint are never reused. build() only encodes texts missing
+    from the index, so later runs with the same checkpoint start immediately.
+    '''
+    def __init__(self, model, cache_root=os.path.join('cache', 'encoder_states')):
+        self.model = unwrap_model(model)
+        self.d_model = self.model.config.d_model
+        self.cache_dir = os.path.join(cache_root, encoder_fingerprint(self.model))
+        self.states_path = os.path.join(self.cache_dir, 'states.f16')
+        self.index_path = os.path.join(self.cache_dir, 'index.pkl')
+        mkdir(self.cache_dir)
+
+        self.index, self.num_rows = {}, 0
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'rb') as f:
+                self.index, self.num_rows = pickle.load(f)
+        self.states = None
+
+    @staticmethod
+    def key(text):
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def build(self, dataset, batch_size=32):
+        '''
+        Encode every input of dataset (a T5Dataset) that is not cached yet.
+        '''
+        texts = sorted({dataset.get_encoder_input(i) for i in range(len(dataset))})
+        missing = [text for text in texts if self.key(text) not in self.index]
+        print(f"Encoder state cache {self.cache_dir}: {len(texts) - len(missing)}/{len(texts)} inputs cached")
+        if missing:
+            self.states = None
+            # Drop rows written after the last saved index (e.g. an interrupted build)
+            with open(self.states_path, 'ab') as f:
+                f.truncate(self.num_rows * self.d_model * 2)
+
+            self.model.eval()
+            with open(self.states_path, 'ab') as f, torch.no_grad():
+                for start in tqdm(range(0, len(missing), batch_size), desc="Caching encoder states"):
+                    batch_texts = missing[start:start + batch_size]
+                    tokens = dataset.tokenizer(batch_texts, max_length=512, truncation=True,
+                                               padding=True, return_tensors='pt').to(DEVICE)
+                    hidden = self.model.get_encoder()(**tokens, return_dict=True).last_hidden_state
+                    for text, states, mask in zip(batch_texts, hidden, tokens['attention_mask']):
+                        length = int(mask.sum())
+                        f.write(states[:length].to(torch.float16).cpu().numpy().tobytes())
+                        self.index[self.key(text)] = (self.num_rows, length)
+                        self.num_rows += length
+                f.flush()
+                os.fsync(f.fileno())
+
+            tmp_path = self.index_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                pickle.dump((self.index, self.num_rows), f)
+            os.replace(tmp_path, self.index_path)
+        return self
+
+    def get(self, text):
+        if self.states is None:
+            self.states = np.memmap(self.states_path, dtype=np.float16, mode='r', shape=(self.num_rows, self.d_model))
+        start, length = self.index[self.key(text)]
+        return torch.from_numpy(np.array(self.states[start:start + length]))
+
+def encoder_fingerprint(model):
+    # Hash of the encoder weights: identifies the checkpoint the cached states belong to
+    digest = hashlib.sha1()
+    for name, tensor in sorted(unwrap_model(model).get_encoder().state_dict().items()):
+        digest.update(name.encode('utf-8'))
+        digest.update(tensor.detach().to('cpu', torch.float32).contiguous().numpy().tobytes())
+    return digest.hexdigest()[:16]
+
+def get_encoder_outputs(model, encoder_input, encoder_mask):
+    '''
+    Encoder outputs for a batch. encoder_input is either token ids, or encoder states
+    from an EncoderStateCache, which are used as they are.
+    '''
+    model = unwrap_model(model)
+    if encoder_input.is_floating_point():
+        return BaseModelOutput(last_hidden_state=encoder_input.to(model.dtype))
+    return model.get_encoder()(input_ids=encoder_input, attention_mask=encoder_mask, return_dict=True)
+
+def encoder_inputs(model, encoder_input, encoder_mask):
+    # Keyword arguments for model(...): input ids, or cached encoder states as encoder_outputs
+    if encoder_input.is_floating_point():
+        return {'encoder_outputs': get_encoder_outputs(model, encoder_input, encoder_mask)}
+    return {'input_ids': encoder_input}
+
+def output_vocab_ids(tokenizer, sql_queries):
+    '''
+    Sorted token ids that occur in the tokenized sql_queries, plus pad, eos and unk.
+    Pad (0) and eos (1) stay first, so their ids are unchanged in the restricted vocab.
+    '''
+    token_ids = {tokenizer.pad_token_id, tokenizer.eos_token_id, tokenizer.unk_token_id}
+    for input_ids in tokenizer(sql_queries)['input_ids']:
+        token_ids.update(input_ids)
+    return torch.tensor(sorted(token_ids), dtype=torch.long)
+
+def restrict_output_vocab(model, token_ids, unk_token_id=2):
+    '''
+    Inference only: slice the LM head (and the decoder input embedding, since generated ids
+    are fed back) to token_ids, so each decoding step runs a len(token_ids)-way softmax.
+    The decoder then works in restricted ids: map its inputs and targets with
+    to_output_vocab and generated ids back with from_output_vocab.
+    '''
+    model = unwrap_model(model)
+    token_ids = token_ids.to(model.lm_head.weight.device)
+    lm_head = nn.Linear(model.config.d_model, len(token_ids), bias=False)
+    lm_head.weight = nn.Parameter(model.lm_head.weight.detach()[token_ids].clone())
+    decoder_embedding = nn.Embedding(len(token_ids), model.config.d_model)
+    decoder_embedding.weight = nn.Parameter(model.decoder.get_input_embeddings().weight.detach()[token_ids].clone())
+    model.lm_head = lm_head
+    model.decoder.set_input_embeddings(decoder_embedding)
+
+    # Full id -> restricted id; ids outside the restricted vocab map to unk
+    unk_id = int((token_ids == unk_token_id).nonzero())
+    index = torch.full((model.config.vocab_size,), unk_id, dtype=torch.long, device=token_ids.device)
+    index[token_ids] = torch.arange(len(token_ids), device=token_ids.device)
+    model.register_buffer('output_vocab', token_ids, persistent=False)
+    model.register_buffer('output_vocab_index', index, persistent=False)
+    print(f"✓ Restricted the output vocabulary to {len(token_ids)} of {model.config.vocab_size} tokens")
+    return model
+
+def has_restricted_vocab(model):
+    return getattr(unwrap_model(model), 'output_vocab', None) is not None
+
+def to_output_vocab(model, token_ids):
+    # Full vocabulary ids -> decoder ids (no-op for unrestricted models)
+    if not has_restricted_vocab(model):
+        return token_ids
+    return unwrap_model(model).output_vocab_index[token_ids]
+
+def from_output_vocab(model, token_ids):
+    # Decoder ids -> full vocabulary ids, for tokenizer.decode (no-op for unrestricted models)
+    if not has_restricted_vocab(model):
+        return token_ids
+    return unwrap_model(model).output_vocab[token_ids]
+
+class GenerationCache:
+    '''
+    Generated ids per distinct encoder input, for one inference pass with fixed weights.
+    Repeated inputs (frequent once literals are anonymized, see anonymizer) are generated
+    once; generate() only runs model.generate on the rows of a batch it has not seen.
+    '''
+    def __init__(self):
+        self.outputs = {}
+        self.lookups = 0
+        self.hits = 0
+
+    @staticmethod
+    def key(encoder_input, encoder_mask):
+        # Unpadded ids (or cached encoder states), so batch padding does not matter
+        return encoder_input[encoder_mask.bool()].cpu().numpy().tobytes()
+
+    def generate(self, model, encoder_input, encoder_mask, encoder_outputs=None, **generate_kwargs):
+        keys = [self.key(ids, mask) for ids, mask in zip(encoder_input, encoder_mask)]
+        first_rows = {}
+        for row, key in enumerate(keys):
+            if key not in self.outputs:
+                first_rows.setdefault(key, row)
+        self.lookups += len(keys)
+        self.hits += len(keys) - len(first_rows)
+
+        if first_rows:
+            rows = torch.tensor(list(first_rows.values()), device=encoder_mask.device)
+            if encoder_outputs is not None:
+                inputs = {'encoder_outputs': BaseModelOutput(last_hidden_state=encoder_outputs.last_hidden_state[rows])}
+            else:
+                inputs = {'input_ids': encoder_input[rows]}
+            generated_ids = model.generate(attention_mask=encoder_mask[rows], **inputs, **generate_kwargs)
+            for key, gen_ids in zip(first_rows, generated_ids):
+                self.outputs[key] = gen_ids
+        return nn.utils.rnn.pad_sequence([self.outputs[key] for key in keys], batch_first=True, padding_value=0)
+
+    def report(self):
+        if self.hits:
+            print(f"✓ Generation cache: {self.hits}/{self.lookups} inputs reused ({100 * self.hits / self.lookups:.1f}%)")
+
+def lookup_draft(tokens, draft, num_draft_tokens, ngram_size):
+    # Prompt lookup: the draft tokens that follow an occurrence of the longest matching
+    # suffix (up to ngram_size tokens) of the decoded tokens, taking the occurrence
+    # closest to the current position since the draft is a near copy of the output
+    for n in range(min(ngram_size, len(tokens)), 0, -1):
+        suffix = tokens[-n:]
+        ends = [start + n for start in range(len(draft) - n + 1) if draft[start:start + n] == suffix]
+        if ends:
+            end = min(ends, key=lambda end: abs(end - len(tokens)))
+            return draft[end:end + num_draft_tokens]
+    return []
+
+def crop_past_key_values(past_key_values, length):
+    # Keep the first length decoder positions of the self-attention cache (cross-attention is fixed)
+    return tuple((self_k[:, :, :length], self_v[:, :, :length], cross_k, cross_v)
+                 for self_k, self_v, cross_k, cross_v in past_key_values)
+
+def speculative_generate(model, encoder_outputs, encoder_mask, drafts, max_length,
+                         num_draft_tokens=8, ngram_size=3, stats=None):
+    '''
+    Greedy decoding with draft tokens verified in parallel (retrieval / prompt-lookup
+    speculative decoding). drafts holds one list of full-vocabulary token ids per row, e.g.
+    the tokenized SQL of the nearest train question (sql_templates). Each decoder forward
+    feeds the last token plus up to num_draft_tokens draft tokens; the longest prefix that
+    matches the model's own argmax is accepted, plus the model's next token, and the KV
+    cache is cropped back to the accepted length. The output is the greedy model.generate
+    output (padded ids starting with the decoder start token); a bad draft only costs
+    speed. stats, if given, accumulates 'tokens' and 'forwards'.
+    '''
+    model = unwrap_model(model)
+    start_id = model.config.decoder_start_token_id
+    eos_id = model.config.eos_token_id
+    outputs = []
+    for row, draft in enumerate(drafts):
+        row_outputs = BaseModelOutput(last_hidden_state=encoder_outputs.last_hidden_state[row:row + 1])
+        row_mask = encoder_mask[row:row + 1]
+        draft = [start_id] + to_output_vocab(model, torch.tensor(draft, dtype=torch.long, device=row_mask.device)).tolist()
+
+        tokens, past_key_values, num_cached = [start_id], None, 0
+        while len(tokens) < max_length and (len(tokens) == 1 or tokens[-1] != eos_id):
+            proposal = lookup_draft(tokens, draft, num_draft_tokens, ngram_size)[:max_length - len(tokens) - 1]
+            decoder_input = torch.tensor([tokens[num_cached:] + proposal], device=row_mask.device)
+            output = model(encoder_outputs=row_outputs, attention_mask=row_mask, decoder_input_ids=decoder_input,
+                           past_key_values=past_key_values, use_cache=True)
+            predicted = output.logits[0, -len(proposal) - 1:].argmax(dim=-1).tolist()
+
+            accepted = 0
+            while accepted < len(proposal) and proposal[accepted] == predicted[accepted] and proposal[accepted] != eos_id:
+                accepted += 1
+            num_cached = len(tokens) + accepted
+            tokens += proposal[:accepted] + [predicted[accepted]]
+            past_key_values = crop_past_key_values(output.past_key_values, num_cached)
+            if stats is not None:
+                stats['tokens'] = stats.get('tokens', 0) + accepted + 1
+                stats['forwards'] = stats.get('forwards', 0) + 1
+        outputs.append(torch.tensor(tokens, device=row_mask.device))
+    return nn.utils.rnn.pad_sequence(outputs, batch_first=True, padding_value=model.config.pad_token_id)
+
 def mkdir(dirpath):
     if not os.path.exists(dirpath):
         try:
@@ -79,30 +548,343 @@ def mkdir(dirpath):
         except FileExistsError:
             pass
 
-def save_model(checkpoint_dir, model, best):
+def unwrap_model(model):
+    # DistributedDataParallel keeps the underlying model in .module
+    return model.module if isinstance(model, torch.nn.parallel.DistributedDataParallel) else model
+
+class CheckpointWriter:
+    '''
+    Writes checkpoints on a background thread so the training loop never waits on disk.
+
+    save() snapshots the state dict to CPU and returns immediately. The worker writes the
+    snapshot to a temporary file in safetensors format and atomically renames it into place,
+    so a crash mid-write can never leave a truncated checkpoint behind. Per-epoch
+    checkpoints are rotated so only the newest keep_last_n remain. Paths not ending in
+    .safetensors (e.g. the training state, which holds optimizer state and RNG states)
+    are written with torch.save through the same atomic path. An optional on_saved callback
+    runs on the writer thread once the file is in place.
+    '''
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.wait)
+
+    def save(self, state_dict, save_path, keep_last_n=None, on_saved=None, metadata=None):
+        self._raise_pending_error()
+        if save_path.endswith('.safetensors'):
+            snapshot = snapshot_state_dict(state_dict)
+        else:
+            snapshot = snapshot_object(state_dict)
+        self.queue.put((snapshot, save_path, keep_last_n, on_saved, metadata))
+
+    def wait(self):
+        # Block until every queued checkpoint is on disk
+        self.queue.join()
+        self._raise_pending_error()
+
+    def _raise_pending_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError(f"Background checkpoint write failed: {error}") from error
+
+    def _run(self):
+        while True:
+            snapshot, save_path, keep_last_n, on_saved, metadata = self.queue.get()
+            try:
+                tmp_path = save_path + '.tmp'
+                if save_path.endswith('.safetensors'):
+                    save_file(snapshot, tmp_path, metadata=metadata)
+                else:
+                    torch.save(snapshot, tmp_path)
+                with open(tmp_path, 'rb') as f:
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, save_path)
+                if keep_last_n is not None:
+                    for old_path in list_epoch_checkpoints(os.path.dirname(save_path))[:-keep_last_n]:
+                        os.remove(old_path)
+                if on_saved is not None:
+                    on_saved()
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+_checkpoint_writer = None
+
+def get_checkpoint_writer():
+    global _checkpoint_writer
+    if _checkpoint_writer is None:
+        _checkpoint_writer = CheckpointWriter()
+    return _checkpoint_writer
+
+def wait_for_checkpoints():
+    if _checkpoint_writer is not None:
+        _checkpoint_writer.wait()
+
+def snapshot_state_dict(state_dict):
+    '''
+    Detached CPU copy of a state dict, safe to write while training keeps updating the model.
+    Tied weights (T5 shares the embedding matrix) are stored once, as safetensors requires;
+    load_model restores the aliases.
+    '''
+    snapshot = {}
+    seen_storages = set()
+    for name, tensor in sorted(state_dict.items()):
+        storage = (tensor.device, tensor.untyped_storage().data_ptr())
+        if storage in seen_storages:
+            continue
+        seen_storages.add(storage)
+        snapshot[name] = tensor.detach().to('cpu', copy=True).contiguous()
+    return snapshot
+
+def snapshot_object(obj):
+    # Recursively copy tensors (e.g. inside optimizer.state_dict()) to CPU
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: snapshot_object(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_object(v) for v in obj)
+    return obj
+
+def list_epoch_checkpoints(checkpoint_dir):
+    # Oldest first; the zero-padded epoch keeps lexicographic order chronological
+    return sorted(glob.glob(os.path.join(checkpoint_dir, 'model_epoch*.safetensors')))
+
+def get_checkpoint_path(checkpoint_dir, best):
+    '''
+    Path of the best (or most recent) checkpoint in checkpoint_dir, falling back to
+    checkpoints written by older versions with torch.save.
+    '''
+    if best:
+        candidates = [os.path.join(checkpoint_dir, 'best_model.safetensors')]
+    else:
+        candidates = list_epoch_checkpoints(checkpoint_dir)[::-1]
+        candidates.append(os.path.join(checkpoint_dir, 'last_model.safetensors'))
+    candidates.append(os.path.join(checkpoint_dir, 'best_model.pt' if best else 'last_model.pt'))
+
+    for path in candidates:
+        if os.path.exists(path):
+            return path
+    return candidates[0]
+
+def load_model_weights(model, checkpoint_path, device=DEVICE):
+    '''
+    Load weights written by save_model (safetensors) or a legacy torch.save checkpoint
+    ({'model_state_dict': ...} or a bare state dict), onto device. Adapter-only LoRA
+    checkpoints add their adapters to model first if it has none.
+    '''
+    if checkpoint_path.endswith('.safetensors'):
+        with safe_open(checkpoint_path, framework='pt') as f:
+            metadata = f.metadata() or {}
+        if 'lora_config' in metadata:
+            if not has_lora(model):
+                apply_lora(model, **json.loads(metadata['lora_config']))
+            load_checkpoint_state_dict(model, load_file(checkpoint_path, device=str(device)))
+        else:
+            load_model(model, checkpoint_path, device=str(device))
+    else:
+        checkpoint = torch.load(checkpoint_path, map_location=device)
+        model.load_state_dict(checkpoint.get('model_state_dict', checkpoint))
+    return model
+
+def save_model(checkpoint_dir, model, best, epoch=None, keep_last_n=2):
     # Save model checkpoint to be able to load the model later
+    # (replicas are identical under DDP, so only rank 0 writes).
+    # The write happens in the background; see CheckpointWriter.
+    if not is_main_process():
+        return
+    model = unwrap_model(model)
     mkdir(checkpoint_dir)
     
     if best:
-        save_path = os.path.join(checkpoint_dir, 'best_model.pt')
+        save_path = os.path.join(checkpoint_dir, 'best_model.safetensors')
         print(f"✓ Saving best model to {save_path}")
+        keep_last_n = None
+    elif epoch is not None:
+        save_path = os.path.join(checkpoint_dir, f'model_epoch{epoch:04d}.safetensors')
     else:
-        save_path = os.path.join(checkpoint_dir, 'last_model.pt')
+        save_path = os.path.join(checkpoint_dir, 'last_model.safetensors')
+        keep_last_n = None
     
-    torch.save({
-        'model_state_dict': model.state_dict(),
-    }, save_path)
+    get_checkpoint_writer().save(checkpoint_state_dict(model), save_path, keep_last_n, metadata=checkpoint_metadata(model))
+
+class AsyncEvaluator:
+    '''
+    Runs detailed evaluations (generation, SQL execution and metrics) in a background
+    process so the next epoch can train meanwhile.
+
+    submit() snapshots the model weights through the checkpoint writer; once the snapshot
+    is on disk the worker loads it and calls eval_fn(args, snapshot_path, epoch, cache,
+    **job_kwargs), where cache is a dict that persists across jobs (model, tokenizer,
+    dev loader).
+    eval_fn must be a module-level function so it can be pickled. Results come back in
+    submission order from poll() (non-blocking) or drain() (waits for all pending jobs).
+    The caller then keeps the snapshot as the best model or discards it with finish().
+    pending_jobs() goes into the training state (the snapshot is written before it), and
+    restore() re-submits those jobs when an interrupted run is resumed.
+    '''
+    def __init__(self, args, eval_fn, checkpoint_dir):
+        self.checkpoint_dir = checkpoint_dir
+        self.pending = []
+        self.job_kwargs = {}
+        ctx = mp.get_context('spawn')
+        self.jobs = ctx.Queue()
+        self.results = ctx.Queue()
+        self.process = ctx.Process(target=_async_eval_worker, args=(args, eval_fn, self.jobs, self.results), daemon=True)
+        self.process.start()
+
+    def snapshot_path(self, epoch):
+        return os.path.join(self.checkpoint_dir, f'eval_snapshot_epoch{epoch:04d}.safetensors')
+
+    def submit(self, model, epoch, **job_kwargs):
+        snapshot_path = self.snapshot_path(epoch)
+        self.pending.append(epoch)
+        self.job_kwargs[epoch] = job_kwargs
+        get_checkpoint_writer().save(checkpoint_state_dict(model), snapshot_path,
+                                     on_saved=lambda: self.jobs.put((epoch, snapshot_path, job_kwargs)),
+                                     metadata=checkpoint_metadata(model))
+
+    def pending_jobs(self):
+        # (epoch, job_kwargs) of the jobs without a result yet, for the training state
+        return [(epoch, self.job_kwargs[epoch]) for epoch in self.pending]
+
+    def restore(self, pending_jobs):
+        '''
+        Re-submit the pending jobs of a resumed run (their snapshots are already on disk)
+        and delete snapshots no job refers to, left behind by an interrupted run.
+        '''
+        for epoch, job_kwargs in pending_jobs:
+            snapshot_path = self.snapshot_path(epoch)
+            if not os.path.exists(snapshot_path):
+                print(f"⚠ Snapshot {snapshot_path} is missing, skipping the evaluation of epoch {epoch + 1}")
+                continue
+            print(f"Re-queuing the DETAILED evaluation of epoch {epoch + 1} in the background...")
+            self.pending.append(epoch)
+            self.job_kwargs[epoch] = job_kwargs
+            self.jobs.put((epoch, snapshot_path, job_kwargs))
+        for snapshot_path in glob.glob(os.path.join(self.checkpoint_dir, 'eval_snapshot_epoch*.safetensors')):
+            if snapshot_path not in map(self.snapshot_path, self.pending):
+                os.remove(snapshot_path)
+
+    def poll(self, block=False):
+        # List of (epoch, eval_results) for every job that has finished
+        finished = []
+        while self.pending:
+            try:
+                epoch, eval_results = self.results.get(block=block, timeout=10 if block else None)
+            except queue.Empty:
+                if block and self.process.is_alive():
+                    continue
+                if block:
+                    raise RuntimeError("Background evaluator exited unexpectedly")
+                break
+            if isinstance(eval_results, Exception):
+                raise RuntimeError(f"Background evaluation of epoch {epoch + 1} failed") from eval_results
+            self.pending.remove(epoch)
+            del self.job_kwargs[epoch]
+            finished.append((epoch, eval_results))
+        return finished
+
+    def drain(self):
+        if self.pending:
+            print(f"Waiting for {len(self.pending)} background evaluation(s)...")
+        return self.poll(block=True)
+
+    def finish(self, epoch, best):
+        # Promote the evaluated snapshot to best_model.safetensors, or delete it
+        snapshot_path = self.snapshot_path(epoch)
+        if best:
+            best_path = os.path.join(self.checkpoint_dir, 'best_model.safetensors')
+            print(f"✓ Saving best model to {best_path}")
+            os.replace(snapshot_path, best_path)
+        else:
+            os.remove(snapshot_path)
+
+    def close(self):
+        self.jobs.put(None)
+        self.process.join()
+
+def _async_eval_worker(args, eval_fn, jobs, results):
+    # Leave most cores to the training process
+    torch.set_num_threads(args.async_eval_threads)
+    cache = {}
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        epoch, snapshot_path, job_kwargs = job
+        try:
+            results.put((epoch, eval_fn(args, snapshot_path, epoch, cache, **job_kwargs)))
+        except Exception as e:
+            results.put((epoch, RuntimeError(repr(e))))
+
+# Progress entries that differ between DDP ranks and are stored once per rank
+PER_RANK_PROGRESS_KEYS = ('rng', 'epoch_rng', 'train_loss_totals')
+
+def save_training_state(checkpoint_dir, model, optimizer, scheduler, progress):
+    '''
+    Save everything needed to continue training exactly where it stopped: model,
+    optimizer and scheduler state, the RNG states of every rank, and the loop counters
+    in progress (epoch, batches_done, best_f1, best_epoch, epochs_since_improvement,
+    pending_evals, ...).
+    Must be called on every rank under DDP (RNG states are gathered); only rank 0 writes.
+    '''
+    progress = dict(progress, rng=get_rng_state())
+    for key in PER_RANK_PROGRESS_KEYS:
+        if key in progress:
+            progress[key] = gather_shards([progress[key]])
+    if not is_main_process():
+        return
+
+    mkdir(checkpoint_dir)
+    state = {
+        'model_state_dict': checkpoint_state_dict(model),
+        'optimizer_state_dict': optimizer.state_dict(),
+        'scheduler_state_dict': scheduler.state_dict() if scheduler is not None else None,
+        'progress': progress,
+    }
+    get_checkpoint_writer().save(state, os.path.join(checkpoint_dir, 'training_state.pt'))
+
+def load_training_state(checkpoint_dir, model, optimizer, scheduler):
+    '''
+    Restore model, optimizer, scheduler and RNG states saved by save_training_state.
+    Returns the saved progress dict (RNG states selected for this rank), or None if
+    there is nothing to resume from.
+    '''
+    state_path = os.path.join(checkpoint_dir, 'training_state.pt')
+    if not os.path.exists(state_path):
+        print(f"⚠ No training state found at {state_path}, starting from scratch")
+        return None
+
+    print(f"Resuming training state from {state_path}")
+    state = torch.load(state_path, map_location=DEVICE)
+    load_checkpoint_state_dict(model, state['model_state_dict'])
+    optimizer.load_state_dict(state['optimizer_state_dict'])
+    if scheduler is not None and state['scheduler_state_dict'] is not None:
+        scheduler.load_state_dict(state['scheduler_state_dict'])
+
+    progress = state['progress']
+    for key in PER_RANK_PROGRESS_KEYS:
+        if key in progress:
+            progress[key] = progress[key][get_rank()]
+    set_rng_state(progress['rng'])
+    return progress
 
 def load_model_from_checkpoint(args, best):
     # Load model from a checkpoint
-    checkpoint_file = 'best_model.pt' if best else 'last_model.pt'
-    checkpoint_path = os.path.join(args.checkpoint_dir, checkpoint_file)
+    wait_for_checkpoints()
+    checkpoint_path = get_checkpoint_path(args.checkpoint_dir, best)
     
     print(f"\nLoading model from {checkpoint_path}")
     
     model = initialize_model(args)
-    checkpoint = torch.load(checkpoint_path, map_location=DEVICE)
-    model.load_state_dict(checkpoint['model_state_dict'])
+    load_model_weights(model, checkpoint_path)
+    
+    # Serve at full speed: fold LoRA adapters into the base weights
+    merge_lora(model)
     
     return model
 
@@ -133,7 +915,26 @@ def initialize_optimizer(args, model):
         },
     ]
     
-    print(f"Optimizer: AdamW (lr={args.learning_rate}, wd={args.weight_decay})")
+    num_trainable = sum(p.numel() for group in optimizer_grouped_parameters for p in group["params"])
+    
+    if args.optimizer == "adafactor":
+        # Factorized second moments (row and column statistics instead of a full buffer per
+        # matrix), optionally without a first moment. Relative-step sizing is disabled so
+        # args.learning_rate and the chosen scheduler drive the learning rate as with AdamW.
+        print(f"Optimizer: Adafactor (lr={args.learning_rate}, wd={args.weight_decay}, "
+              f"beta1={args.adafactor_beta1}, {num_trainable:,} parameters)")
+        optimizer = transformers.Adafactor(
+            optimizer_grouped_parameters,
+            lr=args.learning_rate,
+            beta1=args.adafactor_beta1,
+            clip_threshold=1.0,
+            scale_parameter=False,
+            relative_step=False,
+            warmup_init=False,
+        )
+        return optimizer
+    
+    print(f"Optimizer: AdamW (lr={args.learning_rate}, wd={args.weight_decay}, {num_trainable:,} parameters)")
     
     optimizer = torch.optim.AdamW(
         optimizer_grouped_parameters, 
@@ -143,6 +944,15 @@ def initialize_optimizer(args, model):
     )
     
     return optimizer
+
+def optimizer_state_bytes(optimizer):
+    # Memory held by the optimizer's per-parameter state (moment buffers, factored statistics)
+    return sum(
+        value.numel() * value.element_size()
+        for state in optimizer.state.values()
+        for value in state.values()
+        if isinstance(value, torch.Tensor)
+    )
         
 def initialize_scheduler(args, optimizer, epoch_length):
     if args.scheduler_type == "none":
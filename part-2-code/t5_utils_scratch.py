@@ -18,9 +18,14 @@ def initialize_model_scratch(args):
     config.dropout_rate = args.dropout_rate
     config.layer_norm_epsilon = 1e-6
     
+    # Smaller embedding / LM head for a domain tokenizer (see sql_tokenizer.py)
+    if getattr(args, 'vocab_size', None) is not None:
+        config.vocab_size = args.vocab_size
+    
     print(f"Configuration adjustments:")
     print(f"  Dropout rate: {config.dropout_rate}")
     print(f"  Layer norm epsilon: {config.layer_norm_epsilon}")
+    print(f"  Vocabulary size: {config.vocab_size}")
     
     # Initialize model
     model = T5ForConditionalGeneration(config)
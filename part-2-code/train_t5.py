@@ -1,16 +1,31 @@
 import os
+import time
 import argparse
+import contextlib
 from tqdm import tqdm
 
 import torch
 import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data.distributed import DistributedSampler
 import numpy as np
 import wandb
 
-from t5_utils import initialize_model, initialize_optimizer_and_scheduler, save_model, load_model_from_checkpoint, setup_wandb
-from transformers import GenerationConfig, T5TokenizerFast
-from load_data import load_t5_data
-from utils import compute_metrics, save_queries_and_records
+from t5_utils import initialize_model, initialize_optimizer_and_scheduler, save_model, load_model_from_checkpoint, setup_wandb, compile_model, bucket_batch, enable_gradient_checkpointing, unwrap_model, wait_for_checkpoints
+from t5_utils import save_training_state, load_training_state, AsyncEvaluator, load_model_weights
+from t5_utils import EncoderStateCache, get_encoder_outputs, encoder_inputs
+from t5_utils import output_vocab_ids, restrict_output_vocab, to_output_vocab, from_output_vocab, GenerationCache
+from t5_utils import speculative_generate
+from transformers import GenerationConfig, T5TokenizerFast, LogitsProcessorList
+from load_data import load_t5_data, get_dataloader, with_encoder_cache, restore_literals, load_lines
+from utils import compute_metrics, save_queries_and_records, save_sharded_queries_and_records
+from utils import setup_distributed, is_distributed, is_main_process, barrier, all_reduce_sum, broadcast_object
+from utils import get_rng_state, set_rng_state
+from sql_compression import compress_sql, expand_sql
+from sql_templates import TemplateMatcher
+from static_decoder import StaticCacheDecoder
+from length_predictor import LengthPredictor, length_grouped_batches
+from sql_grammar import SQLGrammar
 
 DEVICE = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
 PAD_IDX = 0
@@ -27,10 +42,28 @@ def get_args():
     parser.add_argument('--finetune', action='store_true', help="Fine-tune T5 (vs train from scratch)")
     parser.add_argument('--use_schema', action='store_true', default=True, help="Use schema context in inputs")
     parser.add_argument('--no_schema', dest='use_schema', action='store_false', help="Don't use schema context")
+    parser.add_argument('--entity_linking', type=str, default=None, choices=["replace", "annotate"],
+                        help="Rewrite airport/airline/city names in questions to their codes (or append them); see entity_linker")
+    parser.add_argument('--anonymize_literals', action='store_true',
+                        help="Replace city/airline/... names and numbers with typed placeholders in questions and SQL; see anonymizer")
+    parser.add_argument('--schema_token_budget', type=int, default=0,
+                        help="Prune the schema per question to its likely tables/columns within this many tokens (0 = full schema)")
+    parser.add_argument('--schema_prompt_tokens', type=int, default=0,
+                        help="Replace the schema text with this many learned prompt embeddings initialized from it (0 = off)")
+    parser.add_argument('--freeze_encoder', action='store_true',
+                        help="Freeze the pretrained encoder and train the decoder on cached encoder states (requires --finetune)")
+    parser.add_argument('--lora', action='store_true', help="Train LoRA adapters instead of all weights (requires --finetune)")
+    parser.add_argument('--lora_rank', type=int, default=8, help="LoRA adapter rank")
+    parser.add_argument('--lora_alpha', type=float, default=16, help="LoRA scaling numerator (update is scaled by alpha / rank)")
+    parser.add_argument('--lora_dropout', type=float, default=0.05, help="Dropout on the LoRA adapter input")
+    parser.add_argument('--lora_targets', type=str, default="q,k,v,o,wi,wo", help="Comma-separated T5 projections to adapt")
 
     # Training hyperparameters
     parser.add_argument('--learning_rate', type=float, default=1e-4, help="Learning rate")
     parser.add_argument('--weight_decay', type=float, default=0.01, help="Weight decay")
+    parser.add_argument('--optimizer', type=str, default="adamw", choices=["adamw", "adafactor"],
+                        help="AdamW, or Adafactor with factorized second moments (less optimizer memory)")
+    parser.add_argument('--adafactor_beta1', type=float, default=None, help="Adafactor first-moment decay (default: no first moment)")
     parser.add_argument('--scheduler_type', type=str, default="linear", choices=["none", "cosine", "linear"])
     parser.add_argument('--num_warmup_epochs', type=int, default=1, help="Warmup epochs")
     parser.add_argument('--max_n_epochs', type=int, default=20, help="Max training epochs")
@@ -41,11 +74,42 @@ def get_args():
     parser.add_argument('--batch_size', type=int, default=16, help="Training batch size")
     parser.add_argument('--test_batch_size', type=int, default=16, help="Eval batch size")
     parser.add_argument('--use_preprocessed', action='store_true', help="Use preprocessed data")
+    parser.add_argument('--compress_sql', action='store_true',
+                        help="Train on the compact reversible SQL form (sql_compression); outputs are expanded before evaluation")
     
     # Generation hyperparameters
     parser.add_argument('--max_gen_length', type=int, default=512, help="Max generation length")
     parser.add_argument('--num_beams', type=int, default=1, help="Beam search width (1=greedy)")
     parser.add_argument('--length_penalty', type=float, default=1.0, help="Length penalty for beam search")
+    parser.add_argument('--template_threshold', type=float, default=0.0,
+                        help="Test inference: answer questions whose SQL template (sql_templates) is matched with this confidence without decoding (0 = off, e.g. 0.9)")
+    parser.add_argument('--static_decoder', action='store_true',
+                        help="Eval/test: decode with static_decoder.StaticCacheDecoder (preallocated KV cache) instead of model.generate")
+    parser.add_argument('--constrained_decoding', action='store_true',
+                        help="Eval/test: mask tokens that cannot continue a valid SQL query over the schema tables / columns (sql_grammar)")
+    parser.add_argument('--length_margin', type=float, default=0.0,
+                        help="Final eval/test: cap each question's generation at this margin times its predicted length (length_predictor; 0 = off, e.g. 1.5)")
+    parser.add_argument('--decode_slots', type=int, default=0,
+                        help="Greedy --static_decoder: decode at most this many rows at a time, refilling the slots of finished rows from the rest of the batch (0 = whole batch)")
+    parser.add_argument('--retrieval_draft', action='store_true',
+                        help="Test inference: greedy decoding that verifies the nearest train template's SQL as draft tokens (same output, fewer decoder forwards)")
+    parser.add_argument('--num_draft_tokens', type=int, default=8, help="Draft tokens verified per decoder forward (--retrieval_draft)")
+    parser.add_argument('--restrict_vocab', action='store_true',
+                        help="Final eval/test: restrict the LM head to token ids seen in train SQL (smaller softmax per step)")
+    parser.add_argument('--restrict_vocab_tolerance', type=float, default=0.0,
+                        help="Largest dev F1 drop accepted from --restrict_vocab before falling back to the full head")
+    
+    # Performance
+    parser.add_argument('--compile', action='store_true', help="Compile the model forward with torch.compile")
+    parser.add_argument('--compile_bucket_size', type=int, default=64, help="Pad sequence lengths to multiples of this when compiling")
+    parser.add_argument('--gradient_checkpointing', action='store_true', help="Recompute block activations in backward to save memory")
+    parser.add_argument('--checkpoint_stacks', type=str, default="both", choices=["encoder", "decoder", "both"], help="Which stacks to checkpoint")
+    parser.add_argument('--checkpoint_every_n_layers', type=int, default=1, help="Checkpoint every n-th block (1 = all blocks)")
+    parser.add_argument('--keep_last_n_checkpoints', type=int, default=2, help="Per-epoch checkpoints to keep (best is always kept)")
+    parser.add_argument('--resume', action='store_true', help="Resume from the experiment's last saved training state")
+    parser.add_argument('--save_every_n_steps', type=int, default=0, help="Also save training state every n optimizer steps (0 = epoch end only)")
+    parser.add_argument('--async_eval', action='store_true', help="Run detailed evals in a background process while training continues")
+    parser.add_argument('--async_eval_threads', type=int, default=2, help="CPU threads for the background evaluator")
     
     # Experiment tracking
     parser.add_argument('--use_wandb', action='store_true', help="Use Weights & Biases")
@@ -53,18 +117,46 @@ def get_args():
     parser.add_argument('--run_error_analysis', action='store_true', help="Run error analysis on dev set")
     
     args = parser.parse_args()
+    if args.freeze_encoder and not args.finetune:
+        parser.error("--freeze_encoder requires --finetune (a frozen random encoder is not useful)")
+    if args.lora and not args.finetune:
+        parser.error("--lora requires --finetune (adapters on a random model are not useful)")
+    if args.schema_prompt_tokens > 0 and (args.freeze_encoder or args.lora):
+        parser.error("--schema_prompt_tokens trains the shared embedding, which --freeze_encoder and --lora keep frozen")
+    if args.schema_prompt_tokens > 0 and args.schema_token_budget > 0:
+        parser.error("--schema_token_budget prunes the schema text, which --schema_prompt_tokens replaces")
+    if not 0 <= args.schema_prompt_tokens <= 100:
+        parser.error("--schema_prompt_tokens uses the 100 T5 sentinel tokens (0-100)")
+    if args.retrieval_draft and args.num_beams > 1:
+        parser.error("--retrieval_draft verifies drafts against greedy decoding (--num_beams 1)")
+    if args.retrieval_draft and args.constrained_decoding:
+        parser.error("--retrieval_draft verifies drafts against unconstrained greedy decoding")
+    if args.decode_slots and not args.static_decoder:
+        parser.error("--decode_slots requires --static_decoder")
     return args
 
 def train(args, model, train_loader, dev_loader, optimizer, scheduler, tokenizer):
     best_f1 = -1
     best_epoch = 0
     epochs_since_improvement = 0
+    start_epoch = 0
+    resume_state = None
 
     model_type = 'ft' if args.finetune else 'scratch'
     checkpoint_dir = os.path.join('checkpoints', f't5_{model_type}', args.experiment_name)
     os.makedirs(checkpoint_dir, exist_ok=True)
     args.checkpoint_dir = checkpoint_dir
     
+    # Continue an interrupted run from its last saved training state
+    if args.resume:
+        resume_state = load_training_state(checkpoint_dir, model, optimizer, scheduler)
+        if resume_state is not None:
+            start_epoch = args.max_n_epochs if resume_state['finished'] else resume_state['epoch']
+            best_f1 = resume_state['best_f1']
+            best_epoch = resume_state['best_epoch']
+            epochs_since_improvement = resume_state['epochs_since_improvement']
+            print(f"✓ Resuming at epoch {start_epoch + 1}, batch {resume_state['batches_done']} (best F1 so far: {best_f1:.4f})")
+    
     # Setup result paths
     os.makedirs('results', exist_ok=True)
     os.makedirs('records', exist_ok=True)
@@ -72,8 +164,8 @@ def train(args, model, train_loader, dev_loader, optimizer, scheduler, tokenizer
     print("\n" + "="*80)
     print(f"Training: {args.experiment_name}")
     print(f"Model: {model_type}")
-    print(f"Schema: {args.use_schema}")
-    print(f"LR: {args.learning_rate}, WD: {args.weight_decay}, Scheduler: {args.scheduler_type}")
+    print(f"Schema: {args.use_schema}" + (f" (as a {args.schema_prompt_tokens}-token learned prompt)" if args.schema_prompt_tokens else ""))
+    print(f"Optimizer: {args.optimizer}, LR: {args.learning_rate}, WD: {args.weight_decay}, Scheduler: {args.scheduler_type}")
     print(f"Batch size: {args.batch_size}, Grad accum: {args.gradient_accumulation_steps}")
     print(f"Max epochs: {args.max_n_epochs}, Patience: {args.patience_epochs}")
     print(f"Beams: {args.num_beams}")
@@ -81,78 +173,93 @@ def train(args, model, train_loader, dev_loader, optimizer, scheduler, tokenizer
     
     # Initialize wandb
     use_wandb = False
-    if args.use_wandb:
+    if args.use_wandb and is_main_process():
         use_wandb = setup_wandb(args)
     
-    for epoch in range(args.max_n_epochs):
+    # With --async_eval, detailed evals run in a background process on weight snapshots
+    evaluator = None
+    if args.async_eval:
+        if is_distributed():
+            print("⚠ --async_eval is not supported with DDP, evaluating synchronously")
+        else:
+            evaluator = AsyncEvaluator(args, async_eval_job, checkpoint_dir)
+    train_losses = {}
+    
+    # Background evals still in flight are part of the training state and re-queued on --resume
+    def pending_evals():
+        if evaluator is None:
+            return []
+        return [(eval_epoch_idx, job_kwargs, train_losses.get(eval_epoch_idx))
+                for eval_epoch_idx, job_kwargs in evaluator.pending_jobs()]
+    
+    if evaluator is not None:
+        pending = resume_state.get('pending_evals', []) if resume_state is not None else []
+        for eval_epoch_idx, _, train_loss in pending:
+            train_losses[eval_epoch_idx] = train_loss
+        evaluator.restore([(eval_epoch_idx, job_kwargs) for eval_epoch_idx, job_kwargs, _ in pending])
+    elif resume_state is not None and resume_state.get('pending_evals'):
+        print(f"⚠ {len(resume_state['pending_evals'])} background evaluation(s) of the interrupted run "
+              f"need --async_eval, skipping them")
+    
+    def reconcile(evaluated):
+        # Apply finished detailed evals in epoch order: report, track the best model, count patience
+        nonlocal best_f1, best_epoch, epochs_since_improvement
+        for eval_epoch_idx, eval_results in evaluated:
+            report_eval_results(eval_results, eval_epoch_idx, train_losses.get(eval_epoch_idx), use_wandb)
+            
+            # Check for improvement
+            improved = eval_results['record_f1'] > best_f1
+            if improved:
+                best_f1 = eval_results['record_f1']
+                best_epoch = eval_epoch_idx + 1
+                epochs_since_improvement = 0
+            if evaluator is not None:
+                evaluator.finish(eval_epoch_idx, best=improved)
+            elif improved:
+                save_model(checkpoint_dir, model, best=True)
+            
+            if improved:
+                print(f"✓ New best model! F1: {best_f1:.4f} (epoch {best_epoch})")
+            else:
+                epochs_since_improvement += 1
+                print(f"No improvement for {epochs_since_improvement} epoch(s)")
+    
+    for epoch in range(start_epoch, args.max_n_epochs):
         print(f"\n{'='*80}")
         print(f"Epoch {epoch + 1}/{args.max_n_epochs}")
         print(f"{'='*80}")
         
+        # Reshuffle the per-rank partition of the training data
+        if isinstance(train_loader.sampler, DistributedSampler):
+            train_loader.sampler.set_epoch(epoch)
+        
         # Training
-        tr_loss = train_epoch(args, model, train_loader, optimizer, scheduler)
+        progress = {
+            'epoch': epoch, 'best_f1': best_f1, 'best_epoch': best_epoch,
+            'epochs_since_improvement': epochs_since_improvement, 'finished': False,
+            'pending_evals': pending_evals(),
+        }
+        tr_loss = train_epoch(args, model, train_loader, optimizer, scheduler, progress, resume_state)
+        resume_state = None
         print(f"Train Loss: {tr_loss:.4f}")
 
         # Decide whether to do detailed or quick eval
         do_detailed_eval = (epoch % 5 == 0) or (epoch == args.max_n_epochs - 1)
+        train_losses[epoch] = tr_loss
+        evaluated = []
         
-        if do_detailed_eval:
+        if do_detailed_eval and evaluator is not None:
+            print("Queuing DETAILED evaluation in the background...")
+            evaluator.submit(model, epoch)
+        elif do_detailed_eval:
             print("Running DETAILED evaluation (with generation)...")
-            eval_results = eval_epoch(args, model, dev_loader, tokenizer, epoch)  # REMOVED detailed=True
-            
-            eval_loss = eval_results['loss']
-            record_f1 = eval_results['record_f1']
-            record_em = eval_results['record_em']
-            sql_em = eval_results['sql_em']
-            error_rate = eval_results['error_rate']
-            num_syntax_errors = eval_results['num_syntax_errors']
-            
-            print(f"Dev Loss: {eval_loss:.4f}")
-            print(f"Record F1: {record_f1:.4f}, Record EM: {record_em:.4f}, SQL EM: {sql_em:.4f}")
-            print(f"Syntax Errors: {num_syntax_errors} ({error_rate*100:.2f}%)")
-            
-            # Print some examples
-            print("\n" + "-"*80)
-            print("SAMPLE PREDICTIONS:")
-            print("-"*80)
-            for i, example in enumerate(eval_results['examples'][:3]):
-                print(f"\nExample {i+1}:")
-                print(f"  NL: {example['nl']}")
-                print(f"  Predicted: {example['pred'][:100]}...")
-                print(f"  Gold: {example['gold'][:100]}...")
-                print(f"  Match: {'✓' if example['match'] else '✗'}")
-                if example['error']:
-                    print(f"  ERROR: {example['error']}")
-            print("-"*80 + "\n")
-            
-            # Log to wandb
-            if use_wandb:
-                wandb.log({
-                    'epoch': epoch + 1,
-                    'train/loss': tr_loss,
-                    'dev/loss': eval_loss,
-                    'dev/record_f1': record_f1,
-                    'dev/record_em': record_em,
-                    'dev/sql_em': sql_em,
-                    'dev/error_rate': error_rate,
-                    'dev/num_syntax_errors': num_syntax_errors,
-                })
-            
-            # Check for improvement
-            if record_f1 > best_f1:
-                best_f1 = record_f1
-                best_epoch = epoch + 1
-                epochs_since_improvement = 0
-                save_model(checkpoint_dir, model, best=True)
-                print(f"✓ New best model! F1: {best_f1:.4f}")
-            else:
-                epochs_since_improvement += 1
-                print(f"No improvement for {epochs_since_improvement} epoch(s)")
+            eval_results = eval_epoch(args, unwrap_model(model), dev_loader, tokenizer, epoch)  # REMOVED detailed=True
+            evaluated.append((epoch, eval_results))
         
         else:
             # Quick eval - only compute loss
             print("Running QUICK evaluation (loss only)...")
-            eval_loss = eval_epoch_quick(args, model, dev_loader)
+            eval_loss = eval_epoch_quick(args, unwrap_model(model), dev_loader)
             print(f"Dev Loss: {eval_loss:.4f}")
             
             if use_wandb:
@@ -162,14 +269,30 @@ def train(args, model, train_loader, dev_loader, optimizer, scheduler, tokenizer
                     'dev/loss': eval_loss,
                 })
         
+        # Pick up background evaluations that finished while this epoch trained
+        if evaluator is not None:
+            evaluated += evaluator.poll()
+        reconcile(evaluated)
+        
         # Save model
-        save_model(checkpoint_dir, model, best=False)
+        save_model(checkpoint_dir, model, best=False, epoch=epoch, keep_last_n=args.keep_last_n_checkpoints)
 
-        # Early stopping (only check on detailed eval)
-        if do_detailed_eval and epochs_since_improvement >= args.patience_epochs:
+        # Early stopping (only check when detailed eval results come in)
+        stop = len(evaluated) > 0 and epochs_since_improvement >= args.patience_epochs
+        save_training_state(checkpoint_dir, model, optimizer, scheduler, {
+            'epoch': epoch + 1, 'batches_done': 0, 'best_f1': best_f1, 'best_epoch': best_epoch,
+            'epochs_since_improvement': epochs_since_improvement, 'finished': stop,
+            'pending_evals': pending_evals(),
+        })
+        if stop:
             print(f"\nEarly stopping after {epoch + 1} epochs")
             break
     
+    if evaluator is not None:
+        # Evaluations still in flight can change the best model, but not when training stopped
+        reconcile(evaluator.drain())
+        evaluator.close()
+    
     print(f"\n{'='*80}")
     print(f"Training completed!")
     print(f"Best F1: {best_f1:.4f} (epoch {best_epoch})")
@@ -177,45 +300,150 @@ def train(args, model, train_loader, dev_loader, optimizer, scheduler, tokenizer
     
     if use_wandb:
         wandb.finish()
+    
+    # Other ranks must not read checkpoints before rank 0 has written them
+    wait_for_checkpoints()
+    barrier()
 
-def train_epoch(args, model, train_loader, optimizer, scheduler):
+def report_eval_results(eval_results, epoch, tr_loss, use_wandb):
+    eval_loss = eval_results['loss']
+    record_f1 = eval_results['record_f1']
+    record_em = eval_results['record_em']
+    sql_em = eval_results['sql_em']
+    error_rate = eval_results['error_rate']
+    num_syntax_errors = eval_results['num_syntax_errors']
+    
+    print(f"\nDetailed evaluation of epoch {epoch + 1}:")
+    print(f"Dev Loss: {eval_loss:.4f}")
+    print(f"Record F1: {record_f1:.4f}, Record EM: {record_em:.4f}, SQL EM: {sql_em:.4f}")
+    print(f"Syntax Errors: {num_syntax_errors} ({error_rate*100:.2f}%)")
+    
+    # Print some examples
+    print("\n" + "-"*80)
+    print("SAMPLE PREDICTIONS:")
+    print("-"*80)
+    for i, example in enumerate(eval_results['examples'][:3]):
+        print(f"\nExample {i+1}:")
+        print(f"  NL: {example['nl']}")
+        print(f"  Predicted: {example['pred'][:100]}...")
+        print(f"  Gold: {example['gold'][:100]}...")
+        print(f"  Match: {'✓' if example['match'] else '✗'}")
+        if example['error']:
+            print(f"  ERROR: {example['error']}")
+    print("-"*80 + "\n")
+    
+    # Log to wandb
+    if use_wandb:
+        wandb.log({
+            'epoch': epoch + 1,
+            'train/loss': tr_loss,
+            'dev/loss': eval_loss,
+            'dev/record_f1': record_f1,
+            'dev/record_em': record_em,
+            'dev/sql_em': sql_em,
+            'dev/error_rate': error_rate,
+            'dev/num_syntax_errors': num_syntax_errors,
+        })
+
+def async_eval_job(args, snapshot_path, epoch, cache):
+    '''
+    Background evaluator job (see AsyncEvaluator): load a weight snapshot and run the
+    detailed dev evaluation on it. The model, tokenizer and dev loader are built once.
+    '''
+    if 'model' not in cache:
+        cache['tokenizer'] = T5TokenizerFast.from_pretrained('google-t5/t5-small')
+        cache['dev_loader'] = get_dataloader(args.test_batch_size, "dev", args.use_schema, args.use_preprocessed,
+                                             compress_targets=args.compress_sql, schema_prompt_tokens=args.schema_prompt_tokens,
+                                             schema_token_budget=args.schema_token_budget,
+                                             entity_linking=args.entity_linking,
+                                             anonymize_literals=args.anonymize_literals)
+        cache['model'] = initialize_model(args)
+    model = load_model_weights(cache['model'], snapshot_path)
+    return eval_epoch(args, model, cache['dev_loader'], cache['tokenizer'], epoch)
+
+def restricted_vocab_model(args, model, dev_loader, tokenizer, train_sql_queries, full_f1, length_predictor=None):
+    '''
+    Guarded --restrict_vocab: the best model with its LM head restricted to the train SQL
+    token ids, if its dev F1 is within --restrict_vocab_tolerance of the full head's
+    (full_f1); otherwise the full model is kept for test inference.
+    '''
+    print("\nEvaluating dev set with the restricted output vocabulary...")
+    restricted = load_model_from_checkpoint(args, best=True)
+    restrict_output_vocab(restricted, output_vocab_ids(tokenizer, train_sql_queries), tokenizer.unk_token_id)
+    restricted.eval()
+    if args.compile:
+        restricted = compile_model(restricted, args)
+    results = eval_epoch(args, restricted, dev_loader, tokenizer, epoch=998, length_predictor=length_predictor)
+    
+    f1_change = results['record_f1'] - full_f1
+    print(f"Restricted vocab Dev F1: {results['record_f1']:.4f} (change {f1_change:+.4f})")
+    if f1_change < -args.restrict_vocab_tolerance:
+        print(f"⚠ Dev F1 dropped by more than {args.restrict_vocab_tolerance}; using the full LM head")
+        return model
+    print("✓ Using the restricted output vocabulary for test inference")
+    return restricted
+
+def train_epoch(args, model, train_loader, optimizer, scheduler, progress=None, resume_state=None):
     model.train()
     total_loss = 0
     total_tokens = 0
     criterion = nn.CrossEntropyLoss(ignore_index=PAD_IDX, label_smoothing=0.1)
 
-    progress_bar = tqdm(train_loader, desc="Training")
+    # The shuffle order is drawn from the RNG when the loader starts iterating. An interrupted
+    # epoch is resumed by replaying it from the epoch-start RNG state and skipping the
+    # batches already trained on, then restoring the RNG state saved at that point.
+    start_batch = 0
+    if resume_state is not None and resume_state['batches_done'] > 0:
+        set_rng_state(resume_state['epoch_rng'])
+        start_batch = resume_state['batches_done']
+        total_loss, total_tokens = resume_state['train_loss_totals']
+    epoch_rng = get_rng_state()
+    batch_iter = iter(train_loader)
+    for _ in range(start_batch):
+        next(batch_iter)
+    if start_batch > 0:
+        set_rng_state(resume_state['rng'])
+
+    progress_bar = tqdm(batch_iter, desc="Training", initial=start_batch, total=len(train_loader), disable=not is_main_process())
     optimizer.zero_grad()
     
-    for batch_idx, (encoder_input, encoder_mask, decoder_input, decoder_targets, _) in enumerate(progress_bar):
+    for batch_idx, (encoder_input, encoder_mask, decoder_input, decoder_targets, _) in enumerate(progress_bar, start=start_batch):
         # Move to device
         encoder_input = encoder_input.to(DEVICE)
         encoder_mask = encoder_mask.to(DEVICE)
         decoder_input = decoder_input.to(DEVICE)
         decoder_targets = decoder_targets.to(DEVICE)
-
-        # Forward pass
-        outputs = model(
-            input_ids=encoder_input,
-            attention_mask=encoder_mask,
-            decoder_input_ids=decoder_input,
+        encoder_input, encoder_mask, decoder_input, decoder_targets = bucket_batch(
+            args, encoder_input, encoder_mask, decoder_input, decoder_targets
         )
-        logits = outputs.logits
 
-        # Compute loss
-        loss = criterion(
-            logits.reshape(-1, logits.size(-1)),
-            decoder_targets.reshape(-1)
-        )
-        
-        # Scale loss for gradient accumulation
-        loss = loss / args.gradient_accumulation_steps
+        # Under DDP, skip the gradient all-reduce on accumulation micro-steps
+        update_step = (batch_idx + 1) % args.gradient_accumulation_steps == 0
+        sync_context = model.no_sync() if isinstance(model, DDP) and not update_step else contextlib.nullcontext()
         
-        # Backward pass
-        loss.backward()
+        with sync_context:
+            # Forward pass
+            outputs = model(
+                **encoder_inputs(model, encoder_input, encoder_mask),
+                attention_mask=encoder_mask,
+                decoder_input_ids=decoder_input,
+            )
+            logits = outputs.logits
+
+            # Compute loss
+            loss = criterion(
+                logits.reshape(-1, logits.size(-1)),
+                decoder_targets.reshape(-1)
+            )
+            
+            # Scale loss for gradient accumulation
+            loss = loss / args.gradient_accumulation_steps
+            
+            # Backward pass
+            loss.backward()
         
         # Update weights after accumulation steps
-        if (batch_idx + 1) % args.gradient_accumulation_steps == 0:
+        if update_step:
             torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
             optimizer.step()
             if scheduler is not None: 
@@ -231,7 +459,16 @@ def train_epoch(args, model, train_loader, optimizer, scheduler):
         
         if batch_idx % 10 == 0:
             progress_bar.set_postfix({'loss': f'{loss.item() * args.gradient_accumulation_steps:.4f}'})
+        
+        # Periodic mid-epoch training state, on optimizer-step boundaries
+        if (progress is not None and args.save_every_n_steps > 0
+                and (batch_idx + 1) % (args.save_every_n_steps * args.gradient_accumulation_steps) == 0):
+            save_training_state(args.checkpoint_dir, model, optimizer, scheduler, dict(
+                progress, batches_done=batch_idx + 1, epoch_rng=epoch_rng,
+                train_loss_totals=(total_loss, total_tokens),
+            ))
 
+    total_loss, total_tokens = all_reduce_sum(total_loss, total_tokens)
     avg_loss = total_loss / total_tokens if total_tokens > 0 else 0
     return avg_loss
 
@@ -243,15 +480,18 @@ def eval_epoch_quick(args, model, dev_loader):
     criterion = nn.CrossEntropyLoss(ignore_index=PAD_IDX, label_smoothing=0.1)
     
     with torch.no_grad():
-        for encoder_input, encoder_mask, decoder_input, decoder_targets, _ in tqdm(dev_loader, desc="Quick Eval"):
+        for encoder_input, encoder_mask, decoder_input, decoder_targets, _ in tqdm(dev_loader, desc="Quick Eval", disable=not is_main_process()):
             encoder_input = encoder_input.to(DEVICE)
             encoder_mask = encoder_mask.to(DEVICE)
             decoder_input = decoder_input.to(DEVICE)
             decoder_targets = decoder_targets.to(DEVICE)
+            encoder_input, encoder_mask, decoder_input, decoder_targets = bucket_batch(
+                args, encoder_input, encoder_mask, decoder_input, decoder_targets
+            )
             
             # Compute loss
             outputs = model(
-                input_ids=encoder_input,
+                **encoder_inputs(model, encoder_input, encoder_mask),
                 attention_mask=encoder_mask,
                 decoder_input_ids=decoder_input,
             )
@@ -268,10 +508,11 @@ def eval_epoch_quick(args, model, dev_loader):
             total_loss += loss.item() * num_tokens
             total_tokens += num_tokens
     
+    total_loss, total_tokens = all_reduce_sum(total_loss, total_tokens)
     avg_loss = total_loss / total_tokens if total_tokens > 0 else 0
     return avg_loss
         
-def eval_epoch(args, model, dev_loader, tokenizer, epoch):
+def eval_epoch(args, model, dev_loader, tokenizer, epoch, length_predictor=None):
     '''
     You must implement the evaluation loop to be using during training. We recommend keeping track
     of the model loss on the SQL queries, the metrics compute_metrics returns (save_queries_and_records should be helpful)
@@ -288,19 +529,43 @@ def eval_epoch(args, model, dev_loader, tokenizer, epoch):
     
     sql_queries = []
     nl_queries = []
+    generation_cache = GenerationCache()
+    generator = StaticCacheDecoder(model, args.max_gen_length) if args.static_decoder else model
+    greedy_kwargs = {'num_slots': args.decode_slots} if args.static_decoder else {}
+    
+    # Grammar- and schema-constrained decoding (see sql_grammar)
+    grammar, decode_kwargs = None, {}
+    if args.constrained_decoding:
+        dataset = getattr(dev_loader.dataset, 'dataset', dev_loader.dataset)  # EncoderStateDataset wraps a T5Dataset
+        grammar = SQLGrammar.for_model(model, tokenizer, getattr(dataset, 'anonymizer', None))
+        decode_kwargs = {'logits_processor': LogitsProcessorList([grammar.logits_processor()])}
     
-    progress_bar = tqdm(dev_loader, desc="Detailed Eval")
+    # Per-question generation caps; a batch decodes up to its largest (see length_predictor)
+    caps = None
+    if length_predictor is not None:
+        questions = load_lines(os.path.join('data', 'dev.nl'))
+        caps = {idx: length_predictor.predict(questions[idx]) for idx in dev_loader.sampler}
+    
+    progress_bar = tqdm(dev_loader, desc="Detailed Eval", disable=not is_main_process())
     
     with torch.no_grad():
-        for batch_idx, (encoder_input, encoder_mask, decoder_input, decoder_targets, _) in enumerate(progress_bar):
+        for batch_ids, (encoder_input, encoder_mask, decoder_input, decoder_targets, _) in zip(dev_loader.batch_sampler, progress_bar):
             encoder_input = encoder_input.to(DEVICE)
             encoder_mask = encoder_mask.to(DEVICE)
             decoder_input = decoder_input.to(DEVICE)
             decoder_targets = decoder_targets.to(DEVICE)
+            encoder_input, encoder_mask, decoder_input, decoder_targets = bucket_batch(
+                args, encoder_input, encoder_mask, decoder_input, decoder_targets
+            )
+            
+            # Run the encoder once (or use cached states); its outputs feed both the loss and generation
+            encoder_outputs = get_encoder_outputs(model, encoder_input, encoder_mask)
+            decoder_input = to_output_vocab(model, decoder_input)
+            decoder_targets = to_output_vocab(model, decoder_targets)
             
             # Compute loss
             outputs = model(
-                input_ids=encoder_input,
+                encoder_outputs=encoder_outputs,
                 attention_mask=encoder_mask,
                 decoder_input_ids=decoder_input,
             )
@@ -318,29 +583,59 @@ def eval_epoch(args, model, dev_loader, tokenizer, epoch):
             total_tokens += num_tokens
             
             # Generate SQL queries
+            max_length = max(caps[idx] for idx in batch_ids) if caps else args.max_gen_length
             if args.num_beams > 1:
-                generated_ids = model.generate(
-                    input_ids=encoder_input,
-                    attention_mask=encoder_mask,
-                    max_length=args.max_gen_length,
+                generated_ids = generation_cache.generate(
+                    generator, encoder_input, encoder_mask,
+                    encoder_outputs=encoder_outputs,
+                    max_length=max_length,
                     num_beams=args.num_beams,
                     length_penalty=args.length_penalty,
                     early_stopping=True,
+                    **decode_kwargs,
                 )
             else:
-                generated_ids = model.generate(
-                    input_ids=encoder_input,
-                    attention_mask=encoder_mask,
-                    max_length=args.max_gen_length,
+                generated_ids = generation_cache.generate(
+                    generator, encoder_input, encoder_mask,
+                    encoder_outputs=encoder_outputs,
+                    max_length=max_length,
+                    **greedy_kwargs,
+                    **decode_kwargs,
                 )
             
             # Decode SQL
-            for gen_ids in generated_ids:
+            for idx, gen_ids in zip(batch_ids, from_output_vocab(model, generated_ids)):
+                if caps:
+                    gen_ids = length_predictor.capped(gen_ids, caps[idx], tokenizer.eos_token_id)
                 sql = tokenizer.decode(gen_ids, skip_special_tokens=True)
-                sql_queries.append(sql)
-    
+                sql_queries.append(expand_sql(sql) if args.compress_sql else sql)
+    
+    generation_cache.report()
+    if args.static_decoder:
+        generator.report()
+    if grammar is not None:
+        grammar.report()
+    if length_predictor is not None:
+        length_predictor.report()
+    sql_queries = restore_literals(dev_loader, sql_queries)
+    
+    total_loss, total_tokens = all_reduce_sum(total_loss, total_tokens)
     avg_loss = total_loss / total_tokens if total_tokens > 0 else 0
     
+    # Save queries and compute records (under DDP each rank executes its own shard)
+    model_type = 'ft' if args.finetune else 'scratch'
+    model_sql_path = f'results/t5_{model_type}_{args.experiment_name}_dev_epoch{epoch}.sql'
+    model_record_path = f'records/t5_{model_type}_{args.experiment_name}_dev_epoch{epoch}.pkl'
+    sql_queries = save_sharded_queries_and_records(sql_queries, model_sql_path, model_record_path)
+    
+    # Metrics are computed once on the main process and shared with the other ranks
+    results = score_dev_predictions(sql_queries, model_sql_path, model_record_path) if is_main_process() else None
+    results = broadcast_object(results)
+    
+    return {'loss': avg_loss, **results}
+
+def score_dev_predictions(sql_queries, model_sql_path, model_record_path):
+    """Compute dev metrics, syntax error counts and display examples for saved predictions."""
     # Load ground truth
     gt_sql_path = 'data/dev.sql'
     with open(gt_sql_path, 'r') as f:
@@ -351,18 +646,6 @@ def eval_epoch(args, model, dev_loader, tokenizer, epoch):
     with open(nl_path, 'r') as f:
         nl_queries = [line.strip() for line in f.readlines()]
     
-    # Save queries
-    model_type = 'ft' if args.finetune else 'scratch'
-    model_sql_path = f'results/t5_{model_type}_{args.experiment_name}_dev_epoch{epoch}.sql'
-    model_record_path = f'records/t5_{model_type}_{args.experiment_name}_dev_epoch{epoch}.pkl'
-    
-    with open(model_sql_path, 'w') as f:
-        for sql in sql_queries:
-            f.write(sql + '\n')
-    
-    # Compute records and save
-    save_queries_and_records(sql_queries, model_sql_path, model_record_path)
-    
     # Load ground truth records
     gt_record_path = 'records/ground_truth_dev.pkl'
     if not os.path.exists(gt_record_path):
@@ -395,7 +678,6 @@ def eval_epoch(args, model, dev_loader, tokenizer, epoch):
         })
 
     return {
-        'loss': avg_loss,
         'record_f1': record_f1,
         'record_em': record_em,
         'sql_em': sql_em,
@@ -405,46 +687,107 @@ def eval_epoch(args, model, dev_loader, tokenizer, epoch):
         'examples': examples,
     }
         
-def test_inference(args, model, test_loader, tokenizer, model_sql_path, model_record_path):
+def test_inference(args, model, test_loader, tokenizer, model_sql_path, model_record_path, length_predictor=None):
     '''
     You must implement inference to compute your model's generated SQL queries and its associated 
     database records. Implementation should be very similar to eval_epoch.
     '''
     model.eval()
-    sql_queries = []
+    predictions = {}
+    generation_cache = GenerationCache()
+    generator = StaticCacheDecoder(model, args.max_gen_length) if args.static_decoder else model
+    greedy_kwargs = {'num_slots': args.decode_slots} if args.static_decoder else {}
+    
+    # Grammar- and schema-constrained decoding (see sql_grammar)
+    grammar, decode_kwargs = None, {}
+    if args.constrained_decoding:
+        grammar = SQLGrammar.for_model(model, tokenizer, getattr(test_loader.dataset, 'anonymizer', None))
+        decode_kwargs = {'logits_processor': LogitsProcessorList([grammar.logits_processor()])}
     
     print(f"\nGenerating SQL for test set...")
-    progress_bar = tqdm(test_loader, desc="Testing")
+    # Questions close to a train question take the SQL of its template (see sql_templates)
+    # and, with --retrieval_draft, the others decode speculatively from that template
+    use_templates = args.template_threshold > 0 or args.retrieval_draft
+    template_matcher = TemplateMatcher.from_data('data', args.template_threshold) if use_templates else None
+    questions = load_lines(os.path.join('data', 'test.nl'))
+    num_matched = 0
+    draft_stats = {}
+    start_time = time.perf_counter()
+    
+    # With length caps, batches group questions of similar predicted length and decode
+    # up to the largest cap in the batch (see length_predictor)
+    caps = None
+    batches = zip(test_loader.batch_sampler, test_loader)
+    if length_predictor is not None:
+        caps = {idx: length_predictor.predict(questions[idx]) for idx in test_loader.sampler}
+        batches = length_grouped_batches(test_loader, caps)
+    progress_bar = tqdm(batches, total=len(test_loader), desc="Testing", disable=not is_main_process())
     
     with torch.no_grad():
-        for encoder_input, encoder_mask, _ in progress_bar:
-            encoder_input = encoder_input.to(DEVICE)
-            encoder_mask = encoder_mask.to(DEVICE)
+        for batch_ids, (encoder_input, encoder_mask, _) in progress_bar:
+            batch_sql = [template_matcher.match(questions[idx]) if args.template_threshold > 0 else None for idx in batch_ids]
+            rows = [row for row, sql in enumerate(batch_sql) if sql is None]
+            num_matched += len(batch_sql) - len(rows)
+            if not rows:
+                predictions.update(zip(batch_ids, batch_sql))
+                continue
+            
+            rows_index = torch.tensor(rows)
+            encoder_input = encoder_input[rows_index].to(DEVICE)
+            encoder_mask = encoder_mask[rows_index].to(DEVICE)
+            encoder_input, encoder_mask = bucket_batch(args, encoder_input, encoder_mask)
             
             # Generate
-            if args.num_beams > 1:
-                generated_ids = model.generate(
-                    input_ids=encoder_input,
-                    attention_mask=encoder_mask,
-                    max_length=args.max_gen_length,
+            max_length = max(caps[batch_ids[row]] for row in rows) if caps else args.max_gen_length
+            if args.retrieval_draft:
+                drafts = [tokenizer(compress_sql(sql) if args.compress_sql else sql)['input_ids']
+                          for sql in (template_matcher.draft(questions[batch_ids[row]], args.anonymize_literals) for row in rows)]
+                generated_ids = speculative_generate(
+                    model, get_encoder_outputs(model, encoder_input, encoder_mask), encoder_mask, drafts,
+                    max_length, args.num_draft_tokens, stats=draft_stats,
+                )
+            elif args.num_beams > 1:
+                generated_ids = generation_cache.generate(
+                    generator, encoder_input, encoder_mask,
+                    max_length=max_length,
                     num_beams=args.num_beams,
                     length_penalty=args.length_penalty,
                     early_stopping=True,
+                    **decode_kwargs,
                 )
             else:
-                generated_ids = model.generate(
-                    input_ids=encoder_input,
-                    attention_mask=encoder_mask,
-                    max_length=args.max_gen_length,
+                generated_ids = generation_cache.generate(
+                    generator, encoder_input, encoder_mask,
+                    max_length=max_length,
+                    **greedy_kwargs,
+                    **decode_kwargs,
                 )
             
             # Decode
-            for gen_ids in generated_ids:
+            for row, gen_ids in zip(rows, from_output_vocab(model, generated_ids)):
+                if caps:
+                    gen_ids = length_predictor.capped(gen_ids, caps[batch_ids[row]], tokenizer.eos_token_id)
                 sql = tokenizer.decode(gen_ids, skip_special_tokens=True)
-                sql_queries.append(sql)
-    
-    # Save    
-    save_queries_and_records(sql_queries, model_sql_path, model_record_path)
+                sql = expand_sql(sql) if args.compress_sql else sql
+                batch_sql[row] = test_loader.dataset.restore_literals(batch_ids[row], sql)
+            predictions.update(zip(batch_ids, batch_sql))
+    sql_queries = [predictions[idx] for idx in test_loader.sampler]
+    
+    generation_cache.report()
+    if args.static_decoder:
+        generator.report()
+    if grammar is not None:
+        grammar.report()
+    if length_predictor is not None:
+        length_predictor.report()
+    if args.template_threshold > 0:
+        print(f"✓ Template fast path: {num_matched}/{len(sql_queries)} questions answered without decoding")
+    if args.retrieval_draft and draft_stats:
+        print(f"✓ Retrieval drafts: {draft_stats['tokens'] / draft_stats['forwards']:.2f} tokens per decoder forward, "
+              f"{1000 * (time.perf_counter() - start_time) / len(sql_queries):.1f} ms/question")
+    
+    # Save (under DDP each rank executes its own shard)
+    sql_queries = save_sharded_queries_and_records(sql_queries, model_sql_path, model_record_path)
 
     print(f"✓ Saved {len(sql_queries)} queries to {model_sql_path}")
     print(f"✓ Saved records to {model_record_path}")
@@ -455,11 +798,16 @@ def main():
     # Get key arguments
     args = get_args()
     
+    # Data-parallel training when launched with torchrun (gloo backend, CPU friendly)
+    rank, world_size = setup_distributed()
+    
     print("\n" + "="*80)
     print("T5 Text-to-SQL Training")
     print("="*80)
     for arg, value in vars(args).items():
         print(f"  {arg}: {value}")
+    if world_size > 1:
+        print(f"  distributed: {world_size} processes (gloo)")
     print("="*80 + "\n")
     
     # Load tokenizer and data
@@ -467,12 +815,43 @@ def main():
     train_loader, dev_loader, test_loader = load_t5_data(
         args.batch_size, args.test_batch_size,
         use_schema=args.use_schema,
-        use_preprocessed=args.use_preprocessed
+        use_preprocessed=args.use_preprocessed,
+        distributed=is_distributed(),
+        compress_targets=args.compress_sql,
+        schema_prompt_tokens=args.schema_prompt_tokens,
+        schema_token_budget=args.schema_token_budget,
+        entity_linking=args.entity_linking,
+        anonymize_literals=args.anonymize_literals
     )
+    train_sql_queries = train_loader.dataset.sql_queries
+    
+    # Per-question generation caps for the final eval and test inference
+    length_predictor = None
+    if args.length_margin > 0:
+        # With --anonymize_literals the targets hold placeholders, so questions are compared anonymized too
+        anonymizer = train_loader.dataset.anonymizer if args.anonymize_literals else None
+        length_predictor = LengthPredictor(tokenizer, load_lines('data/train.nl'), train_sql_queries, anonymizer,
+                                           max_length=args.max_gen_length, margin=args.length_margin)
     
     # Initialize model
     model = initialize_model(args)
+    if args.freeze_encoder:
+        # Encode every train/dev input once; training steps then only run the decoder
+        if is_main_process():
+            encoder_cache = EncoderStateCache(model)
+            encoder_cache.build(train_loader.dataset, args.test_batch_size)
+            encoder_cache.build(dev_loader.dataset, args.test_batch_size)
+        barrier()
+        encoder_cache = EncoderStateCache(model)
+        train_loader = with_encoder_cache(train_loader, encoder_cache)
+        dev_loader = with_encoder_cache(dev_loader, encoder_cache)
+    if args.gradient_checkpointing:
+        enable_gradient_checkpointing(model, args.checkpoint_stacks, args.checkpoint_every_n_layers)
     optimizer, scheduler = initialize_optimizer_and_scheduler(args, model, len(train_loader))
+    if args.compile:
+        model = compile_model(model, args)
+    if is_distributed():
+        model = DDP(model)
     
     # Train
     train(args, model, train_loader, dev_loader, optimizer, scheduler, tokenizer)
@@ -481,14 +860,20 @@ def main():
     print("\nLoading best model for final evaluation...")
     model = load_model_from_checkpoint(args, best=True)
     model.eval()
+    if args.compile:
+        model = compile_model(model, args)
     
     # Final dev evaluation
     print("\nFinal dev set evaluation...")
-    eval_results = eval_epoch(args, model, dev_loader, tokenizer, epoch=999)
+    eval_results = eval_epoch(args, model, dev_loader, tokenizer, epoch=999, length_predictor=length_predictor)
     print(f"Final Dev F1: {eval_results['record_f1']:.4f}")
+    
+    if args.restrict_vocab:
+        model = restricted_vocab_model(args, model, dev_loader, tokenizer, train_sql_queries, eval_results['record_f1'],
+                                       length_predictor)
 
     # Run error analysis if requested
-    if args.run_error_analysis:
+    if args.run_error_analysis and is_main_process():
         print("\nRunning error analysis...")
         model_type = 'ft' if args.finetune else 'scratch'
         pred_sql_path = f'results/t5_{model_type}_{args.experiment_name}_dev_epoch999.sql'
@@ -502,7 +887,7 @@ def main():
     model_type = 'ft' if args.finetune else 'scratch'
     test_sql_path = f'results/t5_{model_type}_{args.experiment_name}_test.sql'
     test_record_path = f'records/t5_{model_type}_{args.experiment_name}_test.pkl'
-    test_queries = test_inference(args, model, test_loader, tokenizer, test_sql_path, test_record_path)
+    test_queries = test_inference(args, model, test_loader, tokenizer, test_sql_path, test_record_path, length_predictor)
     
     print("\n" + "="*80)
     print("✓ Training complete!")
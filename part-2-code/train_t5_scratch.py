@@ -4,20 +4,36 @@ from tqdm import tqdm
 
 import torch
 import torch.nn as nn
+from torch.utils.data import DataLoader, Subset
 import numpy as np
 import wandb
 
-from t5_utils import initialize_optimizer_and_scheduler, save_model, setup_wandb
+from t5_utils import initialize_optimizer_and_scheduler, save_model, setup_wandb, compile_model, bucket_batch, enable_gradient_checkpointing
+from t5_utils import wait_for_checkpoints, get_checkpoint_path, load_model_weights, save_training_state, load_training_state, AsyncEvaluator
 from t5_utils_scratch import initialize_model_scratch, apply_weight_init
 from transformers import GenerationConfig, T5TokenizerFast
-from load_data_scratch import load_t5_data_scratch
-from utils import compute_metrics, save_queries_and_records
+from load_data_scratch import load_t5_data_scratch, get_dataloader_scratch
+from sql_tokenizer import SQLTokenizer, TrimmedTokenizer
+from utils import save_queries_and_records, load_queries_and_records, read_queries, get_rng_state, set_rng_state
+from utils import compute_sql_exact_match, compute_record_exact_match, compute_record_F1s, stratified_subset, mean_confidence_interval
 
 DEVICE = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
 PAD_IDX = 0
 
 print(f"Using device: {DEVICE}")
 
+def load_scratch_tokenizer(args):
+    """Tokenizer for scratch training: the domain SQL tokenizer or t5-small's (optionally trimmed)"""
+    if args.sql_tokenizer:
+        tokenizer = SQLTokenizer.load_or_train(args.sql_tokenizer_path, min_freq=args.sql_tokenizer_min_freq)
+    elif args.trim_vocab:
+        tokenizer = TrimmedTokenizer.load_or_build(args.trim_vocab_path, T5TokenizerFast.from_pretrained('google-t5/t5-small'))
+    else:
+        return T5TokenizerFast.from_pretrained('google-t5/t5-small')
+    # The model's embedding and LM head are sized to this vocabulary
+    args.vocab_size = len(tokenizer)
+    return tokenizer
+
 def get_end_token_id(tokenizer):
     """Get the token ID for 'END'"""
     # Tokenize "END" to get its ID
@@ -82,10 +98,20 @@ def get_args():
     # Scratch-specific hyperparameters
     parser.add_argument('--dropout_rate', type=float, default=0.2, help="Dropout rate (default: 0.2)")
     parser.add_argument('--label_smoothing', type=float, default=0.1, help="Label smoothing (default: 0.1)")
+    parser.add_argument('--sql_tokenizer', action='store_true',
+                        help="Use a domain tokenizer trained on the train split (smaller vocab, shorter sequences) instead of t5-small's")
+    parser.add_argument('--sql_tokenizer_path', type=str, default="tokenizers/sql_tokenizer.json", help="Where the SQL tokenizer is saved/loaded")
+    parser.add_argument('--sql_tokenizer_min_freq', type=int, default=2, help="Min train-split count for a unit to get its own token")
+    parser.add_argument('--trim_vocab', action='store_true',
+                        help="Keep t5-small's tokenizer but only allocate embeddings for token ids that occur in the data")
+    parser.add_argument('--trim_vocab_path', type=str, default="tokenizers/trimmed_t5_vocab.json", help="Where the trimmed token ids are saved/loaded")
 
     # Training hyperparameters
     parser.add_argument('--learning_rate', type=float, default=5e-5, help="Learning rate")
     parser.add_argument('--weight_decay', type=float, default=0.1, help="Weight decay")
+    parser.add_argument('--optimizer', type=str, default="adamw", choices=["adamw", "adafactor"],
+                        help="AdamW, or Adafactor with factorized second moments (less optimizer memory)")
+    parser.add_argument('--adafactor_beta1', type=float, default=None, help="Adafactor first-moment decay (default: no first moment)")
     parser.add_argument('--scheduler_type', type=str, default="cosine", choices=["cosine", "linear"])
     parser.add_argument('--num_warmup_epochs', type=int, default=5, help="Warmup epochs")
     parser.add_argument('--max_n_epochs', type=int, default=100, help="Max training epochs")
@@ -103,24 +129,53 @@ def get_args():
     parser.add_argument('--max_gen_length', type=int, default=512, help="Max generation length")
     parser.add_argument('--num_beams', type=int, default=1, help="Beam search width (1=greedy)")
     
+    # Performance
+    parser.add_argument('--compile', action='store_true', help="Compile the model forward with torch.compile")
+    parser.add_argument('--compile_bucket_size', type=int, default=64, help="Pad sequence lengths to multiples of this when compiling")
+    parser.add_argument('--gradient_checkpointing', action='store_true', help="Recompute block activations in backward to save memory")
+    parser.add_argument('--checkpoint_stacks', type=str, default="both", choices=["encoder", "decoder", "both"], help="Which stacks to checkpoint")
+    parser.add_argument('--checkpoint_every_n_layers', type=int, default=1, help="Checkpoint every n-th block (1 = all blocks)")
+    parser.add_argument('--keep_last_n_checkpoints', type=int, default=2, help="Per-epoch checkpoints to keep (best is always kept)")
+    parser.add_argument('--resume', action='store_true', help="Resume from the experiment's last saved training state")
+    parser.add_argument('--save_every_n_steps', type=int, default=0, help="Also save training state every n optimizer steps (0 = epoch end only)")
+    parser.add_argument('--async_eval', action='store_true', help="Run detailed evals in a background process while training continues")
+    parser.add_argument('--async_eval_threads', type=int, default=2, help="CPU threads for the background evaluator")
+    
     # Experiment tracking
     parser.add_argument('--use_wandb', action='store_true', help="Use Weights & Biases")
     parser.add_argument('--experiment_name', type=str, default='scratch_exp', help="Experiment name")
     parser.add_argument('--run_error_analysis', action='store_true', help="Run error analysis")
     parser.add_argument('--eval_every_n_epochs', type=int, default=10, help="Detailed eval frequency")
+    parser.add_argument('--dev_subset_size', type=int, default=0,
+                        help="Periodic detailed evals use a stratified dev subset of this size, and the full dev set only when it suggests a new best (0 = always full dev)")
+    parser.add_argument('--dev_subset_confidence', type=float, default=0.9, help="Confidence level of the subset record F1 interval")
     
     args = parser.parse_args()
+    if args.sql_tokenizer and args.trim_vocab:
+        parser.error("--trim_vocab only applies to the t5-small tokenizer (the SQL tokenizer is already domain-sized)")
     return args
 
 def train(args, model, train_loader, dev_loader, optimizer, scheduler, tokenizer):
     best_f1 = -1
     best_epoch = 0
     epochs_since_improvement = 0
+    start_epoch = 0
+    resume_state = None
 
     checkpoint_dir = os.path.join('checkpoints', 't5_scratch', args.experiment_name)
     os.makedirs(checkpoint_dir, exist_ok=True)
     args.checkpoint_dir = checkpoint_dir
     
+    # Continue an interrupted run from its last saved training state
+    if args.resume:
+        resume_state = load_training_state(checkpoint_dir, model, optimizer, scheduler)
+        if resume_state is not None:
+            start_epoch = args.max_n_epochs if resume_state['finished'] else resume_state['epoch']
+            best_f1 = resume_state['best_f1']
+            best_epoch = resume_state['best_epoch']
+            epochs_since_improvement = resume_state['epochs_since_improvement']
+            print(f"✓ Resuming at epoch {start_epoch + 1}, batch {resume_state['batches_done']} (best F1 so far: {best_f1:.4f})")
+    
     # Setup result paths
     os.makedirs('results', exist_ok=True)
     os.makedirs('records', exist_ok=True)
@@ -137,7 +192,7 @@ def train(args, model, train_loader, dev_loader, optimizer, scheduler, tokenizer
     print(f"SCRATCH TRAINING: {args.experiment_name}")
     print("="*80)
     print(f"Schema: {args.use_schema}")
-    print(f"LR: {args.learning_rate}, WD: {args.weight_decay}")
+    print(f"Optimizer: {args.optimizer}, LR: {args.learning_rate}, WD: {args.weight_decay}")
     print(f"Scheduler: {args.scheduler_type}, Warmup: {args.num_warmup_epochs} epochs")
     print(f"Batch size: {args.batch_size}, Grad accum: {args.gradient_accumulation_steps}")
     print(f"Effective batch size: {args.batch_size * args.gradient_accumulation_steps}")
@@ -145,6 +200,9 @@ def train(args, model, train_loader, dev_loader, optimizer, scheduler, tokenizer
     print(f"Dropout: {args.dropout_rate}, Label smoothing: {args.label_smoothing}")
     print(f"Max grad norm: {args.max_grad_norm}")
     print(f"Heavy augmentation: {args.heavy_augmentation}")
+    print(f"Tokenizer: {'SQL domain' if args.sql_tokenizer else 'google-t5/t5-small'}{' (trimmed)' if args.trim_vocab else ''}")
+    if args.dev_subset_indices is not None:
+        print(f"Periodic detailed evals on a stratified dev subset of {len(args.dev_subset_indices)} examples")
     print(f"Format: Question/Answer with END tokens")
     print(f"Loss: Excludes END token and everything after")
     print("="*80 + "\n")
@@ -154,70 +212,76 @@ def train(args, model, train_loader, dev_loader, optimizer, scheduler, tokenizer
     if args.use_wandb:
         use_wandb = setup_wandb_scratch(args) 
     
-    for epoch in range(args.max_n_epochs):
+    # With --async_eval, detailed evals run in a background process on weight snapshots
+    evaluator = AsyncEvaluator(args, async_eval_job, checkpoint_dir) if args.async_eval else None
+    train_losses = {}
+    
+    # Background evals still in flight are part of the training state and re-queued on --resume
+    def pending_evals():
+        if evaluator is None:
+            return []
+        return [(eval_epoch_idx, job_kwargs, train_losses.get(eval_epoch_idx))
+                for eval_epoch_idx, job_kwargs in evaluator.pending_jobs()]
+    
+    if evaluator is not None:
+        pending = resume_state.get('pending_evals', []) if resume_state is not None else []
+        for eval_epoch_idx, _, train_loss in pending:
+            train_losses[eval_epoch_idx] = train_loss
+        evaluator.restore([(eval_epoch_idx, job_kwargs) for eval_epoch_idx, job_kwargs, _ in pending])
+    elif resume_state is not None and resume_state.get('pending_evals'):
+        print(f"⚠ {len(resume_state['pending_evals'])} background evaluation(s) of the interrupted run "
+              f"need --async_eval, skipping them")
+    
+    def reconcile(evaluated):
+        # Apply finished detailed evals in epoch order: report, track the best model, count patience
+        nonlocal best_f1, best_epoch, epochs_since_improvement
+        for eval_epoch_idx, eval_results in evaluated:
+            report_eval_results(eval_results, eval_epoch_idx, train_losses.get(eval_epoch_idx), use_wandb)
+            
+            # Check for improvement
+            improved = eval_results['record_f1'] > best_f1
+            if improved:
+                best_f1 = eval_results['record_f1']
+                best_epoch = eval_epoch_idx + 1
+                epochs_since_improvement = 0
+            if evaluator is not None:
+                evaluator.finish(eval_epoch_idx, best=improved)
+            elif improved:
+                save_model(checkpoint_dir, model, best=True)
+            
+            if improved:
+                print(f"✓ New best model! F1: {best_f1:.4f} (epoch {best_epoch})")
+            else:
+                epochs_since_improvement += 1
+                print(f"No improvement for {epochs_since_improvement} epoch(s)")
+    
+    for epoch in range(start_epoch, args.max_n_epochs):
         print(f"\n{'='*80}")
         print(f"Epoch {epoch + 1}/{args.max_n_epochs}")
         print(f"{'='*80}")
         
         # Training
-        tr_loss = train_epoch(args, model, train_loader, optimizer, scheduler, end_token_id)
+        progress = {
+            'epoch': epoch, 'best_f1': best_f1, 'best_epoch': best_epoch,
+            'epochs_since_improvement': epochs_since_improvement, 'finished': False,
+            'pending_evals': pending_evals(),
+        }
+        tr_loss = train_epoch(args, model, train_loader, optimizer, scheduler, end_token_id, progress, resume_state)
+        resume_state = None
         print(f"Train Loss: {tr_loss:.4f}")
 
         # Decide evaluation frequency
         do_detailed_eval = (epoch % args.eval_every_n_epochs == 0) or (epoch == args.max_n_epochs - 1)
+        train_losses[epoch] = tr_loss
+        evaluated = []
         
-        if do_detailed_eval:
+        if do_detailed_eval and evaluator is not None:
+            print("Queuing DETAILED evaluation in the background...")
+            evaluator.submit(model, epoch, best_f1=best_f1)
+        elif do_detailed_eval:
             print("Running DETAILED evaluation (with generation)...")
-            eval_results = eval_epoch(args, model, dev_loader, tokenizer, epoch, end_token_id)
-            
-            eval_loss = eval_results['loss']
-            record_f1 = eval_results['record_f1']
-            record_em = eval_results['record_em']
-            sql_em = eval_results['sql_em']
-            error_rate = eval_results['error_rate']
-            num_syntax_errors = eval_results['num_syntax_errors']
-            
-            print(f"Dev Loss: {eval_loss:.4f}")
-            print(f"Record F1: {record_f1:.4f}, Record EM: {record_em:.4f}, SQL EM: {sql_em:.4f}")
-            print(f"Syntax Errors: {num_syntax_errors} ({error_rate*100:.2f}%)")
-            
-            # Print sample predictions
-            print("\n" + "-"*80)
-            print("SAMPLE PREDICTIONS:")
-            print("-"*80)
-            for i, example in enumerate(eval_results['examples'][:3]):
-                print(f"\nExample {i+1}:")
-                print(f"  NL: {example['nl'][:80]}...")
-                print(f"  Predicted: {example['pred'][:80]}...")
-                print(f"  Gold: {example['gold'][:80]}...")
-                print(f"  Match: {'✓' if example['match'] else '✗'}")
-                if example['error']:
-                    print(f"  ERROR: {example['error'][:60]}...")
-            print("-"*80 + "\n")
-            
-            # Log to wandb
-            if use_wandb:
-                wandb.log({
-                    'epoch': epoch + 1,
-                    'train/loss': tr_loss,
-                    'dev/loss': eval_loss,
-                    'dev/record_f1': record_f1,
-                    'dev/record_em': record_em,
-                    'dev/sql_em': sql_em,
-                    'dev/error_rate': error_rate,
-                    'dev/num_syntax_errors': num_syntax_errors,
-                })
-            
-            # Check for improvement
-            if record_f1 > best_f1:
-                best_f1 = record_f1
-                best_epoch = epoch + 1
-                epochs_since_improvement = 0
-                save_model(checkpoint_dir, model, best=True)
-                print(f"✓ New best model! F1: {best_f1:.4f}")
-            else:
-                epochs_since_improvement += 1
-                print(f"No improvement for {epochs_since_improvement} epoch(s)")
+            eval_results = detailed_eval(args, model, dev_loader, tokenizer, epoch, end_token_id, best_f1)
+            evaluated.append((epoch, eval_results))
         
         else:
             # Quick eval - only compute loss
@@ -232,14 +296,30 @@ def train(args, model, train_loader, dev_loader, optimizer, scheduler, tokenizer
                     'dev/loss': eval_loss,
                 })
         
+        # Pick up background evaluations that finished while this epoch trained
+        if evaluator is not None:
+            evaluated += evaluator.poll()
+        reconcile(evaluated)
+        
         # Save last model
-        save_model(checkpoint_dir, model, best=False)
-
-        # Early stopping (only check on detailed eval)
-        if do_detailed_eval and epochs_since_improvement >= args.patience_epochs:
+        save_model(checkpoint_dir, model, best=False, epoch=epoch, keep_last_n=args.keep_last_n_checkpoints)
+
+        # Early stopping (only check when detailed eval results come in)
+        stop = len(evaluated) > 0 and epochs_since_improvement >= args.patience_epochs
+        save_training_state(checkpoint_dir, model, optimizer, scheduler, {
+            'epoch': epoch + 1, 'batches_done': 0, 'best_f1': best_f1, 'best_epoch': best_epoch,
+            'epochs_since_improvement': epochs_since_improvement, 'finished': stop,
+            'pending_evals': pending_evals(),
+        })
+        if stop:
             print(f"\nEarly stopping after {epoch + 1} epochs")
             break
     
+    if evaluator is not None:
+        # Evaluations still in flight can change the best model, but not when training stopped
+        reconcile(evaluator.drain())
+        evaluator.close()
+    
     print(f"\n{'='*80}")
     print(f"Training completed!")
     print(f"Best F1: {best_f1:.4f} (epoch {best_epoch})")
@@ -248,7 +328,84 @@ def train(args, model, train_loader, dev_loader, optimizer, scheduler, tokenizer
     if use_wandb:
         wandb.finish()
 
-def train_epoch(args, model, train_loader, optimizer, scheduler, end_token_id):
+def report_eval_results(eval_results, epoch, tr_loss, use_wandb):
+    eval_loss = eval_results['loss']
+    record_f1 = eval_results['record_f1']
+    record_em = eval_results['record_em']
+    sql_em = eval_results['sql_em']
+    error_rate = eval_results['error_rate']
+    num_syntax_errors = eval_results['num_syntax_errors']
+    
+    print(f"\nDetailed evaluation of epoch {epoch + 1}:")
+    print(f"Dev Loss: {eval_loss:.4f}")
+    print(f"Record F1: {record_f1:.4f}, Record EM: {record_em:.4f}, SQL EM: {sql_em:.4f}")
+    print(f"Syntax Errors: {num_syntax_errors} ({error_rate*100:.2f}%)")
+    if eval_results['subset']:
+        print(f"(on a dev subset of {eval_results['num_examples']} examples)")
+    
+    # Print sample predictions
+    print("\n" + "-"*80)
+    print("SAMPLE PREDICTIONS:")
+    print("-"*80)
+    for i, example in enumerate(eval_results['examples'][:3]):
+        print(f"\nExample {i+1}:")
+        print(f"  NL: {example['nl'][:80]}...")
+        print(f"  Predicted: {example['pred'][:80]}...")
+        print(f"  Gold: {example['gold'][:80]}...")
+        print(f"  Match: {'✓' if example['match'] else '✗'}")
+        if example['error']:
+            print(f"  ERROR: {example['error'][:60]}...")
+    print("-"*80 + "\n")
+    
+    # Log to wandb
+    if use_wandb:
+        wandb.log({
+            'epoch': epoch + 1,
+            'train/loss': tr_loss,
+            'dev/loss': eval_loss,
+            'dev/record_f1': record_f1,
+            'dev/record_em': record_em,
+            'dev/sql_em': sql_em,
+            'dev/error_rate': error_rate,
+            'dev/num_syntax_errors': num_syntax_errors,
+        })
+
+def detailed_eval(args, model, dev_loader, tokenizer, epoch, end_token_id, best_f1):
+    """
+    Detailed dev evaluation for checkpoint selection. With --dev_subset_size, the
+    stratified subset is evaluated first and the full dev set only if the upper end of
+    the subset's record F1 interval exceeds best_f1. Otherwise the subset results are
+    returned; their record F1 is below best_f1, so they never count as an improvement.
+    """
+    if args.dev_subset_indices is None:
+        return eval_epoch(args, model, dev_loader, tokenizer, epoch, end_token_id)
+    
+    subset_results = eval_epoch(args, model, dev_loader, tokenizer, epoch, end_token_id, indices=args.dev_subset_indices)
+    ci_low, ci_high = subset_results['record_f1_ci']
+    print(f"Dev subset Record F1: {subset_results['record_f1']:.4f} "
+          f"({args.dev_subset_confidence:.0%} CI {ci_low:.4f}-{ci_high:.4f}, {subset_results['num_examples']} examples)")
+    if ci_high <= best_f1:
+        print(f"Subset rules out a new best (best F1: {best_f1:.4f}), skipping full dev evaluation")
+        return subset_results
+    
+    print("Subset suggests a possible new best, running full dev evaluation...")
+    return eval_epoch(args, model, dev_loader, tokenizer, epoch, end_token_id)
+
+def async_eval_job(args, snapshot_path, epoch, cache, best_f1=-1):
+    """
+    Background evaluator job (see AsyncEvaluator): load a weight snapshot and run the
+    detailed dev evaluation on it. The model, tokenizer and dev loader are built once.
+    """
+    if 'model' not in cache:
+        cache['tokenizer'] = load_scratch_tokenizer(args)
+        cache['end_token_id'] = get_end_token_id(cache['tokenizer'])
+        cache['dev_loader'] = get_dataloader_scratch(args.test_batch_size, "dev", args.use_schema, args.use_preprocessed,
+                                                     tokenizer=cache['tokenizer'])
+        cache['model'] = initialize_model_scratch(args)
+    model = load_model_weights(cache['model'], snapshot_path)
+    return detailed_eval(args, model, cache['dev_loader'], cache['tokenizer'], epoch, cache['end_token_id'], best_f1)
+
+def train_epoch(args, model, train_loader, optimizer, scheduler, end_token_id, progress=None, resume_state=None):
     model.train()
     total_loss = 0
     total_tokens = 0
@@ -257,15 +414,33 @@ def train_epoch(args, model, train_loader, optimizer, scheduler, end_token_id):
         label_smoothing=args.label_smoothing
     )
 
-    progress_bar = tqdm(train_loader, desc="Training")
+    # The shuffle order is drawn from the RNG when the loader starts iterating. An interrupted
+    # epoch is resumed by replaying it from the epoch-start RNG state and skipping the
+    # batches already trained on, then restoring the RNG state saved at that point.
+    start_batch = 0
+    if resume_state is not None and resume_state['batches_done'] > 0:
+        set_rng_state(resume_state['epoch_rng'])
+        start_batch = resume_state['batches_done']
+        total_loss, total_tokens = resume_state['train_loss_totals']
+    epoch_rng = get_rng_state()
+    batch_iter = iter(train_loader)
+    for _ in range(start_batch):
+        next(batch_iter)
+    if start_batch > 0:
+        set_rng_state(resume_state['rng'])
+
+    progress_bar = tqdm(batch_iter, desc="Training", initial=start_batch, total=len(train_loader))
     optimizer.zero_grad()
     
-    for batch_idx, (encoder_input, encoder_mask, decoder_input, decoder_targets, _) in enumerate(progress_bar):
+    for batch_idx, (encoder_input, encoder_mask, decoder_input, decoder_targets, _) in enumerate(progress_bar, start=start_batch):
         # Move to device
         encoder_input = encoder_input.to(DEVICE)
         encoder_mask = encoder_mask.to(DEVICE)
         decoder_input = decoder_input.to(DEVICE)
         decoder_targets = decoder_targets.to(DEVICE)
+        encoder_input, encoder_mask, decoder_input, decoder_targets = bucket_batch(
+            args, encoder_input, encoder_mask, decoder_input, decoder_targets
+        )
 
         # Mask END token and everything after it
         masked_targets = mask_end_token_and_after(decoder_targets, end_token_id)
@@ -307,6 +482,14 @@ def train_epoch(args, model, train_loader, optimizer, scheduler, end_token_id):
         
         if batch_idx % 10 == 0:
             progress_bar.set_postfix({'loss': f'{loss.item() * args.gradient_accumulation_steps:.4f}'})
+        
+        # Periodic mid-epoch training state, on optimizer-step boundaries
+        if (progress is not None and args.save_every_n_steps > 0
+                and (batch_idx + 1) % (args.save_every_n_steps * args.gradient_accumulation_steps) == 0):
+            save_training_state(args.checkpoint_dir, model, optimizer, scheduler, dict(
+                progress, batches_done=batch_idx + 1, epoch_rng=epoch_rng,
+                train_loss_totals=(total_loss, total_tokens),
+            ))
 
     avg_loss = total_loss / total_tokens if total_tokens > 0 else 0
     return avg_loss
@@ -327,6 +510,9 @@ def eval_epoch_quick(args, model, dev_loader, end_token_id):
             encoder_mask = encoder_mask.to(DEVICE)
             decoder_input = decoder_input.to(DEVICE)
             decoder_targets = decoder_targets.to(DEVICE)
+            encoder_input, encoder_mask, decoder_input, decoder_targets = bucket_batch(
+                args, encoder_input, encoder_mask, decoder_input, decoder_targets
+            )
             
             # Mask END token and everything after it
             masked_targets = mask_end_token_and_after(decoder_targets, end_token_id)
@@ -351,7 +537,11 @@ def eval_epoch_quick(args, model, dev_loader, end_token_id):
     avg_loss = total_loss / total_tokens if total_tokens > 0 else 0
     return avg_loss
         
-def eval_epoch(args, model, dev_loader, tokenizer, epoch, end_token_id):
+def eval_epoch(args, model, dev_loader, tokenizer, epoch, end_token_id, indices=None):
+    # With indices, only that subset of the dev set is evaluated
+    if indices is not None:
+        dev_loader = DataLoader(Subset(dev_loader.dataset, indices), batch_size=dev_loader.batch_size,
+                                shuffle=False, collate_fn=dev_loader.collate_fn)
     model.eval()
     total_loss = 0
     total_tokens = 0
@@ -362,7 +552,7 @@ def eval_epoch(args, model, dev_loader, tokenizer, epoch, end_token_id):
     
     sql_queries = []
     
-    progress_bar = tqdm(dev_loader, desc="Detailed Eval")
+    progress_bar = tqdm(dev_loader, desc="Detailed Eval" if indices is None else "Detailed Eval (subset)")
     
     with torch.no_grad():
         for batch_idx, (encoder_input, encoder_mask, decoder_input, decoder_targets, _) in enumerate(progress_bar):
@@ -370,13 +560,23 @@ def eval_epoch(args, model, dev_loader, tokenizer, epoch, end_token_id):
             encoder_mask = encoder_mask.to(DEVICE)
             decoder_input = decoder_input.to(DEVICE)
             decoder_targets = decoder_targets.to(DEVICE)
+            encoder_input, encoder_mask, decoder_input, decoder_targets = bucket_batch(
+                args, encoder_input, encoder_mask, decoder_input, decoder_targets
+            )
             
             # Mask END token and everything after it
             masked_targets = mask_end_token_and_after(decoder_targets, end_token_id)
             
+            # Run the encoder once; its outputs feed both the loss and generation
+            encoder_outputs = model.get_encoder()(
+                input_ids=encoder_input,
+                attention_mask=encoder_mask,
+                return_dict=True,
+            )
+            
             # Compute loss
             outputs = model(
-                input_ids=encoder_input,
+                encoder_outputs=encoder_outputs,
                 attention_mask=encoder_mask,
                 decoder_input_ids=decoder_input,
             )
@@ -395,7 +595,7 @@ def eval_epoch(args, model, dev_loader, tokenizer, epoch, end_token_id):
             # Generate SQL queries
             if args.num_beams > 1:
                 generated_ids = model.generate(
-                    input_ids=encoder_input,
+                    encoder_outputs=encoder_outputs,
                     attention_mask=encoder_mask,
                     max_length=args.max_gen_length,
                     num_beams=args.num_beams,
@@ -403,7 +603,7 @@ def eval_epoch(args, model, dev_loader, tokenizer, epoch, end_token_id):
                 )
             else:
                 generated_ids = model.generate(
-                    input_ids=encoder_input,
+                    encoder_outputs=encoder_outputs,
                     attention_mask=encoder_mask,
                     max_length=args.max_gen_length,
                 )
@@ -419,8 +619,7 @@ def eval_epoch(args, model, dev_loader, tokenizer, epoch, end_token_id):
     
     # Load ground truth (without END tokens)
     gt_sql_path = 'data/dev.sql'
-    with open(gt_sql_path, 'r') as f:
-        gt_queries = [line.strip() for line in f.readlines()]
+    gt_queries = read_queries(gt_sql_path)
     
     # Load NL queries
     nl_path = 'data/dev.nl'
@@ -428,8 +627,9 @@ def eval_epoch(args, model, dev_loader, tokenizer, epoch, end_token_id):
         nl_queries = [line.strip() for line in f.readlines()]
     
     # Save queries (without END tokens)
-    model_sql_path = f'results/t5_scratch_{args.experiment_name}_dev_epoch{epoch}.sql'
-    model_record_path = f'records/t5_scratch_{args.experiment_name}_dev_epoch{epoch}.pkl'
+    split_name = 'dev' if indices is None else 'dev_subset'
+    model_sql_path = f'results/t5_scratch_{args.experiment_name}_{split_name}_epoch{epoch}.sql'
+    model_record_path = f'records/t5_scratch_{args.experiment_name}_{split_name}_epoch{epoch}.pkl'
     
     with open(model_sql_path, 'w') as f:
         for sql in sql_queries:
@@ -441,19 +641,21 @@ def eval_epoch(args, model, dev_loader, tokenizer, epoch, end_token_id):
     # Load ground truth records
     gt_record_path = 'records/ground_truth_dev.pkl'
     if not os.path.exists(gt_record_path):
-        with open(gt_sql_path, 'r') as f:
-            gt_queries_for_records = [line.strip() for line in f.readlines()]
-        save_queries_and_records(gt_queries_for_records, gt_sql_path, gt_record_path)
+        save_queries_and_records(gt_queries, gt_sql_path, gt_record_path)
+    _, gt_records, _ = load_queries_and_records(gt_sql_path, gt_record_path)
+    model_queries, records, error_msgs = load_queries_and_records(model_sql_path, model_record_path)
+    
+    num_dev_examples = len(gt_queries)
+    if indices is not None:
+        gt_queries = [gt_queries[i] for i in indices]
+        gt_records = [gt_records[i] for i in indices]
+        nl_queries = [nl_queries[i] for i in indices]
     
     # Compute metrics
-    sql_em, record_em, record_f1, _ = compute_metrics(
-        gt_sql_path, model_sql_path, gt_record_path, model_record_path
-    )
-
-    # Count syntax errors
-    import pickle
-    with open(model_record_path, 'rb') as f:
-        records, error_msgs = pickle.load(f)
+    sql_em = compute_sql_exact_match(gt_queries, model_queries)
+    record_em = compute_record_exact_match(gt_records, records)
+    record_f1s = compute_record_F1s(gt_records, records)
+    record_f1 = float(np.mean(record_f1s))
 
     num_syntax_errors = sum(1 for msg in error_msgs if msg)
     error_rate = num_syntax_errors / len(error_msgs) if error_msgs else 0
@@ -472,6 +674,9 @@ def eval_epoch(args, model, dev_loader, tokenizer, epoch, end_token_id):
     return {
         'loss': avg_loss,
         'record_f1': record_f1,
+        'record_f1_ci': mean_confidence_interval(record_f1s, num_dev_examples, args.dev_subset_confidence),
+        'num_examples': len(sql_queries),
+        'subset': indices is not None,
         'record_em': record_em,
         'sql_em': sql_em,
         'error_rate': error_rate,
@@ -491,6 +696,7 @@ def test_inference(args, model, test_loader, tokenizer, model_sql_path, model_re
         for encoder_input, encoder_mask, _ in progress_bar:
             encoder_input = encoder_input.to(DEVICE)
             encoder_mask = encoder_mask.to(DEVICE)
+            encoder_input, encoder_mask = bucket_batch(args, encoder_input, encoder_mask)
             
             # Generate
             if args.num_beams > 1:
@@ -525,14 +731,13 @@ def test_inference(args, model, test_loader, tokenizer, model_sql_path, model_re
 
 def load_model_from_checkpoint(args, best=True):
     """Load scratch model from checkpoint"""
-    checkpoint_file = 'best_model.pt' if best else 'last_model.pt'
-    checkpoint_path = os.path.join(args.checkpoint_dir, checkpoint_file)
+    wait_for_checkpoints()
+    checkpoint_path = get_checkpoint_path(args.checkpoint_dir, best)
     
     print(f"\nLoading model from {checkpoint_path}")
     
     model = initialize_model_scratch(args)
-    checkpoint = torch.load(checkpoint_path, map_location=DEVICE)
-    model.load_state_dict(checkpoint['model_state_dict'])
+    load_model_weights(model, checkpoint_path)
     
     return model
 
@@ -546,6 +751,7 @@ def setup_wandb_scratch(args):
             config={
                 "learning_rate": args.learning_rate,
                 "weight_decay": args.weight_decay,
+                "optimizer": args.optimizer,
                 "scheduler": args.scheduler_type,
                 "batch_size": args.batch_size,
                 "gradient_accumulation_steps": args.gradient_accumulation_steps,
@@ -555,6 +761,8 @@ def setup_wandb_scratch(args):
                 "max_epochs": args.max_n_epochs,
                 "warmup_epochs": args.num_warmup_epochs,
                 "heavy_augmentation": args.heavy_augmentation,
+                "sql_tokenizer": args.sql_tokenizer,
+                "trim_vocab": args.trim_vocab,
                 "eval_every_n_epochs": args.eval_every_n_epochs,
                 "format": "Question/Answer with END",
             }
@@ -583,22 +791,31 @@ def main():
         # We'll need to modify load_data or use a custom path
     
     # Load tokenizer and data
-    tokenizer = T5TokenizerFast.from_pretrained('google-t5/t5-small')
+    tokenizer = load_scratch_tokenizer(args)
     train_loader, dev_loader, test_loader = load_t5_data_scratch(
         args.batch_size, args.test_batch_size,
         use_schema=args.use_schema,
         use_preprocessed=args.use_preprocessed,
-        use_heavy_aug=args.heavy_augmentation
+        use_heavy_aug=args.heavy_augmentation,
+        tokenizer=tokenizer
     )
-    
+
+    # Stratified dev subset for the periodic detailed evals (set before the async evaluator pickles args)
+    args.dev_subset_indices = (stratified_subset(dev_loader.dataset.sql_queries, args.dev_subset_size)
+                               if args.dev_subset_size > 0 else None)
+
     # Initialize model from scratch
     model = initialize_model_scratch(args)
     
     # Apply custom weight initialization
     apply_weight_init(model)
+    if args.gradient_checkpointing:
+        enable_gradient_checkpointing(model, args.checkpoint_stacks, args.checkpoint_every_n_layers)
     
     # Initialize optimizer and scheduler
     optimizer, scheduler = initialize_optimizer_and_scheduler(args, model, len(train_loader))
+    if args.compile:
+        model = compile_model(model, args)
     
     # Train
     train(args, model, train_loader, dev_loader, optimizer, scheduler, tokenizer)
@@ -607,6 +824,8 @@ def main():
     print("\nLoading best model for final evaluation...")
     model = load_model_from_checkpoint(args, best=True)
     model.eval()
+    if args.compile:
+        model = compile_model(model, args)
     
     # Get END token ID
     end_token_id = get_end_token_id(tokenizer)
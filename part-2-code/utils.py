@@ -4,15 +4,23 @@ import os
 import re
 import pickle
 import random
+from collections import OrderedDict
 from tqdm import tqdm
 
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from statistics import NormalDist
 from typing import List, Any
 
 import torch
+import torch.distributed as dist
 
 DB_PATH = 'data/flight_database.db'
 
+# Query -> (records, error message) for queries executed by compute_records; the database is read-only.
+# Least recently used entries are evicted beyond RECORD_CACHE_SIZE so long runs stay bounded.
+RECORD_CACHE_SIZE = 4096
+RECORD_CACHE = OrderedDict()
+
 def compute_metrics(gt_path: str, model_path: str, gt_query_records: str = None, model_query_records: str = None):
     '''
     Main function to compute the three metrics used for evaluation: 
@@ -94,16 +102,26 @@ def compute_records(processed_qs: List[str]):
     num_threads = 10
     timeout_secs = 120
 
+    # Each distinct query runs once; queries already executed in this process
+    # (e.g. by an earlier epoch's evaluation) are not run again
+    results = {}
+    for query in dict.fromkeys(processed_qs):
+        if query in RECORD_CACHE:
+            RECORD_CACHE.move_to_end(query)
+            results[query] = RECORD_CACHE[query]
+    pending = [query for query in dict.fromkeys(processed_qs) if query not in results]
+
     pool = ThreadPoolExecutor(num_threads)
     futures = []
-    for i, query in enumerate(processed_qs):
+    for i, query in enumerate(pending):
         futures.append(pool.submit(compute_record, i, query))
         
-    rec_dict = {}
     try:
         for x in tqdm(as_completed(futures, timeout=timeout_secs)):
             query_id, rec, error_msg = x.result()
-            rec_dict[query_id] = (rec, error_msg)
+            results[pending[query_id]] = RECORD_CACHE[pending[query_id]] = (rec, error_msg)
+            if len(RECORD_CACHE) > RECORD_CACHE_SIZE:
+                RECORD_CACHE.popitem(last=False)
     except:
         for future in futures:
             if not future.done():
@@ -111,14 +129,11 @@ def compute_records(processed_qs: List[str]):
             
     recs = []
     error_msgs = []
-    for i in range(len(processed_qs)):
-        if i in rec_dict:
-            rec, error_msg = rec_dict[i]
-            recs.append(rec)
-            error_msgs.append(error_msg)
-        else:
-            recs.append([])
-            error_msgs.append("Query timed out")
+    for query in processed_qs:
+        # Timed-out queries are not cached, so they are retried next time
+        rec, error_msg = results.get(query, ([], "Query timed out"))
+        recs.append(rec)
+        error_msgs.append(error_msg)
             
     return recs, error_msgs
 
@@ -166,6 +181,12 @@ def compute_record_F1(gt_records: List[Any], model_records: List[Any]):
     Helper function to compute F1 between records
     generated by ground-truth and model SQL queries
     '''
+    return np.mean(compute_record_F1s(gt_records, model_records))
+
+def compute_record_F1s(gt_records: List[Any], model_records: List[Any]):
+    '''
+    Per-query record F1 scores (compute_record_F1 is their mean)
+    '''
     F1s = []
     for gt_rec, model_rec in zip(gt_records, model_records):
         gt_set = set(gt_rec)
@@ -186,7 +207,61 @@ def compute_record_F1(gt_records: List[Any], model_records: List[Any]):
         F1 = 2 * precision * recall / (precision + recall + 1e-8)
         F1s.append(F1)
 
-    return np.mean(F1s)
+    return F1s
+
+def sql_template(sql_query: str):
+    '''
+    Coarse template of a SQL query: what it selects, with table aliases stripped
+    (e.g. flight.flight_id, fare.fare_id, count()
+    '''
+    match = re.match(r"SELECT\s+(?:DISTINCT\s+)?(\S+)", sql_query.strip(), re.IGNORECASE)
+    if match is None:
+        return ''
+    return re.sub(r"_\d+\b", "", match.group(1))
+
+def stratified_subset(sql_queries: List[str], subset_size: int, num_length_buckets: int = 4, seed: int = 0):
+    '''
+    Sorted indices of a random subset of sql_queries, stratified by SQL template and
+    query length bucket (quantiles of the token count). Each stratum gets a share of
+    subset_size proportional to its size (largest remainder), so the plain mean over
+    the subset is an estimate of the mean over all queries.
+    '''
+    if subset_size >= len(sql_queries):
+        return list(range(len(sql_queries)))
+
+    lengths = [len(q.split()) for q in sql_queries]
+    edges = np.quantile(lengths, np.linspace(0, 1, num_length_buckets + 1)[1:-1])
+    strata = {}
+    for i, (query, length) in enumerate(zip(sql_queries, lengths)):
+        key = (sql_template(query), int(np.searchsorted(edges, length, side='right')))
+        strata.setdefault(key, []).append(i)
+
+    keys = sorted(strata)
+    quotas = [subset_size * len(strata[key]) / len(sql_queries) for key in keys]
+    counts = [int(q) for q in quotas]
+    by_remainder = sorted(range(len(keys)), key=lambda k: quotas[k] - counts[k], reverse=True)
+    for k in by_remainder[:subset_size - sum(counts)]:
+        counts[k] += 1
+
+    rng = random.Random(seed)
+    indices = []
+    for key, count in zip(keys, counts):
+        indices += rng.sample(strata[key], count)
+    return sorted(indices)
+
+def mean_confidence_interval(values: List[float], population_size: int, confidence: float = 0.9):
+    '''
+    Normal-approximation confidence interval for the population mean estimated from a
+    sample of values drawn without replacement from population_size items. Treats the
+    sample as simple random, which is conservative for a proportional stratified sample.
+    '''
+    n = len(values)
+    mean = float(np.mean(values))
+    if n < 2 or n >= population_size:
+        return mean, mean
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    standard_error = np.std(values, ddof=1) / np.sqrt(n) * np.sqrt(1 - n / population_size)
+    return max(0.0, mean - z * standard_error), min(1.0, mean + z * standard_error)
 
 def set_random_seeds(seed_value=42):
     '''
@@ -200,3 +275,121 @@ def set_random_seeds(seed_value=42):
     torch.cuda.manual_seed_all(seed_value)
     torch.backends.cudnn.deterministic = True
     torch.backends.cudnn.benchmark = False
+
+def get_rng_state():
+    '''
+    Snapshot of every RNG that training draws from (data shuffling, dropout, augmentation).
+    '''
+    return {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+    }
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'].cpu())
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state['cuda']])
+
+def setup_distributed():
+    '''
+    Initialize a gloo process group when launched with torchrun, e.g.
+        torchrun --nproc_per_node=2 train_t5.py --finetune
+    Single-process runs (WORLD_SIZE unset or 1) are left untouched.
+    Returns (rank, world_size).
+    '''
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size > 1 and not is_distributed():
+        dist.init_process_group(backend='gloo')
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // int(os.environ.get('LOCAL_WORLD_SIZE', world_size))))
+
+        # Only the main process prints, unless print(..., force=True)
+        import builtins
+        builtin_print = builtins.print
+        def print_main(*args, force=False, **kwargs):
+            if force or is_main_process():
+                builtin_print(*args, **kwargs)
+        builtins.print = print_main
+
+    return get_rank(), get_world_size()
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+def is_main_process():
+    return get_rank() == 0
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+def all_reduce_sum(*values):
+    '''
+    Sum python scalars across ranks (e.g. loss and token totals).
+    '''
+    if not is_distributed():
+        return values
+    tensor = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tuple(tensor.tolist())
+
+def broadcast_object(obj):
+    '''
+    Send a picklable object from the main process to every rank.
+    '''
+    if not is_distributed():
+        return obj
+    container = [obj]
+    dist.broadcast_object_list(container, src=0)
+    return container[0]
+
+def gather_shards(shard: List[Any]):
+    '''
+    Merge per-rank results produced from a strided shard (examples rank, rank + world_size, ...)
+    back into dataset order. Every rank receives the merged list.
+    '''
+    if not is_distributed():
+        return shard
+    shards = [None] * get_world_size()
+    dist.all_gather_object(shards, shard)
+
+    merged = []
+    for i in range(max(len(s) for s in shards)):
+        for s in shards:
+            if i < len(s):
+                merged.append(s[i])
+    return merged
+
+def save_sharded_queries_and_records(sql_queries: List[str], sql_path: str, record_path: str):
+    '''
+    Distributed counterpart of save_queries_and_records: each rank executes its own shard
+    of the generated queries, then the shards are merged in dataset order and only the
+    main process writes the files. Returns the merged list of queries.
+    '''
+    if not is_distributed():
+        save_queries_and_records(sql_queries, sql_path, record_path)
+        return sql_queries
+
+    records, error_msgs = compute_records(sql_queries)
+    sql_queries = gather_shards(sql_queries)
+    records = gather_shards(records)
+    error_msgs = gather_shards(error_msgs)
+
+    if is_main_process():
+        with open(sql_path, 'w') as f:
+            for query in sql_queries:
+                f.write(f'{query}\n')
+        with open(record_path, 'wb') as f:
+            pickle.dump((records, error_msgs), f)
+    barrier()
+
+    return sql_queries